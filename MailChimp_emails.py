@@ -1,13 +1,13 @@
 from pandas import DataFrame, notna, notnull
 from members import *
+from memberships import MembershipIntervals
+from pipeline import compute, lazy_attributes, stage
+from writers import OutputRun, csv_output, submit_output
 
 
 def output_members(mbrs, prefix):
-    mbrs.drop(columns=['Mailing List', 'Associate'])\
-        .to_csv(
-        prefix + 'members' + NOW.isoformat().replace(':', '-') + '.csv',
-        index=False
-    )
+    submit_output(csv_output, prefix + 'members' + NOW.isoformat().replace(':', '-') + '.csv',
+                  mbrs.drop(columns=['Mailing List', 'Associate']))
 
 
 def output_different_member_types(mbrs):
@@ -16,22 +16,34 @@ def output_different_member_types(mbrs):
     output_members(mbrs[notna(mbrs['Mailing List']) & mbrs['Mailing List']], 'mailing_list_')
 
 
-def gather_member_details(for_date: Timestamp, mbrs: DataFrame, accs: DataFrame, issu: DataFrame):
+def gather_member_details(for_date: Timestamp, mbrs: DataFrame, accs: DataFrame, intervals: MembershipIntervals):
     from_date = for_date - offsets.MonthBegin() * 13
 
     curr = concat([
-        issu[issu['Card End Date'] > from_date].set_index('Membership ID')[[]],
+        DataFrame(index=intervals.members_ending_after(from_date)),
         accs[accs['Date first joined'] > from_date][[]]
     ])
     curr = curr.groupby(curr.index).first()
 
     return mbrs[notnull(mbrs['Email'])][['Email', 'Informal Name', 'Full Name', 'Mailing List']].join(
-        accounts[['Associate']]
+        accs[['Associate']]
     )   .join(curr, how='inner')\
         .sort_index()\
         .reset_index(names='Membership ID')
 
 
-member_email_details = gather_member_details(NOW, members, accounts, issuance)
+@stage('member_email_details', 'members', 'accounts', 'membership_intervals')
+def process_member_email_details(members, accounts, membership_intervals):
+    return gather_member_details(NOW, members, accounts, membership_intervals)
 
-output_different_member_types(member_email_details)
+
+def write_member_types():
+    output_different_member_types(compute('member_email_details'))
+
+
+__getattr__ = lazy_attributes(__name__)
+
+
+if __name__ == '__main__':
+    with OutputRun():
+        write_member_types()
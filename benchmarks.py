@@ -0,0 +1,1023 @@
+import argparse
+import locale
+import math
+import os
+import re
+import resource
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Any, Callable, Dict, NamedTuple
+
+import numpy as np
+from openpyxl import load_workbook
+from pandas import DataFrame, ExcelWriter, Index, Series, Timestamp, concat, isna, offsets, to_timedelta
+from pandas.testing import assert_frame_equal
+
+from cards_to_print import (create_cards, create_issuances, create_reprints, lay_out_cards,
+                            timestamp_to_long_date_with_ordinal)
+from collation import sort_collated
+from fees import fee_schedule
+from kernels import affordability, kernel_backends, preprint_split, renewal_due
+from ledger import RunningBalances
+from memberships import MembershipIntervals
+from postal_batches import resolve_issuance_fees
+import utils
+from schema import compact_column, schemas
+from statement_store import StatementStore, statements_sheet
+from synthetic_data import synthetic_issuance, synthetic_statements
+from writers import ExcelOutput, OutputRun, csv_output, excel_output, output_workers, write_csv
+from members import (NOW, month_begin, create_addressee, create_addressees, create_formal_name, create_full_name, create_informal_greeting,
+                     create_informal_name, create_names, reshape_contact_fields, resolve_addresses, trim_normalise_string)
+
+
+class Result(NamedTuple):
+    benchmark: str
+    size: int
+    variant: str
+    seconds: float
+    peak_mib: float
+
+
+type Benchmark = Callable[[int], list[Result]]
+
+benchmarks: Dict[str, Benchmark] = {}
+
+
+def benchmark(name: str):
+    def register(function: Benchmark) -> Benchmark:
+        benchmarks[name] = function
+        return function
+
+    return register
+
+
+def measure(function: Callable[[], Any]) -> tuple[Any, float, float]:
+    # timed and traced separately, as tracemalloc slows down the code it watches
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    del result
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak / 2 ** 20
+
+
+def compare_variants(name: str, size: int, variants: Dict[str, Callable[[], Any]],
+                     check: Callable[[Any, Any], None] = assert_frame_equal) -> list[Result]:
+    results, reference = [], None
+    for variant, function in variants.items():
+        result, seconds, peak_mib = measure(function)
+        if reference is None:
+            reference = result
+        else:
+            check(reference, result)
+        results.append(Result(name, size, variant, seconds, peak_mib))
+    return results
+
+
+def synthetic_normal_members(size: int, seed: int = 0) -> DataFrame:
+    rng = np.random.default_rng(seed)
+    offsite = rng.random(size) < 0.25
+    return DataFrame({
+        'Membership Number': np.arange(1, size + 1),
+        'Diff Address': np.where(offsite, 'Y', None),
+        'Offsite Address Line 1': np.where(offsite, 'Elsewhere Road', None),
+        'Offsite Address Line 2': np.where(offsite & (rng.random(size) < 0.5), 'Flat 2', None),
+        'Offsite City': np.where(offsite, 'Leeds', None),
+        'Offsite Post Code': np.where(offsite, 'LS1 1AA', None),
+        'Onsite Address 1': [f'{i} Some House' for i in range(size)],
+        'Onsite Address 2': 'Barbican',
+        'Onsite City': 'London',
+        'Onsite Post Code': rng.choice(['EC2Y 8AA', 'EC2Y 8BB', 'EC2Y 8DD'], size),
+    })
+
+
+def rowwise_address_resolution(normal_members: DataFrame) -> DataFrame:
+    # members.process_normal_members before resolve_addresses
+    return normal_members.apply(
+        lambda row:
+        {
+            'Associate': False,
+            'Offsite': True,
+            'Address Line 1': row['Offsite Address Line 1'],
+            'Address Line 2': row['Offsite Address Line 2'],
+            'City': row['Offsite City'],
+            'Post Code': row['Offsite Post Code'],
+        } if row['Diff Address'] == 'Y' else {
+            'Associate': False,
+            'Offsite': False,
+            'Address Line 1': row['Onsite Address 1'],
+            'Address Line 2': row['Onsite Address 2'],
+            'City': row['Onsite City'],
+            'Post Code': row['Onsite Post Code'],
+        },
+        axis=1,
+        result_type='expand'
+    )
+
+
+@benchmark('address_resolution')
+def bench_address_resolution(size: int) -> list[Result]:
+    normal_members = synthetic_normal_members(size)
+    return compare_variants('address_resolution', size, {
+        'row-wise': lambda: rowwise_address_resolution(normal_members),
+        'vectorized': lambda: resolve_addresses(normal_members),
+    })
+
+
+def synthetic_all_members(size: int, seed: int = 0, contacts: int = 3) -> DataFrame:
+    rng = np.random.default_rng(seed)
+    all_members = DataFrame({
+        'Property Code': [f'P{i:06d}' for i in range(size)],
+        'E mail': np.where(rng.random(size) < 0.8, [f'm{i}@example.com' for i in range(size)], None),
+        'Post Zone': rng.choice(['Barbican', 'UK', 'Europe', 'Zone 1'], size),
+    }, index=np.arange(1, size + 1))
+    all_members.index.name = 'Membership Number'
+    for count in range(1, contacts + 1):
+        present = rng.random(size) < 1 / count
+        all_members[f'Title {count}'] = np.where(present, rng.choice(['Mr', 'Mrs', 'Dr', None], size), None)
+        all_members[f'First name {count}'] = np.where(present, rng.choice(['Alice', ' Bob ', 'J', '  ', None], size), None)
+        all_members[f'Middlename {count}'] = np.where(present & (rng.random(size) < 0.2), 'Lee', None)
+        all_members[f'Surname {count}'] = np.where(present, rng.choice(['Smith', 'Jones ', 'le Carré', None], size), None)
+        all_members[f'Telephone {count}'] = np.where(present & (rng.random(size) < 0.6),
+                                                     rng.integers(2070000000, 2079999999, size), None)
+        all_members[f'Mailing List {count}'] = np.where(present, rng.random(size) < 0.7, None)
+    return all_members
+
+
+def rowwise_contact_reshape(all_members: DataFrame) -> DataFrame:
+    # members.process_members before reshape_contact_fields
+    members = all_members[
+        [
+            col for
+            col in
+            all_members.columns
+            if re.search('E mail|((Title|First name|Middlename|Surname|Telephone|E mail|Mailing List) \\d)$', col)
+        ]]\
+        .stack()\
+        .reset_index(level=1)\
+        .rename(columns={
+            'level_1': 'Field Name',
+            0: 'Value'
+        }).apply(
+            lambda row: {
+                'Field Name': row['Field Name'][0:len(row['Field Name']) - 2]
+                if row['Field Name'][-1].isdigit()
+                else row['Field Name'],
+                'Count': int(row['Field Name'][len(row['Field Name']) - 1])
+                if row['Field Name'][-1].isdigit()
+                else 1,
+                'Value': row['Value']
+            },
+            axis=1,
+            result_type='expand'
+    ).reset_index(names=['Membership ID'])\
+        .set_index(['Membership ID', 'Count', 'Field Name'])\
+        .unstack(level=2)
+    members = members.reset_index(level=1, col_level=1)
+    members.columns = members.columns.droplevel(0)
+    return members.applymap(trim_normalise_string)
+
+
+@benchmark('contact_reshape')
+def bench_contact_reshape(size: int) -> list[Result]:
+    all_members = synthetic_all_members(size)
+    return compare_variants('contact_reshape', size, {
+        'row-wise': lambda: rowwise_contact_reshape(all_members),
+        'vectorized': lambda: reshape_contact_fields(all_members),
+    })
+
+
+def rowwise_names(members: DataFrame) -> DataFrame:
+    # members.process_members before create_names
+    return members.apply(
+        lambda row: {
+            'Formal Name': create_formal_name(row['Title'], row['First name'], row['Surname']),
+            'Informal Name': create_informal_name(row['Title'], row['First name'], row['Surname']),
+            'Full Name': create_full_name(row['Title'], row['First name'], row['Middlename'], row['Surname']),
+        },
+        axis=1,
+        result_type='expand'
+    )
+
+
+@benchmark('names')
+def bench_names(size: int) -> list[Result]:
+    members = reshape_contact_fields(synthetic_all_members(size))
+    members = members[members['First name'].notna() | members['Middlename'].notna() | members['Surname'].notna()]
+    # every first name blank, as when a sheet has the column but nothing in it
+    blank_first_names = members.assign(**{'First name': ''})
+    return compare_variants('names', size, {
+        'row-wise': lambda: rowwise_names(members),
+        'vectorized': lambda: create_names(members),
+    }) + compare_variants('names blank first', size, {
+        'row-wise': lambda: rowwise_names(blank_first_names),
+        'vectorized': lambda: create_names(blank_first_names),
+    })
+
+
+def synthetic_members(all_members: DataFrame) -> DataFrame:
+    members = reshape_contact_fields(all_members)
+    members = members[members['First name'].notna() | members['Middlename'].notna() | members['Surname'].notna()]
+    return concat([members, create_names(members)], axis='columns')
+
+
+def rowwise_addressees(members: DataFrame, alt_addressees: DataFrame, current_ids: Index) -> DataFrame:
+    # members.process_accounts before create_addressees
+    return members\
+        .reset_index(names='Membership ID')\
+        .set_index(['Membership ID', 'Count'])\
+        .groupby(['Membership ID']).agg(**{
+            'Normal Addressee': ('Formal Name', create_addressee),
+            'Informal Greeting': ('Informal Name', create_informal_greeting)
+        })\
+        .join(alt_addressees)\
+        .reset_index(names='Membership ID')\
+        .apply(
+            lambda row: {
+                'Membership ID': row['Membership ID'],
+                'Informal Greeting': row['Informal Greeting'],
+                'Addressee': row['Normal Addressee'] if isna(row['Alt Addressee']) else row['Alt Addressee'],
+                'Current Member': row['Membership ID'] in current_ids,
+            },
+            axis=1,
+            result_type='expand'
+        )\
+        .set_index('Membership ID')
+
+
+def vectorized_addressees(members: DataFrame, alt_addressees: DataFrame, current_ids: Index) -> DataFrame:
+    addressees = create_addressees(members).join(alt_addressees)
+    return DataFrame({
+        'Informal Greeting': addressees['Informal Greeting'],
+        'Addressee': addressees['Alt Addressee'].where(addressees['Alt Addressee'].notna(),
+                                                       addressees['Normal Addressee']),
+        'Current Member': addressees.index.isin(current_ids),
+    })
+
+
+@benchmark('addressees')
+def bench_addressees(size: int) -> list[Result]:
+    all_members = synthetic_all_members(size, contacts=4)
+    all_members['Alt Addressee'] = np.where(np.arange(size) % 20 == 0, 'The Trustees', None)
+    members = synthetic_members(all_members)
+    current_ids = Index(all_members.index[::3])
+    return compare_variants('addressees', size, {
+        'row-wise': lambda: rowwise_addressees(members, all_members[['Alt Addressee']], current_ids),
+        'vectorized': lambda: vectorized_addressees(members, all_members[['Alt Addressee']], current_ids),
+    })
+
+
+# postal_batches.fee_mappings, which the fee schedule replaced
+fee_mappings = dict(zip(fee_schedule.fees, fee_schedule.postal_zones(fee_schedule.fees, NOW)))
+
+
+def self_joined_postal_batches(issuance: DataFrame, members: DataFrame, preprints: DataFrame) -> DataFrame:
+    # postal_batches.self_joined_issuance, which resolve_issuance_fees replaced, sorted stably where it used a
+    # quicksort, which left rows tied on processing date in no fixed order
+    def create_resolved_columns(row_dict):
+        fee = row_dict['Membership Fee Original'] if row_dict['Has Fee'] else row_dict['Membership Fee Joined'] if row_dict['Replace Fee'] else 0
+        batch_date = row_dict['Processing Date Original']
+        letters = 1
+        membership_cards = row_dict['Members']
+        preprinted_letters = 0
+        preprinted_cards = 0
+        if not isna(row_dict['Preprinted']):
+            batch_date = row_dict['Card Issuance Original']
+            letters, preprinted_letters = preprinted_letters, letters
+            membership_cards, preprinted_cards = preprinted_cards, membership_cards
+        return {
+            'Batch': batch_date.strftime('%Y%m'),
+            'Fee': fee,
+            'Zone': fee_mappings[fee],
+            'Valid': fee > 0,
+            'Letters': letters,
+            'Cards': membership_cards,
+            'Preprinted Letters': preprinted_letters,
+            'Preprinted Cards': preprinted_cards
+        }
+
+    indexed_issuance = issuance.set_index('Membership ID')
+    self_joined_issuance = indexed_issuance\
+        .join(indexed_issuance, lsuffix=' Original', rsuffix=' Joined')\
+        .join(members.groupby('Membership ID').agg(**{'Members': ('Count', 'max')}))\
+        .reset_index()
+    self_joined_issuance = preprints\
+        .set_index(['Membership Number', 'Letter Date'])\
+        .merge(
+            self_joined_issuance,
+            how='right',
+            left_index=True,
+            right_on=['Membership ID', 'Card Issuance Original'])\
+        .sort_values('Processing Date Joined', ascending=False, kind='stable')
+    self_joined_issuance['Has Fee'] =\
+        ((self_joined_issuance['Membership Fee Original'] > 0) &
+         (self_joined_issuance['Processing Date Original'] == self_joined_issuance['Processing Date Joined']))
+    self_joined_issuance['Previous Prospectives'] =\
+        ((self_joined_issuance['Membership Fee Original'] == 0) &
+         (self_joined_issuance['Processing Date Original'] > self_joined_issuance['Processing Date Joined']))
+    self_joined_issuance['Closest Prospective'] = ~self_joined_issuance.duplicated(
+        ['Membership ID', 'Processing Date Original', 'Membership Fee Original', 'Membership Fee Joined',
+         'Previous Prospectives'])
+    self_joined_issuance['Replace Fee'] =\
+        ((self_joined_issuance['Membership Fee Original'] == 0) &
+         (self_joined_issuance['Membership Fee Joined'] > 0) &
+         self_joined_issuance['Previous Prospectives'] &
+         self_joined_issuance['Closest Prospective'])
+    self_joined_issuance =\
+        concat([self_joined_issuance,
+                self_joined_issuance.apply(create_resolved_columns, axis=1, result_type='expand')],
+               axis=1)
+    return self_joined_issuance[self_joined_issuance['Valid'] > 0][
+        ['Batch', 'Zone', 'Letters', 'Cards', 'Preprinted Letters', 'Preprinted Cards']]
+
+
+def as_of_postal_batches(issuance: DataFrame, members: DataFrame, preprints: DataFrame) -> DataFrame:
+    return resolve_issuance_fees(issuance, members, preprints)[
+        ['Batch', 'Zone', 'Letters', 'Cards', 'Preprinted Letters', 'Preprinted Cards']]
+
+
+# the self-join joins every member's cards with each other, so it is left out past this many members
+self_join_max_size = 20_000
+
+
+@benchmark('postal_batches')
+def bench_postal_batches(size: int) -> list[Result]:
+    # in no particular order, as the sheet is kept, with a few cards not yet given a Membership ID
+    issuance = synthetic_issuance(size).sample(frac=1, random_state=0).reset_index(drop=True)
+    issuance['Membership ID'] = issuance['Membership ID'].astype(float)\
+        .mask(np.random.default_rng(0).random(len(issuance)) < 0.002)
+    members = DataFrame({'Count': 1}, index=Index(np.arange(1, size + 1), name='Membership ID'))
+    preprints = issuance.sample(frac=0.02, random_state=0)[['Membership ID', 'Card Issuance']]\
+        .set_axis(['Membership Number', 'Letter Date'], axis=1)\
+        .drop_duplicates()\
+        .assign(Preprinted=True)
+    variants = {
+        'self-join': lambda: self_joined_postal_batches(issuance, members, preprints),
+        'as-of': lambda: as_of_postal_batches(issuance, members, preprints),
+    }
+    if size > self_join_max_size:
+        del variants['self-join']
+    return compare_variants('postal_batches', size, variants,
+                            check=lambda expected, actual: assert_frame_equal(expected, actual, check_dtype=False))
+
+
+def assert_same_arrays(expected, actual):
+    for expected_array, actual_array in zip(expected, actual, strict=True):
+        np.testing.assert_array_equal(expected_array, actual_array)
+
+
+def kernel_variants(kernel: Callable[..., Any], *args) -> Dict[str, Callable[[], Any]]:
+    variants = {}
+    for backend in kernel_backends:
+        # compile before timing, numba caches the machine code after the first call
+        kernel(*args, backend=backend)
+        variants[backend] = lambda backend=backend: kernel(*args, backend=backend)
+    return variants
+
+
+# cards_to_print.get_account_fee and create_affordability_row, which the fee schedule replaced
+associate_fee = fee_schedule.associate_fee(NOW)
+zone_fees = dict(zip(fee_schedule.zones, fee_schedule.zone_fees(fee_schedule.zones, NOW)))
+other_zone_fee = fee_schedule.zone_fees([None], NOW)[0]
+
+
+def get_account_fee(r):
+    if r['Associate']:
+        return associate_fee
+    else:
+        return zone_fees.get(r['Post Zone'], other_zone_fee)
+
+
+def create_affordability_row(r):
+    fee = get_account_fee(r)
+    balance = r['Balance']
+    return {
+        **r,
+        'Balance': balance,
+        'Membership Fee': fee,
+        'Can Afford': balance >= fee
+    }
+
+
+def synthetic_accounts(size: int, seed: int = 0) -> DataFrame:
+    rng = np.random.default_rng(seed)
+    balances = rng.choice([0, 5, 8, 10, 11, 14, 20], size).astype(float)
+    balances[rng.random(size) < 0.1] = np.nan
+    return DataFrame({
+        'Associate': rng.random(size) < 0.1,
+        'Post Zone': rng.choice(['Barbican', 'UK', 'Europe', 'Zone 1', 'Zone 3', None], size),
+        'Balance': balances,
+    }, index=Index(np.arange(1, size + 1), name='Membership Number'))
+
+
+@benchmark('affordability')
+def bench_affordability(size: int) -> list[Result]:
+    accounts = synthetic_accounts(size)
+    args = (accounts['Associate'], fee_schedule.zone_fees(accounts['Post Zone'], NOW), accounts['Balance'],
+            associate_fee)
+
+    def rowwise():
+        rows = accounts.apply(create_affordability_row, axis=1, result_type='expand')
+        return rows['Membership Fee'].to_numpy(), rows['Can Afford'].to_numpy(bool)
+
+    return compare_variants('affordability', size, {'rowwise': rowwise, **kernel_variants(affordability, *args)},
+                            check=assert_same_arrays)
+
+
+# cards_to_print.zone_mapping and zone_mapper, which the fee schedule replaced
+zone_mapping: Dict[str, int] = dict(zip(fee_schedule.zones, range(len(fee_schedule.zones))))
+
+
+def zone_mapper(zone: str | Series) -> int:
+    if isinstance(zone, Series):
+        return zone_mapper(zone.iloc[0])
+    else:
+        zone_str = str(zone)
+        if zone_str not in zone_mapping:
+            raise ValueError(f'No such zone {zone_str}')
+        return zone_mapping[zone_str]
+
+
+@benchmark('zone_rules')
+def bench_zone_rules(size: int) -> list[Result]:
+    rng = np.random.default_rng(0)
+    zones = Series(rng.choice(fee_schedule.zones, size))
+    fees = Series(rng.choice(fee_schedule.fees, size))
+    return compare_variants('zone_rules', size, {
+        'per value': lambda: (zones.map(zone_mapper).to_numpy(), fees.map(fee_mappings).to_numpy()),
+        'lookup tables': lambda: (fee_schedule.zone_orders(zones), fee_schedule.postal_zones(fees, NOW)),
+    }, check=assert_same_arrays)
+
+
+@benchmark('renewal_filter')
+def bench_renewal_filter(size: int) -> list[Result]:
+    rng = np.random.default_rng(0)
+    now = Timestamp.today()
+    renewal_dates = Series(now.normalize() + to_timedelta(rng.integers(-400, 400, size), unit='D'))
+    renewal_dates[rng.random(size) < 0.05] = None
+    can_afford = rng.random(size) < 0.8
+    horizon = now + offsets.MonthEnd() * 3
+    return compare_variants('renewal_filter', size, kernel_variants(
+        lambda *args, backend: (renewal_due(*args, backend=backend),),
+        renewal_dates, can_afford, now, horizon, True, False), check=assert_same_arrays)
+
+
+@benchmark('preprint_split')
+def bench_preprint_split(size: int) -> list[Result]:
+    rng = np.random.default_rng(0)
+    preprinted = rng.random(size) < 0.1
+    members = rng.choice([1.0, 2.0, 3.0, np.nan], size, p=[0.7, 0.2, 0.09, 0.01])
+    return compare_variants('preprint_split', size, kernel_variants(preprint_split, preprinted, members),
+                            check=assert_same_arrays)
+
+
+def memory_status_kib(field: str) -> int:
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(f'{field}:'))
+
+
+def reset_peak_rss() -> int:
+    # Linux can restart the peak RSS from the current RSS, which importing the libraries has usually pushed well
+    # above; elsewhere the process-wide peak is all there is
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return memory_status_kib('VmRSS')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def peak_rss_kib() -> int:
+    try:
+        return memory_status_kib('VmHWM')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def load_with_engine(files_dir: str, name: str, sheet: str, engine: str) -> tuple[DataFrame, str, float, float]:
+    # run in a fresh process, so that its peak RSS is the load's alone
+    utils.files_dir = files_dir
+    rss_before = reset_peak_rss()
+    start = time.perf_counter()
+    with utils.Workbook(name, engine) as workbook:
+        df = workbook.parse(sheet)
+    seconds = time.perf_counter() - start
+    return df, workbook.engine, seconds, (peak_rss_kib() - rss_before) / 1024
+
+
+@benchmark('excel_engines')
+def bench_excel_engines(size: int) -> list[Result]:
+    # peak_mib is the growth in peak RSS of the loading process rather than traced allocations
+    results = []
+    with tempfile.TemporaryDirectory() as files_dir:
+        for name, sheet, df in [('Statements', 'Statements 30-91-79 27933660', synthetic_statements(size)),
+                                ('Card Issuances', 'Card Issuance', synthetic_issuance(size // 3))]:
+            with ExcelWriter(os.path.join(files_dir, f'{name}.xlsx')) as writer:
+                df.to_excel(writer, sheet_name=sheet, index=False)
+            reference = None
+            for engine in utils.excel_engines:
+                with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+                    df, used, seconds, peak_mib = executor.submit(
+                        load_with_engine, files_dir, name, sheet, engine).result()
+                if reference is None:
+                    reference = df
+                else:
+                    assert_frame_equal(reference, df)
+                variant = engine if used == engine else f'{engine}->{used}'
+                results.append(Result(f'excel {name}', len(df), variant, seconds, peak_mib))
+    return results
+
+
+def write_statements(directory: str, statements: DataFrame):
+    utils.close_workbooks()
+    with ExcelWriter(os.path.join(directory, f'{statements_sheet.workbook}.xlsx')) as writer:
+        statements.to_excel(writer, sheet_name=statements_sheet.sheet, index=False)
+
+
+def check_newest_first_ingest(directory: str, statements: DataFrame, month: Timestamp):
+    # a newest first export is ingested a quarter of its rows at a time, each added at the top
+    newest_first = statements.iloc[::-1].reset_index(drop=True)
+    store = StatementStore(os.path.join(directory, 'newest first'))
+    ingested = 0
+    for quarter in range(3, -1, -1):
+        rows = newest_first.iloc[len(newest_first) * quarter // 4:]
+        write_statements(directory, rows)
+        assert store.ingest() == len(rows) - ingested
+        ingested = len(rows)
+    expected = newest_first[newest_first['Transaction Date'].dt.to_period('M') == month.to_period('M')]
+    assert_frame_equal(expected.reset_index(drop=True), store.month(month.to_period('M')).reset_index(drop=True))
+
+
+@benchmark('statement_month')
+def bench_statement_month(size: int) -> list[Result]:
+    statements = synthetic_statements(size)
+    month_start = Timestamp.today().normalize() - offsets.MonthBegin() * 2
+    month_end = month_start + offsets.MonthBegin()
+    files_dir = utils.files_dir
+    with tempfile.TemporaryDirectory() as directory:
+        utils.files_dir = directory
+        try:
+            write_statements(directory, statements)
+            store = StatementStore(os.path.join(directory, 'store'))
+            store.ingest()
+
+            def whole_sheet():
+                with utils.Workbook(statements_sheet.workbook) as workbook:
+                    statement_history = workbook.parse(statements_sheet.sheet)
+                return statement_history[(statement_history['Transaction Date'] >= month_start) &
+                                         (statement_history['Transaction Date'] < month_end)]
+
+            def partition():
+                store.ingest()
+                return store.month(month_start.to_period('M'))
+
+            results = compare_variants('statement_month', size, {'whole sheet': whole_sheet, 'partition': partition})
+            check_newest_first_ingest(directory, statements, month_start)
+            return results
+        finally:
+            utils.close_workbooks()
+            utils.files_dir = files_dir
+
+
+def synthetic_payment_history(size: int, seed: int = 0) -> DataFrame:
+    rng = np.random.default_rng(seed)
+    return DataFrame({
+        'Membership ID': rng.integers(1, size // 5 + 2, size),
+        'Date': Timestamp.today().normalize() - to_timedelta(rng.integers(0, 2000, size), unit='D'),
+        'Amount': rng.choice([-14, -8, 5, 7.5, 8, 10, 11, 20], size),
+    }).set_index(['Membership ID', 'Date']).sort_index()
+
+
+def fee_totals(issuance: DataFrame, members: DataFrame, payment_history: DataFrame) -> tuple:
+    # sums and products of money, which wrapped around when the money columns were compacted to int8
+    charges = issuance['Membership Fee'] * issuance['Membership ID'].map(members['Count'])
+    return (charges.groupby(issuance['Card Issuance']).sum().to_numpy(), charges.to_numpy(),
+            (payment_history['Amount'] * 100).to_numpy())
+
+
+@benchmark('compact_totals')
+def bench_compact_totals(size: int) -> list[Result]:
+    rng = np.random.default_rng(0)
+    # fees, counts and amounts larger than an int8 or int16 holds
+    issuance = synthetic_issuance(size, fees=rng.choice([14, 150, 300], size))
+    members = DataFrame({'Count': rng.integers(1, 300, size)}, index=Index(np.arange(1, size + 1), name='Membership ID'))
+    payment_history = synthetic_payment_history(size).assign(Amount=rng.choice([-300, -14, 8, 150, 400], size))
+
+    def compacted(name: str, df: DataFrame) -> DataFrame:
+        return df.assign(**{column: compact_column(df[column], kind)
+                            for column, kind in schemas[name].items() if column in df})
+
+    return compare_variants('compact_totals', size, {
+        'as read': lambda: fee_totals(issuance, members, payment_history),
+        'compacted': lambda: fee_totals(compacted('issuance', issuance), compacted('members', members),
+                                        compacted('payment_history', payment_history)),
+    }, check=assert_same_arrays)
+
+
+@benchmark('balances_as_of')
+def bench_balances_as_of(size: int) -> list[Result]:
+    payment_history = synthetic_payment_history(size)
+    rng = np.random.default_rng(1)
+    # every member's balance on their own renewal date, some time in the last two years
+    members = rng.permutation(np.arange(1, size // 5 + 2))
+    dates = np.asarray(Timestamp.today().normalize() - to_timedelta(rng.integers(0, 730, len(members)), unit='D'))
+
+    def groupby_per_date():
+        balances = np.full(len(members), np.nan)
+        history_dates = payment_history.index.get_level_values('Date')
+        for date in np.unique(dates):
+            at_date = dates == date
+            totals = payment_history[history_dates <= date].groupby(level='Membership ID')['Amount'].sum()
+            balances[at_date] = totals.reindex(members[at_date]).to_numpy()
+        return balances,
+
+    def running_balances():
+        return RunningBalances(payment_history).as_of(members, dates),
+
+    # the running_balances stage is built once and queried for each date asked about
+    prebuilt = RunningBalances(payment_history)
+    return compare_variants('balances_as_of', size, {
+        'groupby per date': groupby_per_date,
+        'running balances': running_balances,
+        'lookup only': lambda: (prebuilt.as_of(members, dates),),
+    }, check=assert_same_arrays)
+
+
+def synthetic_card_issuance(size: int, seed: int = 0) -> DataFrame:
+    rng = np.random.default_rng(seed)
+    card_issuance = Timestamp.today().normalize() - offsets.MonthBegin() * rng.integers(0, 120, size)
+    return DataFrame({
+        'Membership ID': rng.integers(1, size // 3 + 2, size),
+        'Card Issuance': card_issuance,
+        'Card End Date': card_issuance + offsets.MonthBegin() * 12 + offsets.MonthEnd(),
+    })
+
+
+@benchmark('membership_counts')
+def bench_membership_counts(size: int) -> list[Result]:
+    issuance = synthetic_card_issuance(size)
+    # members current on the first of each month of the last ten years
+    months = Timestamp.today().normalize() - offsets.MonthBegin() * np.arange(120)
+
+    def filter_per_month():
+        return np.array([
+            issuance[(issuance['Card Issuance'] <= month) & (issuance['Card End Date'] >= month)]['Membership ID']
+            .nunique() for month in months]),
+
+    return compare_variants('membership_counts', size, {
+        'filter per month': filter_per_month,
+        'intervals': lambda: (MembershipIntervals(issuance).current_counts(months),),
+    }, check=assert_same_arrays)
+
+
+def synthetic_renewals(size: int, seed: int = 0) -> tuple[DataFrame, DataFrame]:
+    rng = np.random.default_rng(seed)
+    renewal_dates = Series(month_begin + to_timedelta(rng.integers(-90, 90, size), unit='D'))
+    renewal_dates[rng.random(size) < 0.05] = None
+    renewals = DataFrame({
+        'Membership Fee': rng.choice([5, 8, 10, 11, 14], size),
+        'Can Afford': rng.random(size) < 0.8,
+        'Renewal Date': renewal_dates.to_numpy(),
+        'Issuance Count': np.where(rng.random(size) < 0.1, np.nan, rng.integers(0, 5, size)),
+    }, index=Index(np.arange(1, size + 1), name='Membership Number'))
+    reprint_count = size // 50 + 1
+    card_issuance = Series(month_begin - to_timedelta(rng.integers(0, 300, reprint_count), unit='D'))
+    reprints = DataFrame({
+        'Reset Issuance': rng.random(reprint_count) < 0.5,
+        'Card Issuance.Card Issuance': card_issuance.to_numpy(),
+        'Card Issuance.Renewal Date': (card_issuance + offsets.MonthBegin() * 12).to_numpy(),
+        'Card Issuance.Card End Date': (card_issuance + offsets.MonthBegin() * 12 + offsets.MonthEnd()).to_numpy(),
+        'Issuance Count': rng.integers(1, 5, reprint_count),
+    }, index=Index(rng.choice(np.arange(size + 1, 2 * size + 1), reprint_count, replace=False), name='Membership ID'))
+    return renewals, reprints
+
+
+def rowwise_renewals(renewals: DataFrame, reprints: DataFrame) -> DataFrame:
+    # cards_to_print.create_issuance, create_reprint_row_creator and the letter date apply before create_issuances
+    card_renewal_date = month_begin + offsets.MonthBegin() * 12
+    card_end_date = card_renewal_date + offsets.MonthEnd()
+
+    def create_issuance(r):
+        card_issuance = month_begin if isna(r['Renewal Date']) or r['Renewal Date'] < NOW else r['Renewal Date']
+        renewal_date = card_issuance + offsets.MonthBegin() * 12
+        return {
+            'Processing Date': NOW,
+            'Card Issuance': card_issuance,
+            'Renewal Date': renewal_date,
+            'Card End Date': renewal_date + offsets.MonthEnd(),
+            'Membership Fee': r['Membership Fee'],
+            'Issuance Count': r['Issuance Count'],
+            'Anticipatory': not r['Can Afford']
+        }
+
+    reprinted = reprints.apply(lambda r: {
+        'Processing Date': NOW,
+        'Card Issuance': month_begin,
+        'Renewal Date': card_renewal_date,
+        'Card End Date': card_end_date,
+        'Membership Fee': 0,
+        'Issuance Count': r['Issuance Count'],
+        'Anticipatory': False
+    } if r['Reset Issuance'] else {
+        'Processing Date': NOW,
+        'Card Issuance': r['Card Issuance.Card Issuance'],
+        'Renewal Date': r['Card Issuance.Renewal Date'],
+        'Card End Date': r['Card Issuance.Card End Date'],
+        'Membership Fee': 0,
+        'Issuance Count': r['Issuance Count'],
+        'Anticipatory': False
+    }, axis=1, result_type='expand')
+    return concat([renewals.apply(create_issuance, axis=1, result_type='expand'), reprinted])\
+        .apply(lambda r: {
+            **r,
+            'Letter Date': r['Card Issuance'] if r['Card Issuance'] > month_begin else month_begin,
+            'Previous Issuance': r['Issuance Count'] > 0
+        }, axis=1, result_type='expand')
+
+
+def vectorized_renewals(renewals: DataFrame, reprints: DataFrame) -> DataFrame:
+    end_dates = concat([create_issuances(renewals), create_reprints(reprints)])
+    return end_dates.assign(**{
+        'Letter Date': end_dates['Card Issuance'].where(end_dates['Card Issuance'] > month_begin, month_begin),
+        'Previous Issuance': end_dates['Issuance Count'] > 0
+    })
+
+
+@benchmark('renewals')
+def bench_renewals(size: int) -> list[Result]:
+    renewals, reprints = synthetic_renewals(size)
+    return compare_variants('renewals', size, {
+        'row-wise': lambda: rowwise_renewals(renewals, reprints),
+        'vectorized': lambda: vectorized_renewals(renewals, reprints),
+    })
+
+
+def synthetic_cards_to_print(size: int, seed: int = 0) -> tuple[DataFrame, DataFrame]:
+    rng = np.random.default_rng(seed)
+    card_issuance = Series(month_begin - offsets.MonthBegin() * rng.integers(0, 24, size))
+    competitions = DataFrame({
+        'Year': np.arange(2016, 2027),
+        'Text': [f'This years picture is by Kid {year - 1}.' for year in range(2016, 2027)],
+    }).set_index('Year')
+    return DataFrame({
+        'Membership Number': rng.integers(1, 5000, size),
+        'Address 1': rng.choice(np.array(['1 Some House', '22 Other House', np.nan], object), size),
+        'Full Name': rng.choice(['Mr Bob Smith', 'Dr Carol le Carré', None], size),
+        'Card Issuance': card_issuance.to_numpy(),
+        'Card End Date': (card_issuance + offsets.MonthBegin() * 12 + offsets.MonthEnd()).to_numpy(),
+        'Anticipatory': rng.random(size) < 0.1,
+    }, index=rng.permutation(size)), competitions
+
+
+def rowwise_cards(cards: DataFrame, competitions: DataFrame) -> DataFrame:
+    # cards_to_print.create_card_row_creator before create_cards
+    filename_count = 0
+
+    def create_card_row(r):
+        nonlocal filename_count
+        filename_count += 1
+        year = r['Card End Date'].year - (2 if r['Card End Date'].month < 4 else 1)
+        return {
+            'p': 'p',
+            'n': f'Card_{filename_count:0=4}',
+            'mn': r['Membership Number'],
+            'ad': r['Address 1'],
+            'nm': r['Full Name'],
+            'd': timestamp_to_long_date_with_ordinal(r['Card End Date']),
+            'year': year,
+            'sy': r['Card Issuance'].year,
+            'em': r['Card End Date'].month_name()[0:3],
+            'ey': r['Card End Date'].year,
+            'pw': (competitions.loc[year] if year in competitions.index else {'Text': ''})['Text'],
+            'an': r['Anticipatory']
+        }
+
+    return cards.apply(create_card_row, axis=1, result_type='expand')
+
+
+@benchmark('cards')
+def bench_cards(size: int) -> list[Result]:
+    cards, competitions = synthetic_cards_to_print(size)
+    results = compare_variants('cards', size, {
+        'row-wise': lambda: rowwise_cards(cards, competitions),
+        'column-wise': lambda: create_cards(cards, competitions),
+    })
+    # the row-wise cards failed on a missing end date, and the column-wise ones must not print another
+    no_end_date = cards.assign(**{'Card End Date': cards['Card End Date'].mask(cards.index == cards.index[-1])})
+    try:
+        create_cards(no_end_date, competitions)
+    except ValueError as error:
+        assert str(no_end_date['Membership Number'].iloc[-1]) in str(error)
+    else:
+        raise AssertionError('a card with no end date was printed')
+    return results
+
+
+def synthetic_cards(size: int, seed: int = 0) -> DataFrame:
+    rng = np.random.default_rng(seed)
+    end_year = rng.integers(2025, 2028, size)
+    address = rng.choice(np.array(['1 Some House', '22 Other House', 'Flat 3, Tower', np.nan, 7.0, 12.5], object), size)
+    return DataFrame({
+        'p': 'p',
+        'n': [f'Card_{i:0=4}' for i in range(1, size + 1)],
+        'mn': rng.integers(1, 5000, size),
+        'ad': address,
+        'nm': rng.choice(['Mr Bob Smith', 'Dr Carol le Carré', None], size),
+        'd': '31st of October 2027',
+        'year': end_year - 1,
+        'sy': end_year - 1,
+        'em': 'Oct',
+        'ey': end_year,
+        'pw': rng.choice(['', 'This years picture is by Kid, winner of the Barbican Photo Competition.'], size),
+        'an': rng.random(size) < 0.1,
+    }, index=rng.permutation(size))
+
+
+def groupby_cards_10up(cards: DataFrame) -> DataFrame:
+    # cards_to_print.process_cards_10up before lay_out_cards
+    cards_10up = cards.copy(deep=False)
+    cards_10up[['n', 'c']] = [("{:04.0f}".format(math.floor(i / 10)), i % 10) for i in range(len(cards_10up))]
+    cards_10up = cards_10up\
+        .groupby('n')\
+        .apply(
+            lambda df: df.apply(
+                lambda r: {k + "{:0.0f}".format(r['c'] + 1): v for (k, v) in r.items() if k not in ['an', 'n', 'c', 'p']},
+                axis=1,
+                result_type='expand'))\
+        .groupby('n')\
+        .agg(
+            lambda s: ([("{:0.0f}".format(v) if isinstance(v, float) else v)
+                        for v in s if not isinstance(v, float) or not math.isnan(v)][:1] or [np.nan])[0])\
+        .reset_index(names='n')
+    cards_10up.insert(1, 'p', 'p')
+    return cards_10up
+
+
+def assert_same_csv(expected: DataFrame, actual: DataFrame):
+    assert expected.to_csv(index=False) == actual.to_csv(index=False)
+
+
+@benchmark('cards_10up')
+def bench_cards_10up(size: int) -> list[Result]:
+    cards = synthetic_cards(size)
+    return compare_variants('cards_10up', size, {
+        'groupby': lambda: groupby_cards_10up(cards),
+        'positional': lambda: lay_out_cards(cards, 10),
+    }, check=assert_same_csv)
+
+
+def synthetic_member_names(size: int, seed: int = 0) -> DataFrame:
+    rng = np.random.default_rng(seed)
+    surnames = np.array([f'{name}{i}' for i in range(size // 10 + 1) for name in ['Smith', 'le Carré', "O'Brien"]], object)
+    first_names = np.array(['Alice', 'bob', 'Émile', 'Zoë', None], object)
+    return DataFrame({
+        'Surname': rng.choice(surnames, size),
+        'First name': rng.choice(first_names, size),
+        'Middlename': np.where(rng.random(size) < 0.2, 'Lee', None),
+        'Property Code': [f'P{i:06d}' for i in rng.integers(0, size, size)],
+    })
+
+
+@benchmark('collation_sort')
+def bench_collation_sort(size: int) -> list[Result]:
+    member_names = synthetic_member_names(size)
+    columns = ['Surname', 'First name', 'Middlename', 'Property Code']
+    return compare_variants('collation_sort', size, {
+        'strxfrm per cell': lambda: member_names.sort_values(
+            columns, key=lambda col: [locale.strxfrm(x.lower()) if isinstance(x, str) else x for x in col]),
+        'collation keys': lambda: sort_collated(member_names, columns),
+        # as when sorted again in the same run, with the keys of every name already worked out
+        'cached keys': lambda: sort_collated(member_names, columns),
+    })
+
+
+def cell_layout(path: str) -> dict:
+    # each sheet's merged ranges, and every written cell's value and format
+    book = load_workbook(path)
+    return {sheet.title: (sorted(str(cells) for cells in sheet.merged_cells.ranges), [
+        (cell.coordinate, cell.value, cell.number_format, cell.font.b, cell.alignment.horizontal,
+         cell.alignment.vertical, cell.border.top.style, cell.border.right.style, cell.border.bottom.style,
+         cell.border.left.style) for row in sheet.iter_rows() for cell in row if cell.has_style or cell.value is not None
+    ]) for sheet in book.worksheets}
+
+
+def assert_same_workbooks(expected_path: str, actual_path: str):
+    expected, actual = cell_layout(expected_path), cell_layout(actual_path)
+    assert list(expected) == list(actual)
+    for sheet in expected:
+        assert expected[sheet] == actual[sheet], sheet
+
+
+def assert_same_files(expected_path: str, actual_path: str):
+    with open(expected_path, 'rb') as expected, open(actual_path, 'rb') as actual:
+        assert expected.read() == actual.read()
+
+
+@benchmark('excel_output')
+def bench_excel_output(size: int) -> list[Result]:
+    # Member Financials: a flat Balances sheet with missing values, and the Payment History sheet, its Membership ID
+    # labels merged down their rows
+    rng = np.random.default_rng(0)
+    balances = DataFrame({
+        'Name': np.where(rng.random(size) < 0.1, None, 'Smith'),
+        'Balance': np.where(rng.random(size) < 0.1, np.nan, rng.choice([-14, 0, 7.5, 20], size)),
+        'Joined': Timestamp.today().normalize() - to_timedelta(
+            np.where(rng.random(size) < 0.1, np.nan, rng.integers(0, 2000, size)), unit='D'),
+        'Current': rng.random(size) < 0.5,
+    }, index=Index(np.arange(1, size + 1), name='Membership ID'))
+    payment_history = synthetic_payment_history(size)
+    with tempfile.TemporaryDirectory() as out_dir:
+        def written(constant_memory: bool) -> Callable[[], str]:
+            def write() -> str:
+                path = os.path.join(out_dir, f'Member Financials {constant_memory}.xlsx')
+                with ExcelOutput(path, constant_memory) as output:
+                    output.write(balances, 'Balances')
+                    output.write(payment_history, 'Payment History')
+                return path
+            return write
+
+        return compare_variants('excel_output', size, {
+            'to_excel': written(False),
+            'constant memory': written(True),
+        }, check=assert_same_workbooks)
+
+
+@benchmark('csv_output')
+def bench_csv_output(size: int) -> list[Result]:
+    # as the current_members CSV, with a membership number column
+    member_details = synthetic_member_names(size).assign(**{'Membership Number': np.arange(1, size + 1)})
+    with tempfile.TemporaryDirectory() as out_dir:
+        def to_csv() -> str:
+            path = os.path.join(out_dir, 'to_csv.csv')
+            member_details.to_csv(path, index=False)
+            return path
+
+        def arrow_chunks() -> str:
+            path = os.path.join(out_dir, 'arrow.csv')
+            write_csv(member_details, path)
+            return path
+
+        return compare_variants('csv_output', size, {'to_csv': to_csv, 'arrow chunks': arrow_chunks},
+                                check=assert_same_files)
+
+
+@benchmark('output_run')
+def bench_output_run(size: int) -> list[Result]:
+    # a workbook and CSVs like those of cards_to_print, written one after another and by a pool of processes;
+    # peak_mib is the main process's only
+    payment_history = synthetic_payment_history(size)
+    member_details = synthetic_member_names(size)
+    with tempfile.TemporaryDirectory() as out_dir:
+        def written(workers: int) -> Callable[[], list[str]]:
+            def write() -> list[str]:
+                now = Timestamp.today()
+                paths = [os.path.join(out_dir, f'{name} {workers}{extension}')
+                         for name, extension in [('Member Financials', '.xlsx'), ('current_members', '.csv'),
+                                                 ('Current Email Details', '.csv')]]
+                with OutputRun(workers, now) as run:
+                    run.submit(excel_output, paths[0], [('Payment History', payment_history, True)])
+                    run.submit(csv_output, paths[1], member_details)
+                    run.submit(csv_output, paths[2], member_details[['Surname', 'First name']])
+                os.remove(run.manifest_path)
+                return paths
+            return write
+
+        def assert_same_outputs(expected: list[str], actual: list[str]):
+            assert_same_workbooks(expected[0], actual[0])
+            for expected_path, actual_path in zip(expected[1:], actual[1:]):
+                assert_same_files(expected_path, actual_path)
+
+        return compare_variants('output_run', size, {
+            'one at a time': written(1),
+            'worker pool': written(max(output_workers, 2)),
+        }, check=assert_same_outputs)
+
+
+def print_results(results: list[Result]):
+    for result in results:
+        print(f'{result.benchmark:<28} {result.size:>8} {result.variant:<18} '
+              f'{result.seconds:9.3f}s {result.peak_mib:9.1f} MiB')
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description='Time the vectorized processing steps against the code they replaced.')
+    parser.add_argument('names', nargs='*', choices=list(benchmarks), metavar='benchmark',
+                        help=f'benchmarks to run (default all): {", ".join(benchmarks)}')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 200_000])
+    args = parser.parse_args(argv)
+
+    for name in args.names or list(benchmarks):
+        for size in args.sizes:
+            print_results(benchmarks[name](size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import pickle
+import time
+from typing import Callable
+
+import pandas as pd
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+def file_digest(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def source_stamp(path: str, digest: Callable[[str], str] = file_digest) -> dict:
+    # what source_is_current checks a file against later
+    stat = os.stat(path)
+    return {
+        'path': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': digest(path),
+    }
+
+
+def source_is_current(entry: dict | None, path: str, digest: Callable[[str], str] = file_digest) -> bool:
+    # whether the file is still the one stamped in the entry; a new mtime alone updates the entry in place
+    if not entry or entry.get('path') != os.path.abspath(path):
+        return False
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != entry['size']:
+        return False
+    if stat.st_mtime_ns != entry['mtime_ns']:
+        # touched or copied but possibly unchanged; only the content hash can tell
+        if digest(path) != entry['sha256']:
+            return False
+        entry['mtime_ns'] = stat.st_mtime_ns
+    return True
+
+
+def write_json_atomic(path: str, obj, indent: int = None):
+    # written beside the file and renamed over it, so a reader never sees half of it
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_file = path + f'.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(obj, f, indent=indent)
+    os.replace(tmp_file, path)
+
+
+def to_arrow_table(df: pd.DataFrame):
+    if pa is None or not all(isinstance(col, str) for col in df.columns):
+        return None
+    try:
+        return pa.Table.from_pandas(df)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # mixed-type columns, e.g. a Telephone column holding both numbers and text
+        return None
+
+
+def from_arrow_table(table) -> pd.DataFrame:
+    df = table.to_pandas()
+    # read_excel leaves blank cells as NaN where Arrow hands back None
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].fillna(np.nan)
+    return df
+
+
+def write_frame(df: pd.DataFrame, base_file: str) -> str:
+    # Parquet where Arrow can hold the columns, otherwise a pickle; returns the format written
+    table = to_arrow_table(df)
+    data_format = 'parquet' if table is not None else 'pickle'
+    data_file = f'{base_file}.{data_format}'
+    if table is not None:
+        pq.write_table(table, data_file + '.tmp')
+    else:
+        with open(data_file + '.tmp', 'wb') as f:
+            pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(data_file + '.tmp', data_file)
+    return data_format
+
+
+def read_frame(base_file: str, data_format: str) -> pd.DataFrame:
+    data_file = f'{base_file}.{data_format}'
+    if data_format == 'parquet':
+        return from_arrow_table(pq.read_table(data_file))
+    with open(data_file, 'rb') as f:
+        return pickle.load(f)
+
+
+class SheetCache:
+    """Columnar copies of parsed worksheets, keyed on the workbook's path, size, mtime and content hash.
+
+    Entries are evicted when their workbook changes or disappears, and least-recently-used first once the
+    cache grows beyond ``max_bytes``.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(directory, 'index.json')
+        self._index = None
+        self._digests: dict[tuple[str, int, int], str] = {}
+
+    @property
+    def index(self) -> dict[str, dict]:
+        if self._index is None:
+            try:
+                with open(self.index_file) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+            self.evict_stale()
+        return self._index
+
+    def _save_index(self):
+        write_json_atomic(self.index_file, self._index, indent=1)
+
+    def _digest(self, path: str) -> str:
+        # each workbook hashed once however many of its sheets are cached
+        stat = os.stat(path)
+        stamp = (path, stat.st_size, stat.st_mtime_ns)
+        if stamp not in self._digests:
+            self._digests[stamp] = file_digest(path)
+        return self._digests[stamp]
+
+    @staticmethod
+    def key(path: str, sheet: str, variant: str = '') -> str:
+        return hashlib.sha1(f'{os.path.abspath(path)}\0{sheet}\0{variant}'.encode()).hexdigest()
+
+    def _data_file(self, key: str, entry: dict) -> str:
+        return os.path.join(self.directory, f'{key}.{entry["format"]}')
+
+    def _remove(self, key: str):
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            try:
+                os.remove(self._data_file(key, entry))
+            except OSError:
+                pass
+
+    def _is_current(self, entry: dict) -> bool:
+        return source_is_current(entry, entry['path'], self._digest)
+
+    def evict_stale(self):
+        stale = [key for key, entry in self._index.items() if not self._is_current(entry)]
+        for key in stale:
+            self._remove(key)
+        if stale:
+            self._save_index()
+
+    def evict_lru(self):
+        total = sum(entry['bytes'] for entry in self._index.values())
+        for key, entry in sorted(self._index.items(), key=lambda item: item[1]['used']):
+            if total <= self.max_bytes:
+                break
+            total -= entry['bytes']
+            self._remove(key)
+
+    def get(self, path: str, sheet: str, variant: str = '') -> pd.DataFrame | None:
+        key = self.key(path, sheet, variant)
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        if not self._is_current(entry):
+            self._remove(key)
+            self._save_index()
+            return None
+        try:
+            df = read_frame(os.path.join(self.directory, key), entry['format'])
+        except Exception:
+            self._remove(key)
+            self._save_index()
+            return None
+        entry['used'] = time.time()
+        self._save_index()
+        return df
+
+    def put(self, path: str, sheet: str, df: pd.DataFrame, variant: str = ''):
+        key = self.key(path, sheet, variant)
+        if key in self.index:
+            self._remove(key)
+        entry = {**source_stamp(path, self._digest), 'sheet': sheet, 'variant': variant}
+        os.makedirs(self.directory, exist_ok=True)
+        entry['format'] = write_frame(df, os.path.join(self.directory, key))
+        entry['bytes'] = os.path.getsize(self._data_file(key, entry))
+        entry['used'] = time.time()
+        self._index[key] = entry
+        self.evict_lru()
+        self._save_index()
+
+    def clear(self):
+        for key in list(self.index):
+            self._remove(key)
+        self._save_index()
@@ -1,83 +1,57 @@
-import locale
 import math
-from typing import Callable, Dict
 
-from pandas import Series, isnull, notna
+from pandas import Series, factorize, isnull, notna
 
+from collation import sort_collated
+from fees import fee_schedule
+from kernels import affordability, renewal_due
 from member_financials import *
 from members import *
+from pipeline import compute, lazy_attributes, stage
+from utils import env_setting
+from writers import OutputRun, csv_output, excel_output, submit_output
 
 advance_months = 2
 # This does not work as expected, as it will include anyone who could possibly be renewed
 # I think that I would rather that it only included people who had been members in the previous n months
 include_anticipatory = False
+# the cards on each sheet of card stock, laid out in the Cards_{N}up CSV
+cards_per_sheet = int(env_setting('BA_CARDS_PER_SHEET', '10'))
+if cards_per_sheet < 1:
+    raise ValueError('BA_CARDS_PER_SHEET must be at least 1')
 
 now_str = NOW.isoformat().replace(':', '-')
 
-locale.setlocale(locale.LC_ALL, '')
 
-
-def get_account_fee(r):
-    if r['Associate']:
-        return 10
-    else:
-        match r['Post Zone']:
-            case 'Barbican':
-                return 5
-            case 'UK':
-                return 8
-            case 'Europe':
-                return 11
-            case _:
-                return 14
-
-
-def create_affordability_row(r):
-    fee = get_account_fee(r)
-    balance = r['Balance']
-    return {
-        **r,
-        'Balance': balance,
-        'Membership Fee': fee,
-        'Can Afford': balance >= fee
-    }
-
-
-def create_reprint_row_creator() -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+def create_reprints(reprints: DataFrame) -> DataFrame:
+    # a reset reprint starts a new card this month, the others reprint the member's latest card
     card_renewal_date = month_begin + offsets.MonthBegin() * 12
     card_end_date = card_renewal_date + offsets.MonthEnd()
-    return lambda r: {
-        'Processing Date': NOW,
-        'Card Issuance': month_begin,
-        'Renewal Date': card_renewal_date,
-        'Card End Date': card_end_date,
+    reset = reprints['Reset Issuance'].astype(bool)
+    return DataFrame({
+        'Processing Date': NOW.as_unit('ns'),
+        'Card Issuance': reprints['Card Issuance.Card Issuance'].mask(reset, month_begin),
+        'Renewal Date': reprints['Card Issuance.Renewal Date'].mask(reset, card_renewal_date),
+        'Card End Date': reprints['Card Issuance.Card End Date'].mask(reset, card_end_date),
         'Membership Fee': 0,
-        'Issuance Count': r['Issuance Count'],
+        'Issuance Count': reprints['Issuance Count'],
         'Anticipatory': False
-    } if r['Reset Issuance'] else {
-        'Processing Date': NOW,
-        'Card Issuance': r['Card Issuance.Card Issuance'],
-        'Renewal Date': r['Card Issuance.Renewal Date'],
-        'Card End Date': r['Card Issuance.Card End Date'],
-        'Membership Fee': 0,
-        'Issuance Count': r['Issuance Count'],
-        'Anticipatory': False
-    }
+    }, index=reprints.index)
 
 
-def create_issuance(r):
-    card_issuance = month_begin if isnull(r['Renewal Date']) or r['Renewal Date'] < NOW else r['Renewal Date']
+def create_issuances(renewals: DataFrame) -> DataFrame:
+    renewal_dates = renewals['Renewal Date']
+    card_issuance = renewal_dates.mask(renewal_dates.isna() | (renewal_dates < NOW), month_begin)
     renewal_date = card_issuance + offsets.MonthBegin() * 12
-    end_date = renewal_date + offsets.MonthEnd()
-    return {
-        'Processing Date': NOW,
+    return DataFrame({
+        'Processing Date': NOW.as_unit('ns'),
         'Card Issuance': card_issuance,
         'Renewal Date': renewal_date,
-        'Card End Date': end_date,
-        'Membership Fee': r['Membership Fee'],
-        'Issuance Count': r['Issuance Count'],
-        'Anticipatory': not r['Can Afford']
-    }
+        'Card End Date': renewal_date + offsets.MonthEnd(),
+        'Membership Fee': renewals['Membership Fee'],
+        'Issuance Count': renewals['Issuance Count'],
+        'Anticipatory': ~renewals['Can Afford'].astype(bool)
+    }, index=renewals.index)
 
 
 def timestamp_to_long_date_with_ordinal(ts: Timestamp):
@@ -95,138 +69,150 @@ def timestamp_to_long_date_with_ordinal(ts: Timestamp):
     return f'{day}{day_ordinal} of {month_name} {year}'
 
 
-def create_card_row_creator():
-    filename_count = 0
-
-    def create_card_row(r):
-        nonlocal filename_count
-        filename_count += 1
-        filename = f'Card_{filename_count:0=4}'
-        year = r['Card End Date'].year - (2 if r['Card End Date'].month < 4 else 1)
-        return {
-            'p': 'p',
-            'n': filename,
-            'mn': r['Membership Number'],
-            'ad': r['Address 1'],
-            'nm': r['Full Name'],
-            'd': timestamp_to_long_date_with_ordinal(r['Card End Date']),
-            'year': year,
-            'sy': r['Card Issuance'].year,
-            'em': r['Card End Date'].month_name()[0:3],
-            'ey': r['Card End Date'].year,
-            'pw': (competitions.loc[year] if year in competitions.index else {'Text': ''})['Text'],
-            'an': r['Anticipatory']
-        }
-
-    return create_card_row
-
-
-zone_mapping: Dict[str, int] = {
-    'Zone 3': 0,
-    'Zone 2': 1,
-    'Zone 1': 2,
-    'Europe': 3,
-    'UK': 4,
-    'Barbican': 5
-}
-
-
-def zone_mapper(zone: str | Series) -> int:
-    if isinstance(zone, Series):
-        return zone_mapper(zone.iloc[0])
-    else:
-        zone_str = str(zone)
-        if zone_str not in zone_mapping:
-            raise ValueError(f'No such zone {zone_str}')
-        return zone_mapping[zone_str]
-
-
-write_output_files = __name__ == '__main__'
-
-
-print('loading/processing competitions')
-competitions = \
-    loadFromExcel('Competitions', 'Junior Photography Competition').apply(
-        lambda r: [
-            r['Year'] + 1,
-            'This year''s picture is by ' + r['Winner'] + ', winner of the ' + str(r['Year'] + 1) +
-            ' Barbican Photo Competition.'], axis=1, result_type='expand')\
-    .rename(columns={0: 'Year', 1: 'Text'})\
-    .set_index('Year')
-
-print('processing accounts')
-extant_accounts = accounts[isnull(accounts['Cancelled'])]\
-    .drop(columns=['Cancelled'])\
-    .join(balances)\
-    .apply(create_affordability_row, axis=1, result_type='expand')
-
-
-print('loading force_reprints')
-force_reprints = loadFromExcel('Force Reprints', 'Forced Reprints')
-print('processing force_reprints')
-force_reprints['Reset Issuance'] = notna(force_reprints['Reset Issuance']) & force_reprints['Reset Issuance']
-force_reprints =\
-    force_reprints.set_index(
-        'Membership ID'
-    ).join(
-        issuance[issuance['Card End Date'] > NOW].groupby('Membership ID').agg(**{
-            'Card Issuance.Card Issuance': ('Card Issuance', 'max'),
-            'Card Issuance.Renewal Date': ('Renewal Date', 'max'),
-            'Card Issuance.Card End Date': ('Card End Date', 'max'),
-            'Issuance Count': ('Membership ID', 'count'),
-        }),
-        how='inner'
-    ).apply(
-        create_reprint_row_creator(),
-        axis=1,
-        result_type='expand'
-    )
-
-print('processing card_renewal_dates')
-card_renewal_dates =\
-    concat(
-        [issuance.set_index('Membership ID'), force_reprints]
-    ).groupby('Membership ID').agg(**{
-        'Renewal Date': ('Renewal Date', 'max'),
-        'Issuance Count': ('Renewal Date', 'count'),
-    })
-
-print('loading preprints')
-preprints = loadFromExcel('Preprints')\
-    .drop(columns=['Card End Date', 'Addressee', 'Informal addressee', 'Address Line 1', 'Done'])
-preprints['Preprinted'] = True
-
-print('processing end_dates')
-end_dates = extant_accounts[['Membership Fee', 'Can Afford']].join(card_renewal_dates)
-print('\tfiltering out accounts that aren\'t ready to renew, and creating issuances for the remaining')
-end_date_filter = end_dates['Renewal Date'].isna() | (NOW >= end_dates['Renewal Date'])
-if advance_months > 0:
-    end_date_filter = end_date_filter | (NOW <= end_dates['Renewal Date']) & (end_dates['Renewal Date'] < month_end + offsets.MonthEnd() * advance_months)
-if not include_anticipatory:
-    end_date_filter = end_date_filter & end_dates['Can Afford']
-end_dates = end_dates[end_date_filter]\
-    .apply(create_issuance, axis=1, result_type='expand')
-print('\tadding forced reprints, letter dates and previous issuance')
-if len(end_dates) != 0:
-    end_dates = concat([end_dates, force_reprints])\
-        .apply(
-            lambda r: {
-                **r,
-                'Letter Date': r['Card Issuance'] if r['Card Issuance'] > month_begin else month_begin,
-                'Previous Issuance': r['Issuance Count'] > 0
-            },
-            axis=1,
-            result_type='expand')\
-        .reset_index(names='Membership Number')\
-        .set_index(['Membership Number', 'Letter Date'])\
-        .join(preprints.set_index(['Membership Number', 'Letter Date']))\
-        .reset_index()\
-        .sort_values(by=['Letter Date', 'Previous Issuance', 'Anticipatory', 'Membership Number'])\
-        .set_index('Membership Number')
-    end_dates['Preprinted'].replace(NaN, False, inplace=True)
-
-    used_preprints =\
-        preprints.\
+def create_cards(cards: DataFrame, competitions: DataFrame) -> DataFrame:
+    # a row of the Cards CSV for each card, numbered in the order given
+    end_dates, issuance_dates = cards['Card End Date'], cards['Card Issuance']
+    # each distinct end date is written out once
+    end_date_codes, distinct_end_dates = factorize(end_dates)
+    if (end_date_codes == -1).any():
+        # factorize codes a missing date -1, which would index the last distinct date
+        missing = cards.loc[end_date_codes == -1, 'Membership Number']
+        raise ValueError(f'Cards for {", ".join(map(str, missing))} have no Card End Date')
+    long_end_dates = Series(distinct_end_dates).map(timestamp_to_long_date_with_ordinal).to_numpy()
+    # the years come out as int32
+    end_years, issuance_years = end_dates.dt.year.astype('int64'), issuance_dates.dt.year.astype('int64')
+    year = end_years - (end_dates.dt.month < 4) - 1
+    return DataFrame({
+        'p': 'p',
+        'n': [f'Card_{count:0=4}' for count in range(1, len(cards) + 1)],
+        'mn': cards['Membership Number'],
+        'ad': cards['Address 1'],
+        'nm': cards['Full Name'],
+        'd': long_end_dates[end_date_codes],
+        'year': year,
+        'sy': issuance_years,
+        'em': end_dates.dt.month_name().str[0:3],
+        'ey': end_years,
+        'pw': year.map(competitions['Text']).fillna(''),
+        'an': cards['Anticipatory']
+    }, index=cards.index)
+
+
+def sort_by_zone(zones: DataFrame) -> DataFrame:
+    # a frame indexed by Post Zone in the order the zones are posted
+    return zones.iloc[fee_schedule.zone_orders(zones.index).argsort()]
+
+
+@stage('competitions', sources=[('Competitions', 'Junior Photography Competition')])
+def process_competitions():
+    print('loading/processing competitions')
+    return loadFromExcel('Competitions', 'Junior Photography Competition').apply(
+            lambda r: [
+                r['Year'] + 1,
+                'This year''s picture is by ' + r['Winner'] + ', winner of the ' + str(r['Year'] + 1) +
+                ' Barbican Photo Competition.'], axis=1, result_type='expand')\
+        .rename(columns={0: 'Year', 1: 'Text'})\
+        .set_index('Year')
+
+
+@stage('extant_accounts', 'accounts', 'balances')
+def process_extant_accounts(accounts, balances):
+    print('processing accounts')
+    extant_accounts = accounts[isnull(accounts['Cancelled'])]\
+        .drop(columns=['Cancelled'])\
+        .join(balances)
+    fees, can_afford = affordability(
+        extant_accounts['Associate'],
+        fee_schedule.zone_fees(extant_accounts['Post Zone'], NOW),
+        extant_accounts['Balance'],
+        fee_schedule.associate_fee(NOW))
+    return extant_accounts.assign(**{'Membership Fee': fees, 'Can Afford': can_afford})
+
+
+def extant_accounts_as_of(date) -> DataFrame:
+    # extant accounts with the balance each had on the date, and whether it covered their fee then
+    extant_accounts = compute('extant_accounts')
+    date = Timestamp(date)
+    balances = compute('running_balances').as_of(extant_accounts.index, date)
+    fees, can_afford = affordability(
+        extant_accounts['Associate'], fee_schedule.zone_fees(extant_accounts['Post Zone'], date), balances,
+        fee_schedule.associate_fee(date))
+    return extant_accounts.assign(**{'Balance': balances, 'Membership Fee': fees, 'Can Afford': can_afford})
+
+
+@stage('force_reprints', 'issuance', 'membership_intervals', sources=[('Force Reprints', 'Forced Reprints')])
+def process_force_reprints(issuance, membership_intervals):
+    print('loading force_reprints')
+    force_reprints = loadFromExcel('Force Reprints', 'Forced Reprints')
+    print('processing force_reprints')
+    force_reprints['Reset Issuance'] = notna(force_reprints['Reset Issuance']) & force_reprints['Reset Issuance']
+    return force_reprints.set_index(
+            'Membership ID'
+        ).join(
+            issuance.iloc[membership_intervals.cards_ending_after(NOW)].groupby('Membership ID').agg(**{
+                'Card Issuance.Card Issuance': ('Card Issuance', 'max'),
+                'Card Issuance.Renewal Date': ('Renewal Date', 'max'),
+                'Card Issuance.Card End Date': ('Card End Date', 'max'),
+                'Issuance Count': ('Membership ID', 'count'),
+            }),
+            how='inner'
+        ).pipe(create_reprints)
+
+
+@stage('card_renewal_dates', 'issuance', 'force_reprints')
+def process_card_renewal_dates(issuance, force_reprints):
+    print('processing card_renewal_dates')
+    return concat(
+            [issuance.set_index('Membership ID'), force_reprints]
+        ).groupby('Membership ID').agg(**{
+            'Renewal Date': ('Renewal Date', 'max'),
+            'Issuance Count': ('Renewal Date', 'count'),
+        })
+
+
+@stage('preprints', sources=[('Preprints', 'Preprints')])
+def load_preprints():
+    print('loading preprints')
+    preprints = loadFromExcel('Preprints')\
+        .drop(columns=['Card End Date', 'Addressee', 'Informal addressee', 'Address Line 1', 'Done'])
+    preprints['Preprinted'] = True
+    return preprints
+
+
+@stage('end_dates', 'extant_accounts', 'card_renewal_dates', 'force_reprints', 'preprints')
+def process_end_dates(extant_accounts, card_renewal_dates, force_reprints, preprints):
+    print('processing end_dates')
+    end_dates = extant_accounts[['Membership Fee', 'Can Afford']].join(card_renewal_dates)
+    print('\tfiltering out accounts that aren\'t ready to renew, and creating issuances for the remaining')
+    end_date_filter = renewal_due(
+        end_dates['Renewal Date'],
+        end_dates['Can Afford'],
+        NOW,
+        month_end + offsets.MonthEnd() * advance_months,
+        advance_months > 0,
+        include_anticipatory)
+    end_dates = create_issuances(end_dates[end_date_filter])
+    print('\tadding forced reprints, letter dates and previous issuance')
+    if len(end_dates) != 0:
+        end_dates = concat([end_dates, force_reprints])
+        end_dates = end_dates\
+            .assign(**{
+                'Letter Date': end_dates['Card Issuance'].where(end_dates['Card Issuance'] > month_begin, month_begin),
+                'Previous Issuance': end_dates['Issuance Count'] > 0
+            })\
+            .reset_index(names='Membership Number')\
+            .set_index(['Membership Number', 'Letter Date'])\
+            .join(preprints.set_index(['Membership Number', 'Letter Date']))\
+            .reset_index()\
+            .sort_values(by=['Letter Date', 'Previous Issuance', 'Anticipatory', 'Membership Number'])\
+            .set_index('Membership Number')
+        end_dates['Preprinted'] = end_dates['Preprinted'].astype('boolean').fillna(False).astype(bool)
+    return end_dates
+
+
+@stage('used_preprints', 'preprints', 'end_dates', 'extant_accounts')
+def process_used_preprints(preprints, end_dates, extant_accounts):
+    return preprints.\
         set_index(['Membership Number', 'Letter Date'])\
         .join(
             end_dates
@@ -238,171 +224,214 @@ if len(end_dates) != 0:
         .join(extant_accounts[['Addressee', 'Address Line 1']])\
         .reset_index()
 
+
+@stage('new_issuances', 'end_dates')
+def process_new_issuances(end_dates):
     print('processing new_issuances')
-    new_issuances =\
-        end_dates\
+    return end_dates\
         .reset_index()[
             ['Membership Number', 'Processing Date', 'Card Issuance', 'Renewal Date', 'Card End Date', 'Membership Fee',
                 'Anticipatory']
         ]
 
+
+@stage('to_print', 'end_dates', 'extant_accounts', 'members')
+def process_to_print(end_dates, extant_accounts, members):
     print('processing to-print accounts')
-    to_print =\
-        end_dates[~end_dates['Preprinted']]\
+    return end_dates[~end_dates['Preprinted']]\
         .join(extant_accounts.drop(columns=['Membership Fee']))\
         .join(members[['Email', 'Telephone', 'Full Name', 'Count']])\
         .reset_index(names='Membership Number')
 
+
+@stage('lettered', 'to_print')
+def process_lettered(to_print):
     print('processing lettered accounts')
-    lettered =\
-        to_print[to_print['Count'] == 1][
+    return to_print[to_print['Count'] == 1][
             [
                 'Addressee', 'Informal Greeting', 'Address Line 1', 'Address Line 2', 'City', 'County', 'Post Code',
                 'Country', 'Membership Number', 'Telephone', 'Email', 'Letter Date', 'Previous Issuance', 'Anticipatory'
             ]
         ]
 
+
+@stage('new_letter_accounts', 'lettered')
+def process_new_letter_accounts(lettered):
     print('processing new_letter_accounts')
-    new_letter_accounts =\
-        lettered[~lettered['Previous Issuance']]\
+    return lettered[~lettered['Previous Issuance']]\
         .drop(columns=['Letter Date', 'Previous Issuance', 'Anticipatory'])
 
+
+@stage('renewal_letter_accounts', 'lettered')
+def process_renewal_letter_accounts(lettered):
     print('processing renewal_letter_accounts')
-    renewal_letter_accounts =\
-        lettered[lettered['Previous Issuance']]\
+    return lettered[lettered['Previous Issuance']]\
         .drop(columns='Previous Issuance')
 
-    letter_post_zones =\
-        new_issuances\
+
+@stage('letter_post_zones', 'new_issuances', 'extant_accounts')
+def process_letter_post_zones(new_issuances, extant_accounts):
+    return new_issuances\
         .set_index('Membership Number')\
         .join(extant_accounts.drop(columns='Membership Fee'))\
         .reset_index()[
             ['Post Zone']
         ]\
-        .groupby('Post Zone')\
-        .agg(**{
-            'Count': ('Post Zone', 'count'),
-            'Zone Order': ('Post Zone', zone_mapper)})\
-        .sort_values('Zone Order')[
-            ['Count']
-        ]
+        .groupby('Post Zone', observed=True)\
+        .agg(**{'Count': ('Post Zone', 'count')})\
+        .pipe(sort_by_zone)
 
+
+@stage('cards', 'to_print', 'properties', 'competitions')
+def process_cards(to_print, properties, competitions):
     print('processing cards')
-    cards =\
-        to_print\
+    return to_print\
         .join(properties['Address 1'], on='Property Code')\
         .sort_values(
             by=['Letter Date', 'Previous Issuance', 'Anticipatory', 'Membership Number', 'Count'])\
-        .apply(
-            create_card_row_creator(),
-            axis=1,
-            result_type='expand')
-
-    print('processing 10-up cards')
-    cards_10up = cards.copy(deep=False)
-    cards_10up[['n','c']] = [("{:04.0f}".format(math.floor(i/10)), i%10) for i in range(len(cards_10up))]
-    cards_10up = cards_10up\
-        .groupby('n')\
-        .apply(
-            lambda df:
-                df.apply(
-                    lambda r:
-                        {
-                            k + "{:0.0f}".format(r['c'] + 1): v
-                            for (k, v)
-                            in r.items()
-                            if not k in ['an', 'n', 'c', 'p']},
-                    axis=1,
-                    result_type='expand'))\
-        .groupby('n')\
-        .agg(
-            lambda s:
-                (
-                    [
-                        ("{:0.0f}".format(v) if isinstance(v, float) else v)
-                        for v
-                        in s
-                        if not isinstance(v, float)
-                            or not math.isnan(v)][:1]
-                    or [NaN])[0])\
-        .reset_index(names='n')
-    cards_10up.insert(1, 'p', 'p')
-
-    if write_output_files:
-        print(f'writing to Cards to Print {NOW.isoformat()}')
-        with ExcelWriter(f'Cards to Print {now_str}.xlsx') as writer:
-            new_letter_accounts.to_excel(writer, sheet_name='New Letter Accounts', index=False)
-            renewal_letter_accounts.to_excel(writer, sheet_name='Normal Letter Accounts', index=False)
-            new_issuances.to_excel(writer, sheet_name='New Issuances', index=False)
-            used_preprints.to_excel(writer, sheet_name='Preprints', index=False)
-            letter_post_zones.to_excel(writer, sheet_name='Post Zones')
-
-        print(f'writing card CSVs')
-        cards.to_csv(f'Cards {now_str}.csv', index=False)
-        cards_10up.to_csv(f'Cards_10up {now_str}.csv', index=False)
-
-current_accounts = accounts[
-        isnull(accounts['Cancelled'])
-    ].join(current_members_accounts, how='inner')
-current_accounts['Zone Order'] = current_accounts['Post Zone'].map(zone_mapper)
-
-offsite_accounts = current_accounts[current_accounts['Post Zone'] != 'Barbican']\
-    .reset_index(names='Membership Number')\
-    .sort_values(by=['Zone Order', 'Membership Number'])[
-        ['Addressee', 'Informal Greeting', 'Address Line 1', 'Address Line 2', 'City',
-         'County', 'Post Code', 'Country', 'Post Zone', 'Membership Number']]
-
-post_zones = current_accounts\
-    .reset_index()\
-    .groupby('Post Zone').agg(**{
-        'Count':('Post Zone', 'count'),
-        'Zone Order': ('Post Zone', zone_mapper)})\
-    .reset_index()\
-    .sort_values('Zone Order')[['Post Zone', 'Count']]
-
-print('processing all members details list')
+        .pipe(create_cards, competitions)
+
+
+def format_card_values(values: Series) -> Series:
+    # floats are written without decimals, and an int, shown the same, is left as it is
+    if values.dtype.kind == 'f':
+        return values.map('{:0.0f}'.format, na_action='ignore')
+    if values.dtype == object:
+        return values.map(lambda v: '{:0.0f}'.format(v) if isinstance(v, float) else v, na_action='ignore')
+    return values
+
+
+def lay_out_cards(cards: DataFrame, per_sheet: int = None) -> DataFrame:
+    # a row for each sheet of card stock, with each field of the card in slot k as a column named field + k
+    per_sheet = per_sheet or cards_per_sheet
+    fields = [column for column in cards.columns if column not in ['an', 'n', 'p']]
+    sheets = -(-len(cards) // per_sheet)
+    slots = min(per_sheet, len(cards))
+    padded = {
+        field: format_card_values(cards[field]).astype(object).reset_index(drop=True)
+            .reindex(range(sheets * per_sheet)).to_numpy().reshape(sheets, per_sheet)
+        for field in fields}
+    cards_n_up = DataFrame(
+        {f'{field}{slot + 1}': padded[field][:, slot] for slot in range(slots) for field in fields},
+        index=range(sheets))
+    cards_n_up.insert(0, 'n', [f'{sheet:04}' for sheet in range(sheets)])
+    cards_n_up.insert(1, 'p', 'p')
+    return cards_n_up
+
+
+@stage('card_sheets', 'cards')
+def process_card_sheets(cards):
+    print(f'processing {cards_per_sheet}-up cards')
+    return lay_out_cards(cards)
+
+
+@stage('current_accounts', 'accounts', 'current_members_accounts')
+def process_current_accounts(accounts, current_members_accounts):
+    current_accounts = accounts[
+            isnull(accounts['Cancelled'])
+        ].join(current_members_accounts, how='inner')
+    current_accounts['Zone Order'] = fee_schedule.zone_orders(current_accounts['Post Zone'])
+    return current_accounts
+
+
+@stage('offsite_accounts', 'current_accounts')
+def process_offsite_accounts(current_accounts):
+    return current_accounts[current_accounts['Post Zone'] != 'Barbican']\
+        .reset_index(names='Membership Number')\
+        .sort_values(by=['Zone Order', 'Membership Number'])[
+            ['Addressee', 'Informal Greeting', 'Address Line 1', 'Address Line 2', 'City',
+             'County', 'Post Code', 'Country', 'Post Zone', 'Membership Number']]
+
+
+@stage('post_zones', 'current_accounts')
+def process_post_zones(current_accounts):
+    return current_accounts\
+        .reset_index()\
+        .groupby('Post Zone', observed=True).agg(**{'Count': ('Post Zone', 'count')})\
+        .pipe(sort_by_zone)\
+        .reset_index()[['Post Zone', 'Count']]
+
+
 address_columns = ['Address Line 1', 'Address Line 2', 'City', 'County', 'Post Code', 'Country']
-current_member_details =\
-    accounts[isnull(accounts['Cancelled']) & accounts['Current Member']]\
-        .apply(lambda row: {
-            'Correspondence ' + key if key in address_columns else key:
-                NaN if key in address_columns and not row['Offsite'] else value
-            for (key, value)
-            in row.items()
-        }, axis=1, result_type='expand')\
-        .join(members)\
-        .reset_index('Membership Number')\
-        .set_index('Property Code')\
-        .join(
-            properties
-                .apply(
-                    lambda row: {
-                        'Flat Address Line 1': row['Address 1'],
-                        'Flat Address Line 2': row['Address 2'],
-                        'Flat City': 'London',
-                        'Flat Post Code': row['Post Code']},
-                    axis=1,
-                    result_type='expand'),
-            how='inner')\
-        .reset_index('Property Code')\
-        .sort_values(
-            ['Surname', 'First name', 'Middlename', 'Property Code'],
-            key=lambda col: [locale.strxfrm(x.lower()) if isinstance(x, str) else x for x in col]
-        )[['Title', 'First name', 'Middlename', 'Surname', 'Email', 'Telephone',
-            'Flat Address Line 1', 'Flat Address Line 2', 'Flat City',
-            'Flat Post Code',
-            'Correspondence Address Line 1', 'Correspondence Address Line 2',
-            'Correspondence City', 'Correspondence County',
-            'Correspondence Post Code', 'Correspondence Country']]
-
-if write_output_files:
-    write_mailchimp_members()
-    write_member_financials()
 
+
+@stage('current_member_details', 'accounts', 'members', 'properties')
+def process_current_member_details(accounts, members, properties):
+    print('processing all members details list')
+    return accounts[isnull(accounts['Cancelled']) & accounts['Current Member']]\
+            .apply(lambda row: {
+                'Correspondence ' + key if key in address_columns else key:
+                    NaN if key in address_columns and not row['Offsite'] else value
+                for (key, value)
+                in row.items()
+            }, axis=1, result_type='expand')\
+            .join(members)\
+            .reset_index(names='Membership Number')\
+            .set_index('Property Code')\
+            .join(
+                properties
+                    .apply(
+                        lambda row: {
+                            'Flat Address Line 1': row['Address 1'],
+                            'Flat Address Line 2': row['Address 2'],
+                            'Flat City': 'London',
+                            'Flat Post Code': row['Post Code']},
+                        axis=1,
+                        result_type='expand'),
+                how='inner')\
+            .reset_index('Property Code')\
+            .pipe(sort_collated, ['Surname', 'First name', 'Middlename', 'Property Code'])[['Title', 'First name', 'Middlename', 'Surname', 'Email', 'Telephone',
+                'Flat Address Line 1', 'Flat Address Line 2', 'Flat City',
+                'Flat Post Code',
+                'Correspondence Address Line 1', 'Correspondence Address Line 2',
+                'Correspondence City', 'Correspondence County',
+                'Correspondence Post Code', 'Correspondence Country']]
+
+
+def write_cards_to_print():
+    if len(compute('end_dates')) == 0:
+        print('no cards to print')
+        return
+    print(f'writing to Cards to Print {NOW.isoformat()}')
+    submit_output(excel_output, f'Cards to Print {now_str}.xlsx', [
+        ('New Letter Accounts', compute('new_letter_accounts'), False),
+        ('Normal Letter Accounts', compute('renewal_letter_accounts'), False),
+        ('New Issuances', compute('new_issuances'), False),
+        ('Preprints', compute('used_preprints'), False),
+        ('Post Zones', compute('letter_post_zones'), True)])
+
+
+def write_card_csvs():
+    if len(compute('end_dates')) == 0:
+        return
+    cards, card_sheets = compute('cards'), compute('card_sheets')
+    print('writing card CSVs')
+    submit_output(csv_output, f'Cards {now_str}.csv', cards)
+    submit_output(csv_output, f'Cards_{cards_per_sheet}up {now_str}.csv', card_sheets)
+
+
+def write_addresses():
+    offsite_accounts, post_zones = compute('offsite_accounts'), compute('post_zones')
     print(f'writing to Addresses {NOW.isoformat()}')
-    with ExcelWriter(f'Addresses {now_str}.xlsx') as writer:
-        offsite_accounts.to_excel(writer, sheet_name='Offsite Members', index=False)
-        post_zones.to_excel(writer, sheet_name='Post Zones', index=False)
+    submit_output(excel_output, f'Addresses {now_str}.xlsx', [
+        ('Offsite Members', offsite_accounts, False),
+        ('Post Zones', post_zones, False)])
+
 
+def write_current_members():
+    current_member_details = compute('current_member_details')
     print(f'Writing to all members list: current_members-{now_str}.csv')
-    current_member_details.to_csv(f'current_members-{now_str}.csv', index=False)
+    submit_output(csv_output, f'current_members-{now_str}.csv', current_member_details)
+
+
+__getattr__ = lazy_attributes(__name__)
+
+
+if __name__ == '__main__':
+    with OutputRun():
+        write_cards_to_print()
+        write_card_csvs()
+        write_mailchimp_members()
+        write_member_financials()
+        write_addresses()
+        write_current_members()
@@ -0,0 +1,56 @@
+import locale
+
+import numpy as np
+import pandas as pd
+
+
+class CollationKeys:
+    """Locale collation keys of lower-cased text, worked out once for each distinct value.
+
+    The user's collation locale is set only while new keys are worked out, and restored after.
+    """
+
+    def __init__(self):
+        self._locale = None
+        self._keys = {}
+
+    @property
+    def locale_name(self) -> str:
+        if self._locale is None:
+            previous = locale.setlocale(locale.LC_COLLATE)
+            try:
+                self._locale = locale.setlocale(locale.LC_COLLATE, '')
+            finally:
+                locale.setlocale(locale.LC_COLLATE, previous)
+        return self._locale
+
+    def _add(self, texts: list[str]):
+        previous = locale.setlocale(locale.LC_COLLATE)
+        try:
+            locale.setlocale(locale.LC_COLLATE, self.locale_name)
+            self._keys.update((text, locale.strxfrm(text.lower())) for text in texts)
+        finally:
+            locale.setlocale(locale.LC_COLLATE, previous)
+
+    def ranks(self, values: pd.Series) -> pd.Series:
+        # the rank of each value's key among the distinct values, equal keys ranking equal and missing values last;
+        # anything other than text is its own key
+        codes, distinct = pd.factorize(values)
+        keys = self._keys
+        new_texts = [value for value in distinct if isinstance(value, str) and value not in keys]
+        if new_texts:
+            self._add(new_texts)
+        key_ranks, sorted_keys = pd.factorize(
+            np.array([keys[value] if isinstance(value, str) else value for value in distinct], dtype=object), sort=True)
+        return pd.Series(np.append(key_ranks, len(sorted_keys))[codes], index=values.index)
+
+
+collation_keys = CollationKeys()
+
+
+def sort_collated(df: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    # df sorted on the columns in locale order, ignoring case, by way of rank columns added and dropped again
+    key_columns = [f'{column} Collation Key' for column in columns]
+    keyed = df.assign(**{key_column: collation_keys.ranks(df[column])
+                         for column, key_column in zip(columns, key_columns)})
+    return keyed.sort_values(key_columns).drop(columns=key_columns)
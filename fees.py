@@ -0,0 +1,109 @@
+import datetime
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils import env_setting, files_dir
+
+
+fee_schedule_file = env_setting('BA_FEE_SCHEDULE', os.path.join(files_dir, 'Fee Schedule.json'))
+
+# every Post Zone in the order they are listed and posted, and the postal zone their letters are batched under
+post_zones = pd.DataFrame({
+    'Post Zone': ['Zone 3', 'Zone 2', 'Zone 1', 'Europe', 'UK', 'Barbican'],
+    'Postal Zone': ['International', 'International', 'International', 'EU', 'UK', 'UK'],
+})
+associate_postal_zone = 'UK'
+other_postal_zone = 'International'
+
+# fees by the year they are first charged in, each applying until a later year's; the earliest also applies to
+# every year before it. 'Associate' and 'Other' are required, and Post Zones not listed are charged 'Other'.
+# The fees charged until a schedule file says otherwise:
+type Fees = dict[str, int]
+default_fee_schedule: dict[int, Fees] = {
+    datetime.MINYEAR: {'Associate': 10, 'Barbican': 5, 'UK': 8, 'Europe': 11, 'Other': 14},
+}
+
+
+class FeeSchedule:
+    """The fee of each account and the postal zone of each fee charged, by year, as lookup tables over whole columns.
+
+    Post Zones are looked up by their position in post_zones, one column past the end standing for any other zone,
+    and fees by their position among every fee in the schedule, so each answer is a single indexing of a table with
+    a row per year.
+    """
+
+    def __init__(self, schedule: dict[int, Fees]):
+        self.zones = pd.Index(post_zones['Post Zone'])
+        self.years = np.array(sorted(schedule))
+        yearly_fees = [schedule[year] for year in self.years]
+        for fees in yearly_fees:
+            missing = {'Associate', 'Other'} - set(fees)
+            if missing:
+                raise ValueError(f'Fee schedule has no {" or ".join(sorted(missing))} fee')
+            self.zone_orders([zone for zone in fees if zone not in ('Associate', 'Other')])
+
+        self.associate_fees = np.array([fees['Associate'] for fees in yearly_fees])
+        self.zone_fee_table = np.array(
+            [[fees.get(zone, fees['Other']) for zone in self.zones] + [fees['Other']] for fees in yearly_fees])
+
+        # 0 is charged for reprints, which are not posted in a batch
+        self.postal_zone_names = pd.Index(
+            [*pd.unique(post_zones['Postal Zone']), associate_postal_zone, other_postal_zone, None]).unique()
+        self.fees = pd.Index(np.unique([0, *self.zone_fee_table.ravel(), *self.associate_fees]))
+        associate_code, none_code = self.postal_zone_names.get_indexer([associate_postal_zone, None])
+        zone_codes = self.postal_zone_names.get_indexer([*post_zones['Postal Zone'], other_postal_zone])
+        self.fee_zone_table = np.full((len(self.years), len(self.fees)), -1)
+        for row, fees in enumerate(self.zone_fee_table):
+            for fee, code in [(0, none_code), (self.associate_fees[row], associate_code), *zip(fees, zone_codes)]:
+                column = self.fees.get_loc(fee)
+                if self.fee_zone_table[row, column] not in (-1, code):
+                    raise ValueError(f'Fee {fee} in {self.years[row]} is charged for more than one postal zone')
+                self.fee_zone_table[row, column] = code
+
+    @classmethod
+    def load(cls, path: str = fee_schedule_file) -> 'FeeSchedule':
+        # the schedule in the file, years as its keys, or the default schedule where there is no file
+        try:
+            with open(path) as f:
+                schedule = json.load(f)
+        except FileNotFoundError:
+            return cls(default_fee_schedule)
+        return cls({int(year): fees for year, fees in schedule.items()})
+
+    def _year_rows(self, dates) -> np.ndarray:
+        years = pd.DatetimeIndex(np.atleast_1d(dates)).year.to_numpy()
+        return np.maximum(np.searchsorted(self.years, years, side='right') - 1, 0)
+
+    def associate_fee(self, date) -> int:
+        return int(self.associate_fees[self._year_rows(date)[0]])
+
+    def zone_fees(self, zones, date) -> np.ndarray:
+        # the fee charged in the year of the date for an account in each zone; unknown and missing zones are 'Other'
+        codes = self.zones.get_indexer(zones)
+        codes[codes < 0] = len(self.zones)
+        return self.zone_fee_table[self._year_rows(date)[0], codes]
+
+    def zone_orders(self, zones) -> np.ndarray:
+        # the position of each zone in post_zones, for sorting; any zone not there is rejected, all at once
+        codes = self.zones.get_indexer(zones)
+        unknown = codes < 0
+        if unknown.any():
+            raise ValueError(f'No such zone {", ".join(sorted(map(str, pd.unique(np.asarray(zones)[unknown]))))}')
+        return codes
+
+    def postal_zones(self, fees, dates) -> np.ndarray:
+        # the postal zone of each fee, as charged in the year of its date; a fee never charged that year is a KeyError
+        fees = np.asarray(fees)
+        rows = np.broadcast_to(self._year_rows(dates), fees.shape)
+        codes = self.fees.get_indexer(fees)
+        codes = np.where(codes >= 0, self.fee_zone_table[rows, codes], -1)
+        unknown = codes < 0
+        if unknown.any():
+            raise KeyError(fees[unknown].min())
+        return self.postal_zone_names.to_numpy()[codes]
+
+
+fee_schedule = FeeSchedule.load()
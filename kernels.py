@@ -0,0 +1,119 @@
+import numpy as np
+
+from utils import env_setting
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+kernel_backends = ['pandas', *(['numexpr'] if numexpr is not None else []), *(['numba'] if numba is not None else [])]
+kernel_backend = env_setting('BA_KERNELS', kernel_backends[-1]).lower()
+if kernel_backend not in kernel_backends:
+    print(f'Kernel backend {kernel_backend} is not available, using pandas')
+    kernel_backend = 'pandas'
+
+
+def jit(function):
+    return numba.njit(cache=True, nogil=True)(function) if numba is not None else None
+
+
+def datetimes_as_int64(values) -> np.ndarray:
+    # NaT becomes the smallest int64, which sorts before every real date
+    return np.asarray(values, dtype='datetime64[ns]').view(np.int64)
+
+
+@jit
+def _affordability_numba(associate, zone_fees, balances, associate_fee):
+    fees = np.empty(len(associate), dtype=np.int64)
+    can_afford = np.empty(len(associate), dtype=np.bool_)
+    for i in range(len(associate)):
+        fees[i] = associate_fee if associate[i] else zone_fees[i]
+        # a missing balance compares false, so cannot afford
+        can_afford[i] = balances[i] >= fees[i]
+    return fees, can_afford
+
+
+def affordability(associate: np.ndarray, zone_fees: np.ndarray, balances: np.ndarray, associate_fee: int,
+                  backend: str = None) -> tuple[np.ndarray, np.ndarray]:
+    associate = np.asarray(associate, dtype=bool)
+    zone_fees = np.asarray(zone_fees, dtype=np.int64)
+    balances = np.asarray(balances, dtype=np.float64)
+    match backend or kernel_backend:
+        case 'numba':
+            return _affordability_numba(associate, zone_fees, balances, associate_fee)
+        case 'numexpr':
+            fees = numexpr.evaluate('where(associate, associate_fee, zone_fees)')
+            return fees, numexpr.evaluate('balances >= fees')
+        case _:
+            fees = np.where(associate, associate_fee, zone_fees)
+            return fees, balances >= fees
+
+
+@jit
+def _renewal_due_numba(renewal_dates, can_afford, now, horizon, nat, advance, include_anticipatory):
+    due = np.empty(len(renewal_dates), dtype=np.bool_)
+    for i in range(len(renewal_dates)):
+        renewal_date = renewal_dates[i]
+        due[i] = renewal_date == nat or now >= renewal_date or (advance and now <= renewal_date < horizon)
+        if not include_anticipatory:
+            due[i] = due[i] and can_afford[i]
+    return due
+
+
+def renewal_due(renewal_dates, can_afford: np.ndarray, now, horizon, advance: bool, include_anticipatory: bool,
+                backend: str = None) -> np.ndarray:
+    renewal_dates = datetimes_as_int64(renewal_dates)
+    can_afford = np.asarray(can_afford, dtype=bool)
+    now, horizon = datetimes_as_int64(now).item(), datetimes_as_int64(horizon).item()
+    nat = np.iinfo(np.int64).min
+    match backend or kernel_backend:
+        case 'numba':
+            return _renewal_due_numba(renewal_dates, can_afford, now, horizon, nat, advance, include_anticipatory)
+        case 'numexpr':
+            due = numexpr.evaluate(
+                '(renewal_dates == nat) | (now >= renewal_dates) | (advance & (now <= renewal_dates) & (renewal_dates < horizon))')
+            return due if include_anticipatory else numexpr.evaluate('due & can_afford')
+        case _:
+            due = (renewal_dates == nat) | (now >= renewal_dates)
+            if advance:
+                due |= (now <= renewal_dates) & (renewal_dates < horizon)
+            return due if include_anticipatory else due & can_afford
+
+
+@jit
+def _preprint_split_numba(preprinted, members):
+    letters = np.empty(len(preprinted), dtype=np.int64)
+    cards = np.empty_like(members)
+    preprinted_letters = np.empty(len(preprinted), dtype=np.int64)
+    preprinted_cards = np.empty_like(members)
+    for i in range(len(preprinted)):
+        if preprinted[i]:
+            letters[i], cards[i], preprinted_letters[i], preprinted_cards[i] = 0, 0, 1, members[i]
+        else:
+            letters[i], cards[i], preprinted_letters[i], preprinted_cards[i] = 1, members[i], 0, 0
+    return letters, cards, preprinted_letters, preprinted_cards
+
+
+def preprint_split(preprinted: np.ndarray, members: np.ndarray,
+                   backend: str = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # letters and cards of each issuance, split between those to post and those already preprinted
+    preprinted = np.asarray(preprinted, dtype=bool)
+    members = np.asarray(members)
+    match backend or kernel_backend:
+        case 'numba':
+            return _preprint_split_numba(preprinted, members)
+        case 'numexpr':
+            return (numexpr.evaluate('where(preprinted, 0, 1)').astype(np.int64),
+                    numexpr.evaluate('where(preprinted, 0, members)').astype(members.dtype),
+                    numexpr.evaluate('where(preprinted, 1, 0)').astype(np.int64),
+                    numexpr.evaluate('where(preprinted, members, 0)').astype(members.dtype))
+        case _:
+            return ((~preprinted).astype(np.int64), np.where(preprinted, 0, members),
+                    preprinted.astype(np.int64), np.where(preprinted, members, 0))
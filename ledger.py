@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from cache import read_frame, source_is_current, source_stamp, write_frame, write_json_atomic
+from kernels import datetimes_as_int64
+from utils import Sheet, cache_dir, env_flag, env_setting, load_sheets, workbook_path
+
+
+ledger_dir = env_setting('BA_LEDGER_DIR', os.path.join(cache_dir, 'ledger'))
+ledger_enabled = env_flag('BA_LEDGER')
+
+# bookkeeping columns kept alongside each payment row
+row_columns = ['Row Key', 'Source', 'Position', 'Pence']
+
+
+def row_keys(payments: pd.DataFrame) -> np.ndarray:
+    # the row's contents, plus how many identical rows came before it, so a repeated payment is kept twice;
+    # numbers hash as floats, as a whole-pound column turns to float once a payment in pence is added
+    content = pd.util.hash_pandas_object(payments.astype({
+        column: float for column, dtype in payments.dtypes.items()
+        if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)}), index=False)
+    occurrence = content.groupby(content.to_numpy()).cumcount()
+    return pd.util.hash_pandas_object(
+        pd.DataFrame({'Content': content.to_numpy(), 'Occurrence': occurrence.to_numpy()}), index=False).to_numpy()
+
+
+def to_pence(amounts: pd.Series) -> np.ndarray:
+    return np.rint(amounts.fillna(0).to_numpy(dtype=float) * 100).astype(np.int64)
+
+
+def history_from(payments: list[pd.DataFrame]) -> pd.DataFrame:
+    return pd.concat([df.set_index(['Membership ID', 'Date']) for df in payments]).sort_index()
+
+
+def balances_from(payment_history: pd.DataFrame) -> pd.DataFrame:
+    return payment_history\
+        .reset_index(names=['Membership ID', 'Date'])\
+        .groupby('Membership ID')\
+        .agg(Balance=('Amount', 'sum'))
+
+
+class RunningBalances:
+    """Each member's balance after every payment, for looking up balances as of any date.
+
+    Payments are held sorted on member and date with a running total in pence that restarts at each member. A
+    member's balance on a date is the total at their last payment on or before it, found for many members and dates
+    at once by a binary search over keys that pack the member and the rank of the date into one integer.
+    """
+
+    def __init__(self, payment_history: pd.DataFrame):
+        members = payment_history.index.get_level_values('Membership ID').to_numpy()
+        dates = datetimes_as_int64(payment_history.index.get_level_values('Date'))
+        order = np.lexsort((dates, members))
+        members, dates = members[order], dates[order]
+        pence = to_pence(payment_history['Amount'])[order]
+
+        starts = np.flatnonzero(np.r_[True, members[1:] != members[:-1]]) if len(members) else np.array([], int)
+        counts = np.diff(np.r_[starts, len(members)])
+        totals = np.cumsum(pence)
+        # take off the running total at the end of the previous member
+        totals -= np.repeat(np.r_[0, totals[starts[1:] - 1]], counts) if len(starts) else 0
+        self.members = members[starts]
+        self.member_codes = np.repeat(np.arange(len(starts)), counts)
+        self.unique_dates = np.unique(dates)
+        self.keys = self._keys(self.member_codes, dates)
+        self.totals = totals
+
+    def _keys(self, member_codes: np.ndarray, dates: np.ndarray) -> np.ndarray:
+        # dates ranked among the payment dates, counting those on or before each, so they pack with the member
+        ranks = np.searchsorted(self.unique_dates, dates, side='right')
+        return member_codes.astype(np.int64) * (len(self.unique_dates) + 1) + ranks
+
+    def as_of(self, members, dates) -> np.ndarray:
+        # NaN for members with no payments on or before the date; dates may be a single date for every member
+        members = np.asarray(members)
+        dates = np.broadcast_to(datetimes_as_int64(dates), members.shape)
+        # searched in member order, which keeps the binary searches in cache
+        order = np.argsort(members, kind='stable')
+        members, dates = members[order], dates[order]
+        codes = np.searchsorted(self.members, members)
+        found = codes < len(self.members)
+        found[found] = self.members[codes[found]] == members[found]
+        positions = np.searchsorted(self.keys, self._keys(codes, dates), side='right') - 1
+        found &= positions >= 0
+        found[found] = self.member_codes[positions[found]] == codes[found]
+        balances = np.full(members.shape, np.nan)
+        balances[order[found]] = self.totals[positions[found]] / 100
+        return balances
+
+    def balances_as_of(self, date) -> pd.DataFrame:
+        return pd.DataFrame(
+                {'Balance': self.as_of(self.members, date)},
+                index=pd.Index(self.members, name='Membership ID'))\
+            .dropna()
+
+
+class PaymentLedger:
+    """Every row of the payment workbooks, with each member's balance kept in whole pence.
+
+    An update reads only the workbooks that changed since the last one. Their rows are matched to the ledger on a
+    key made from the row's contents: rows not seen before are added, rows no longer there are removed, and the
+    balances of the members concerned are adjusted by the difference.
+    """
+
+    def __init__(self, directory: str, sources: list[Sheet]):
+        self.directory = directory
+        self.sources = sources
+        self.manifest_file = os.path.join(directory, 'manifest.json')
+        self._manifest = None
+        self._rows = None
+        self._balances = None
+
+    @property
+    def manifest(self) -> dict:
+        if self._manifest is None:
+            try:
+                with open(self.manifest_file) as f:
+                    self._manifest = json.load(f)
+            except (OSError, ValueError):
+                self._manifest = {}
+        return self._manifest
+
+    def _base_file(self, name: str, generation: int) -> str:
+        return os.path.join(self.directory, f'{name}-{generation}')
+
+    def _load(self):
+        if self._rows is None:
+            if 'rows_format' in self.manifest and 'generation' in self.manifest:
+                generation = self.manifest['generation']
+                self._rows = read_frame(self._base_file('rows', generation), self.manifest['rows_format'])
+                self._balances = read_frame(self._base_file('balances', generation), self.manifest['balances_format'])
+            else:
+                # sources stamped without rows to go with them are read again, into a generation of their own
+                self._manifest = {key: self.manifest[key] for key in ['generation'] if key in self.manifest}
+                self._rows = pd.DataFrame(columns=row_columns)
+                self._balances = None
+
+    def _save(self):
+        # rows and balances are written under a new generation, which only replacing the manifest makes current,
+        # so a save cut short leaves the ledger as it was
+        os.makedirs(self.directory, exist_ok=True)
+        previous = self.manifest.get('generation')
+        generation = previous + 1 if previous is not None else 0
+        self.manifest['rows_format'] = write_frame(self._rows, self._base_file('rows', generation))
+        self.manifest['balances_format'] = write_frame(self._balances, self._base_file('balances', generation))
+        self.manifest['generation'] = generation
+        write_json_atomic(self.manifest_file, self.manifest, indent=1)
+        for name in ['rows', 'balances'] if previous is not None else []:
+            for data_format in ['parquet', 'pickle']:
+                if os.path.exists(f'{self._base_file(name, previous)}.{data_format}'):
+                    os.remove(f'{self._base_file(name, previous)}.{data_format}')
+
+    def _is_current(self, source: Sheet) -> bool:
+        return source_is_current(self.manifest.get('sources', {}).get(source.workbook), workbook_path(source.workbook))
+
+    def _adjust_balances(self, rows: pd.DataFrame, sign: int):
+        if len(rows) == 0:
+            return
+        change = rows.groupby('Membership ID').agg(Pence=('Pence', 'sum'), Rows=('Pence', 'size')) * sign
+        if self._balances is not None and len(self._balances):
+            change = self._balances.add(change, fill_value=0).astype(np.int64)
+        self._balances = change[change['Rows'] > 0]
+
+    def update(self) -> int:
+        self._load()
+        changed = [source for source in self.sources if not self._is_current(source)]
+        if not changed:
+            return 0
+        print(f'updating the payment ledger from {", ".join(source.workbook for source in changed)}')
+        added_count, removed_count = 0, 0
+        for source, payments in zip(changed, load_sheets(changed)):
+            payments = payments.assign(**{
+                'Row Key': row_keys(payments),
+                'Source': source.workbook,
+                'Position': np.arange(len(payments)),
+                'Pence': to_pence(payments['Amount'])})
+            in_source = self._rows['Source'] == source.workbook
+            previous = self._rows[in_source]
+            removed = previous[~previous['Row Key'].isin(payments['Row Key'])]
+            added = payments[~payments['Row Key'].isin(previous['Row Key'])]
+            self._adjust_balances(removed, -1)
+            self._adjust_balances(added, 1)
+            # rows already held keep their entry, but may have moved within the sheet
+            kept = self._rows[~in_source]
+            self._rows = pd.concat([kept, payments], ignore_index=True) if len(kept) else payments
+            added_count, removed_count = added_count + len(added), removed_count + len(removed)
+
+            self.manifest.setdefault('sources', {})[source.workbook] = {
+                **source_stamp(workbook_path(source.workbook)),
+                'columns': [column for column in payments.columns if column not in row_columns],
+            }
+        if self._balances is None:
+            self._balances = pd.DataFrame({'Pence': [], 'Rows': []}, dtype=np.int64).rename_axis('Membership ID')
+        self._balances = self._balances.sort_index()
+        self._save()
+        print(f'\tadded {added_count} payments, removed {removed_count}')
+        return added_count + removed_count
+
+    def payment_history(self) -> pd.DataFrame:
+        self._load()
+        # the column order and row order of concatenating the sources in turn and sorting on member and date
+        columns = list(dict.fromkeys(
+            column for source in self.sources for column in self.manifest['sources'][source.workbook]['columns']))
+        rank = {source.workbook: i for i, source in enumerate(self.sources)}
+        return self._rows\
+            .assign(Rank=self._rows['Source'].map(rank))\
+            .sort_values(['Membership ID', 'Date', 'Rank', 'Position'], kind='stable')[columns]\
+            .set_index(['Membership ID', 'Date'])
+
+    def balances(self) -> pd.DataFrame:
+        self._load()
+        return (self._balances[['Pence']] / 100).rename(columns={'Pence': 'Balance'})
+
+    def rebuild(self):
+        self._manifest = {key: self.manifest[key] for key in ['generation'] if key in self.manifest}
+        self._rows, self._balances = None, None
+        self.update()
+
+    def verify(self) -> bool:
+        # the ledger against payment history and balances computed afresh from every workbook
+        self.update()
+        payment_history = history_from(load_sheets(self.sources))
+        balances = balances_from(payment_history)
+        history_matches = self.payment_history().equals(payment_history)
+        # the ledger adds whole pence, so it can differ from a float sum in the last place
+        balance_matches = self.balances().index.equals(balances.index) and np.allclose(
+            self.balances()['Balance'], balances['Balance'], rtol=0, atol=1e-6)
+        print(f'payment history {"matches" if history_matches else "DIFFERS"}, '
+              f'balances {"match" if balance_matches else "DIFFER"}')
+        return history_matches and balance_matches
+
+
+if __name__ == '__main__':
+    from member_financials import payment_sources
+
+    parser = argparse.ArgumentParser(description='Bring the payment ledger up to date with the payment workbooks.')
+    parser.add_argument('--rebuild', action='store_true', help='discard the ledger and rebuild it from every workbook')
+    parser.add_argument('--verify', action='store_true',
+                        help='check the ledger against payment history and balances computed from every workbook')
+    args = parser.parse_args()
+
+    payment_ledger = PaymentLedger(ledger_dir, payment_sources)
+    if args.rebuild:
+        payment_ledger.rebuild()
+    else:
+        payment_ledger.update()
+    if args.verify and not payment_ledger.verify():
+        raise SystemExit(1)
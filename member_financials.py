@@ -1,42 +1,53 @@
-import os
-
-from dotenv import find_dotenv, load_dotenv
-from pandas import DataFrame, ExcelWriter, Timestamp, concat, notna, offsets
+from pandas import DataFrame, ExcelWriter, Timestamp, notna, offsets
 from xlsxwriter import Workbook
 
-from utils import loadFromExcel
-
-
-def payments(file_name: str) -> DataFrame:
-    dir_name = os.getenv('BA_FILES_DIR', '')
-    return loadFromExcel(file_name, 'Payments').set_index(['Membership ID', 'Date'])
+from ledger import PaymentLedger, RunningBalances, balances_from, history_from, ledger_dir, ledger_enabled
+from pipeline import compute, lazy_attributes, stage
+from schema import compact
+from statement_store import statement_store, statements_sheet
+from utils import Sheet, load_sheets, loadFromExcel
+from writers import OutputRun, excel_output, submit_output
 
 
 def write_member_financials():
+    balances, payment_history = compute('balances'), compute('payment_history')
     now = Timestamp.today()
     print(f'writing to Member Financials {now.isoformat()}')
-    with ExcelWriter('Member Financials ' + now.isoformat().replace(':', '-') + '.xlsx') as writer:
-        balances.to_excel(writer, sheet_name='Balances')
-        payment_history.to_excel(writer, sheet_name='Payment History')
+    submit_output(excel_output, 'Member Financials ' + now.isoformat().replace(':', '-') + '.xlsx', [
+        ('Balances', balances, True),
+        ('Payment History', payment_history, True)])
+
+
+def load_statement_month(month_start: Timestamp, month_end: Timestamp) -> DataFrame:
+    # rows labelled in the order of the statement sheet, from the month's partition when the store is on
+    if statement_store is not None:
+        statement_store.ingest()
+        return statement_store.month(month_start.to_period('M'))
+    statement_history = loadFromExcel(*statements_sheet)
+    return statement_history[
+        (statement_history['Transaction Date'] >= month_start) &
+        (statement_history['Transaction Date'] < month_end)]
 
 
 def write_previous_month_payments():
     last_month_end = Timestamp.today().normalize() - offsets.MonthBegin()
     last_month_start = last_month_end - offsets.MonthBegin()
-    statement_history = loadFromExcel('Statements', 'Statements 30-91-79 27933660')
-    statement_history = statement_history[
-            (statement_history['Transaction Date'] >= last_month_start) &
-            (statement_history['Transaction Date'] < last_month_end)]\
+    statement_history = load_statement_month(last_month_start, last_month_end)\
         .sort_index(ascending=False)
     statement_history['Amount'] = statement_history['Credit Amount'].fillna(0) - statement_history[
         'Debit Amount'].fillna(0)
     statement_history = statement_history[
             ['Transaction Date', 'Transaction Description', 'Amount']
         ]
-    (max_row, max_col) = statement_history.shape
     payments_filename = f'Payments {last_month_start.month_name()} {last_month_end.year}.xlsx'
     print(f'Writing {payments_filename}')
-    with ExcelWriter(payments_filename, engine='xlsxwriter', datetime_format='d mmmm yyyy') as writer:
+    submit_output(payments_output, payments_filename, statement_history)
+
+
+def payments_output(path: str, statement_history: DataFrame) -> dict[str, int]:
+    (max_row, max_col) = statement_history.shape
+    # a month of payments, written whole, as the Output_for_Tony table cannot be added in constant_memory mode
+    with ExcelWriter(path, engine='xlsxwriter', datetime_format='d mmmm yyyy') as writer:
         statement_history.to_excel(
             writer, sheet_name='Payments', index=False, header=False, startrow=1)
         payments_sheet = writer.sheets['Payments']
@@ -48,19 +59,47 @@ def write_previous_month_payments():
         payments_sheet.set_column(0,0, 14)
         payments_sheet.set_column(1,1, 85)
         payments_sheet.set_column(2,2, 7)
+    return {'Payments': max_row}
 
 
 file_names = ['Card Issuances', 'Cheques', 'Gifts', 'PayPal', 'Statements']
+payment_sources = [Sheet(file_name, 'Payments') for file_name in file_names]
+payment_ledger = PaymentLedger(ledger_dir, payment_sources) if ledger_enabled else None
+
+
+# with the ledger on, only workbooks that changed are read, by the ledger itself
+@stage('payment_history', sources=payment_sources if payment_ledger is None else [])
+def process_payment_history():
+    print('processing payment history')
+    if payment_ledger is not None:
+        payment_ledger.update()
+        return compact('payment_history', payment_ledger.payment_history())
+    return compact('payment_history', history_from(load_sheets(payment_sources)))
+
+
+@stage('balances', 'payment_history')
+def process_balances(payment_history):
+    print('processing balances')
+    if payment_ledger is not None:
+        return payment_ledger.balances()
+    return balances_from(payment_history)
+
+
+@stage('running_balances', 'payment_history')
+def process_running_balances(payment_history):
+    print('processing running balances')
+    return RunningBalances(payment_history)
+
+
+def balances_as_of(date) -> DataFrame:
+    # as the balances stage, counting only payments made on or before the date
+    return compute('running_balances').balances_as_of(Timestamp(date))
+
 
-print('processing payment history')
-payment_history = concat([payments(file_name) for file_name in file_names]).sort_index()
+__getattr__ = lazy_attributes(__name__)
 
-print('processing balances')
-balances = payment_history\
-    .reset_index(names=['Membership ID', 'Date'])\
-    .groupby('Membership ID')\
-    .agg(Balance=('Amount', 'sum'))
 
 if __name__ == '__main__':
-    write_member_financials()
-    write_previous_month_payments()
+    with OutputRun():
+        write_member_financials()
+        write_previous_month_payments()
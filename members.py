@@ -1,8 +1,13 @@
 from re import search
 from typing import Any
-from pandas import Timestamp, concat, isna, offsets
+from pandas import DataFrame, Series, Timestamp, concat, isna, offsets
 from numpy import NaN
-from utils import loadFromExcel
+from pandas.api.types import infer_dtype
+from memberships import MembershipIntervals
+from pipeline import compute, lazy_attributes, stage
+from schema import compact
+from utils import Excluding, Sheet, loadFromExcel
+from writers import csv_output, submit_output
 
 
 NOW = Timestamp.today()
@@ -12,6 +17,9 @@ month_begin = Timestamp(day=NOW.day, month=NOW.month, year=NOW.year) - offsets.M
 month_end = month_begin + offsets.MonthEnd()
 
 
+contact_field_pattern = 'E mail|((Title|First name|Middlename|Surname|Telephone|E mail|Mailing List) \\d)$'
+
+
 def trim_normalise_string(x: Any):
     if not isinstance(x, str):
         return x
@@ -52,6 +60,29 @@ def create_full_name(title, firstname, middlename, surname):
     return title + firstname + middlename + surname
 
 
+def sanitise_name_strings(names: Series, with_space=True) -> Series:
+    names = names.astype(object).fillna('')
+    if with_space:
+        return (names + ' ').where(names != '', '')
+    return names
+
+
+def create_names(members: DataFrame) -> DataFrame:
+    # create_formal_name, create_informal_name and create_full_name over whole columns
+    title = sanitise_name_strings(members['Title'])
+    firstname = members['First name'].astype(object)
+    middlename = sanitise_name_strings(members['Middlename'])
+    surname = sanitise_name_strings(members['Surname'], False)
+
+    initials = (firstname.str[:1] + ' ').where(firstname.str.len() > 0, '')
+    formal_names = title + initials + surname
+    return DataFrame({
+        'Formal Name': formal_names,
+        'Informal Name': formal_names.where(firstname.isna() | (firstname.str.len() == 1), firstname),
+        'Full Name': title + sanitise_name_strings(firstname) + middlename + surname,
+    }, index=members.index)
+
+
 def create_addressee(name_series):
     name_series = name_series.sort_index().reset_index(level=[0, 1], drop=True)
     if len(name_series) > 1:
@@ -70,170 +101,207 @@ def create_informal_greeting(name_series):
     return name_series[0]
 
 
+def create_addressees(members: DataFrame) -> DataFrame:
+    # create_addressee and create_informal_greeting for every membership at once, working through
+    # each membership's names by their position in Count order
+    names = members[['Count', 'Formal Name', 'Informal Name']]\
+        .reset_index(names='Membership ID')\
+        .sort_values(['Membership ID', 'Count'])
+    names['Rank'] = names.groupby('Membership ID').cumcount()
+    formal_names = names.pivot(index='Membership ID', columns='Rank', values='Formal Name')
+    informal_names = names.pivot(index='Membership ID', columns='Rank', values='Informal Name')
+    name_counts = names.groupby('Membership ID').size()
+
+    addressees = formal_names[0]
+    if 1 in formal_names.columns:
+        addressees = addressees + (' & ' + formal_names[1]).where(name_counts > 1, '')
+
+    greetings = informal_names[0]
+    for rank in informal_names.columns[1:]:
+        separators = Series(', ', index=name_counts.index).where(name_counts - 1 != rank, ' and ')
+        greetings = greetings + (separators + informal_names[rank]).where(name_counts > rank, '')
+
+    return DataFrame({'Normal Addressee': addressees, 'Informal Greeting': greetings})
+
+
+def trim_normalise_strings(frame: DataFrame) -> DataFrame:
+    frame = frame.copy()
+    for col in frame.columns:
+        values = frame[col]
+        if infer_dtype(values, skipna=True) not in ('string', 'mixed', 'mixed-integer'):
+            continue
+        stripped = values.str.strip()
+        frame[col] = values.where(stripped.isna(), stripped).mask(stripped == '', NaN)
+    return frame.infer_objects()
+
+
+def split_field_name(col: str) -> tuple[str, int]:
+    if col[-1].isdigit():
+        return col[0:len(col) - 2], int(col[-1])
+    return col, 1
+
+
+def reshape_contact_fields(all_members: DataFrame) -> DataFrame:
+    # one row per contact, gathered from numbered columns such as 'First name 2'
+    fields_by_count: dict[int, dict[str, str]] = {}
+    for col in all_members.columns:
+        if search(contact_field_pattern, col):
+            field, count = split_field_name(col)
+            fields_by_count.setdefault(count, {})[col] = field
+
+    contacts = []
+    for count, fields in sorted(fields_by_count.items()):
+        contact = all_members[list(fields)].astype(object).rename(columns=fields)
+        contact = contact[contact.notna().any(axis=1)]
+        contact.insert(0, 'Count', count)
+        contacts.append(contact)
+    field_names = sorted({field for fields in fields_by_count.values() for field in fields.values()})
+
+    members = concat(contacts)\
+        .rename_axis('Membership ID')\
+        .set_index('Count', append=True)\
+        .sort_index()\
+        .reset_index(level='Count')[['Count'] + field_names]
+    members.columns.name = 'Field Name'
+    return trim_normalise_strings(members)
+
+
+def resolve_addresses(normal_members: DataFrame) -> DataFrame:
+    offsite = normal_members['Diff Address'] == 'Y'
+    return DataFrame({
+        'Associate': False,
+        'Offsite': offsite,
+        'Address Line 1': normal_members['Offsite Address Line 1'].where(offsite, normal_members['Onsite Address 1']),
+        'Address Line 2': normal_members['Offsite Address Line 2'].where(offsite, normal_members['Onsite Address 2']),
+        'City': normal_members['Offsite City'].where(offsite, normal_members['Onsite City']),
+        'Post Code': normal_members['Offsite Post Code'].where(offsite, normal_members['Onsite Post Code']),
+    }, index=normal_members.index)
+
+
 def write_mailchimp_members():
+    current_members, members = compute('current_members'), compute('members')
     print("processing MailChimp export")
     email_members = current_members.join(members)[['Email', 'Informal Name', 'Full Name']].reset_index(names='Membership ID')
 
     print("writing emailable members CSV")
-    email_members.to_csv('Current Email Details ' + NOW.isoformat().replace(':', '-') + '.csv', index=False)
-
-
-print("loading properties")
-properties =\
-    loadFromExcel('Properties')\
-    .set_index('Property Code')
-
-print("loading normal_members")
-normal_members =\
-    loadFromExcel('Member Details', 'Member')\
-    .join(properties, on='Property Code')\
-    .rename(columns={
-        'Comment (YELLOW HIGHLIGHT = OLD COMMENT)': 'Comment',
-        'Alt Address 1': 'Offsite Address Line 1',
-        'Alt Address 2': 'Offsite Address Line 2',
-        'Alt Post Code': 'Offsite Post Code',
-        'City': 'Offsite City',
-        'Address 1': 'Onsite Address 1',
-        'Address 2': 'Onsite Address 2',
-        'Address 4': 'Onsite City',
-        'Post Code': 'Onsite Post Code'})
-
-print("processing normal_members")
-normal_members = concat([
-    normal_members,
-    normal_members.apply(
-        lambda row:
-        {
-            'Associate': False,
-            'Offsite': True,
-            'Address Line 1': row['Offsite Address Line 1'],
-            'Address Line 2': row['Offsite Address Line 2'],
-            'City': row['Offsite City'],
-            'Post Code': row['Offsite Post Code'],
-        } if row['Diff Address'] == 'Y' else {
-            'Associate': False,
-            'Offsite': False,
-            'Address Line 1': row['Onsite Address 1'],
-            'Address Line 2': row['Onsite Address 2'],
-            'City': row['Onsite City'],
-            'Post Code': row['Onsite Post Code'],
-        },
-        axis=1,
-        result_type='expand'
-    )],
-    axis='columns')\
-    .drop(['Diff Address', 'Serial Number', 'Alt Address 4', 'Offsite Address Line 1', 'Offsite Address Line 2',
-           'Offsite City', 'Offsite Post Code', 'Onsite Address 1', 'Onsite Address 2', 'Onsite City',
-           'Onsite Post Code', 'Block Code'],
-          axis=1)\
-
-
-print("loading associate_members")
-associate_members = loadFromExcel('Member Details', 'Associates')
-print("processing associate_members")
-associate_members[['Associate', 'Post Zone', 'Offsite', 'Country']] = [True, 'UK', True, 'United Kingdom']
-associate_members = associate_members.rename(columns={
-    'Contact Title 1': 'Title 1',
-    'Contact first name 1': 'First name 1',
-    'Contact middlename 1': 'Middlename 1',
-    'Contact surname 1': 'Surname 1',
-    'Company': 'Alt Addressee',
-    'Alt Address 1': 'Address Line 1',
-    'Alt Address 2': 'Address Line 2',
-    'Alt Post Code': 'Post Code',
-    'Alt Address 4': 'City'
-}).drop(['Serial Number', 'Last Sub Paid', 'Amount Paid', 'Alt Address 3'], axis=1)
-
-print("processing all_members")
-all_members = concat([normal_members, associate_members]).set_index('Membership Number')
-
-print("processing members")
-members = all_members[
-    [
-        col for
-        col in
-        all_members.columns
-        if search('E mail|((Title|First name|Middlename|Surname|Telephone|E mail|Mailing List) \\d)$', col)
-    ]]\
-    .stack()\
-    .reset_index(level=1)\
-    .rename(columns={
-        'level_1': 'Field Name',
-        0: 'Value'
-    }).apply(
-        lambda row: {
-            'Field Name': row['Field Name'][0:len(row['Field Name']) - 2]
-            if row['Field Name'][-1].isdigit()
-            else row['Field Name'],
-            'Count': int(row['Field Name'][len(row['Field Name']) - 1])
-            if row['Field Name'][-1].isdigit()
-            else 1,
-            'Value': row['Value']
-        },
-        axis=1,
-        result_type='expand'
-).reset_index(names=['Membership ID'])\
-    .set_index(['Membership ID', 'Count', 'Field Name'])\
-    .unstack(level=2)
-members = members.reset_index(level=1, col_level=1) # type: ignore
-members.columns = members.columns.droplevel(0)
-members = members.applymap(trim_normalise_string)
-members = members[members['First name'].notna() | members['Middlename'].notna() | members['Surname'].notna()]
-members = concat(
-        [
-            members,
-            members.apply(
-                lambda row: {
-                    'Formal Name': create_formal_name(row['Title'], row['First name'], row['Surname']),
-                    'Informal Name': create_informal_name(row['Title'], row['First name'], row['Surname']),
-                    'Full Name': create_full_name(row['Title'], row['First name'], row['Middlename'], row['Surname']),
-                },
-                axis=1,
-                result_type='expand'
-            )
-        ],
-        axis='columns'
-    )\
-    .rename(columns={'E mail': 'Email'})
-
-
-print("loading issuance")
-issuance =\
-    loadFromExcel('Card Issuances', 'Card Issuance')
-print("processing issuance")
-current_members_accounts = \
-    issuance[issuance['Card End Date'] >= month_begin][['Membership ID']]\
-    .set_index('Membership ID')
-
-
-print("processing accounts")
-accounts = all_members\
-    .join(members
-          .reset_index(names='Membership ID')
-          .set_index(['Membership ID', 'Count'])
-          .groupby(['Membership ID']).agg(**{
-                'Normal Addressee': ('Formal Name', create_addressee),
-                'Informal Greeting': ('Informal Name', create_informal_greeting)
-          })
-          .join(all_members[['Alt Addressee']])
-          .reset_index(names='Membership ID')
-          .apply(
-                lambda row: {
-                    'Membership ID': row['Membership ID'],
-                    'Informal Greeting': row['Informal Greeting'],
-                    'Addressee': row['Normal Addressee'] if isna(row['Alt Addressee']) else row['Alt Addressee'],
-                    'Current Member': row['Membership ID'] in current_members_accounts.index,
-                },
-                axis=1,
-                result_type='expand'
-          )
-          .set_index('Membership ID')
-          )[
-        [
-            'Date first joined', 'Cancelled', 'Treasurere ref', 'Payment Type', 'Comment', 'Property Code',
-            'Offsite', 'Post Zone', 'Address Line 1', 'Address Line 2', 'City', 'County', 'Post Code', 'Country',
-            'Associate', 'Informal Greeting', 'Addressee', 'Current Member'
-        ]]
-
-print("processing current_members")
-current_members = accounts[accounts['Current Member'] == True].drop('Current Member', axis=1)
+    submit_output(csv_output, 'Current Email Details ' + NOW.isoformat().replace(':', '-') + '.csv', email_members)
+
+
+# columns no output uses are left unread
+properties_sheet = Sheet('Properties', 'Properties', Excluding({'Block Code'}))
+member_sheet = Sheet('Member Details', 'Member', Excluding({'Serial Number', 'Alt Address 4'}))
+associates_sheet = Sheet(
+    'Member Details', 'Associates', Excluding({'Serial Number', 'Last Sub Paid', 'Amount Paid', 'Alt Address 3'}))
+
+
+@stage('properties', sources=[properties_sheet])
+def load_properties():
+    print("loading properties")
+    return loadFromExcel(*properties_sheet)\
+        .set_index('Property Code')
+
+
+@stage('normal_members', 'properties', sources=[member_sheet])
+def process_normal_members(properties):
+    print("loading normal_members")
+    normal_members =\
+        loadFromExcel(*member_sheet)\
+        .join(properties, on='Property Code')\
+        .rename(columns={
+            'Comment (YELLOW HIGHLIGHT = OLD COMMENT)': 'Comment',
+            'Alt Address 1': 'Offsite Address Line 1',
+            'Alt Address 2': 'Offsite Address Line 2',
+            'Alt Post Code': 'Offsite Post Code',
+            'City': 'Offsite City',
+            'Address 1': 'Onsite Address 1',
+            'Address 2': 'Onsite Address 2',
+            'Address 4': 'Onsite City',
+            'Post Code': 'Onsite Post Code'})
+
+    print("processing normal_members")
+    return concat([normal_members, resolve_addresses(normal_members)], axis='columns')\
+        .drop(['Diff Address', 'Offsite Address Line 1', 'Offsite Address Line 2', 'Offsite City',
+               'Offsite Post Code', 'Onsite Address 1', 'Onsite Address 2', 'Onsite City', 'Onsite Post Code'],
+              axis=1)
+
+
+@stage('associate_members', sources=[associates_sheet])
+def process_associate_members():
+    print("loading associate_members")
+    associate_members = loadFromExcel(*associates_sheet)
+    print("processing associate_members")
+    associate_members[['Associate', 'Post Zone', 'Offsite', 'Country']] = [True, 'UK', True, 'United Kingdom']
+    return associate_members.rename(columns={
+        'Contact Title 1': 'Title 1',
+        'Contact first name 1': 'First name 1',
+        'Contact middlename 1': 'Middlename 1',
+        'Contact surname 1': 'Surname 1',
+        'Company': 'Alt Addressee',
+        'Alt Address 1': 'Address Line 1',
+        'Alt Address 2': 'Address Line 2',
+        'Alt Post Code': 'Post Code',
+        'Alt Address 4': 'City'
+    })
+
+
+@stage('all_members', 'normal_members', 'associate_members')
+def process_all_members(normal_members, associate_members):
+    print("processing all_members")
+    return compact('all_members', concat([normal_members, associate_members]).set_index('Membership Number'))
+
+
+@stage('members', 'all_members')
+def process_members(all_members):
+    print("processing members")
+    members = reshape_contact_fields(all_members)
+    members = members[members['First name'].notna() | members['Middlename'].notna() | members['Surname'].notna()]
+    members = concat([members, create_names(members)], axis='columns')\
+        .rename(columns={'E mail': 'Email'})
+    return compact('members', members)
+
+
+@stage('issuance', sources=[('Card Issuances', 'Card Issuance')])
+def load_issuance():
+    print("loading issuance")
+    return compact('issuance', loadFromExcel('Card Issuances', 'Card Issuance'))
+
+
+@stage('membership_intervals', 'issuance')
+def process_membership_intervals(issuance):
+    print("processing membership intervals")
+    return MembershipIntervals(issuance)
+
+
+@stage('current_members_accounts', 'membership_intervals')
+def process_current_members_accounts(membership_intervals):
+    print("processing issuance")
+    # a row for each card still held this month, which current_accounts joins on
+    return DataFrame(index=membership_intervals.members_ending_after(month_begin, inclusive=True))
+
+
+@stage('accounts', 'all_members', 'members', 'current_members_accounts')
+def process_accounts(all_members, members, current_members_accounts):
+    print("processing accounts")
+    addressees = create_addressees(members).join(all_members[['Alt Addressee']])
+    accounts = all_members\
+        .join(DataFrame({
+            'Informal Greeting': addressees['Informal Greeting'],
+            'Addressee': addressees['Alt Addressee'].where(addressees['Alt Addressee'].notna(),
+                                                           addressees['Normal Addressee']),
+            'Current Member': addressees.index.isin(current_members_accounts.index),
+        }))[
+            [
+                'Date first joined', 'Cancelled', 'Treasurere ref', 'Payment Type', 'Comment', 'Property Code',
+                'Offsite', 'Post Zone', 'Address Line 1', 'Address Line 2', 'City', 'County', 'Post Code', 'Country',
+                'Associate', 'Informal Greeting', 'Addressee', 'Current Member'
+            ]]
+    return compact('accounts', accounts)
+
+
+@stage('current_members', 'accounts')
+def process_current_members(accounts):
+    print("processing current_members")
+    return accounts[accounts['Current Member'] == True].drop('Current Member', axis=1)
+
+
+__getattr__ = lazy_attributes(__name__)
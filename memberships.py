@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+from kernels import datetimes_as_int64
+
+
+class MembershipIntervals:
+    """The Card Issuance to Card End Date interval of every card issued, for asking who was a member when.
+
+    Cards are held sorted on end date, so the cards not yet ended on a date are the tail found by one binary search.
+    Each member's overlapping cards are also merged into unbroken memberships, held sorted on member and start, which
+    answer whether members were current on dates, and how many were, for many dates at once.
+    """
+
+    def __init__(self, issuance: pd.DataFrame):
+        members = issuance['Membership ID'].to_numpy()
+        starts = datetimes_as_int64(issuance['Card Issuance'])
+        ends = datetimes_as_int64(issuance['Card End Date'])
+
+        self.end_order = np.argsort(ends, kind='stable')
+        self.sorted_ends = ends[self.end_order]
+        self.card_members = members
+
+        # cards missing a date, or ending before they start, are never held
+        held = (starts != np.iinfo(np.int64).min) & (ends >= starts)
+        members, starts, ends = members[held], starts[held], ends[held]
+        order = np.lexsort((starts, members))
+        members, starts, ends = members[order], starts[order], ends[order]
+        new_member = np.r_[True, members[1:] != members[:-1]] if len(members) else np.array([], bool)
+        # the latest end of the member's cards so far; a card starting after it begins a new membership
+        latest_ends = pd.Series(ends).groupby(np.cumsum(new_member)).cummax().to_numpy()
+        begins = new_member.copy()
+        begins[1:] |= starts[1:] > latest_ends[:-1]
+        last = np.r_[begins[1:], True] if len(begins) else begins
+        self.members = members[begins]
+        self.starts = starts[begins]
+        self.ends = latest_ends[last]
+        self.member_ids, self.member_codes = np.unique(self.members, return_inverse=True)
+        self.unique_starts = np.unique(self.starts)
+        self.keys = self._keys(self.member_codes, self.starts)
+        self.sorted_starts = np.sort(self.starts)
+        self.merged_ends = np.sort(self.ends)
+
+    def cards_ending_after(self, date, inclusive: bool = False) -> np.ndarray:
+        # positions in issuance of the cards ending after the date, or on it too if inclusive, in issuance order
+        side = 'left' if inclusive else 'right'
+        return np.sort(self.end_order[np.searchsorted(self.sorted_ends, datetimes_as_int64(date), side=side):])
+
+    def members_ending_after(self, date, inclusive: bool = False) -> pd.Index:
+        # the member of each of those cards, so a member appears once for every card
+        return pd.Index(self.card_members[self.cards_ending_after(date, inclusive)], name='Membership ID')
+
+    def active_in(self, first, last) -> pd.Index:
+        # the members holding a card at any time from the first date to the last
+        active = (self.starts <= datetimes_as_int64(last)) & (self.ends >= datetimes_as_int64(first))
+        return pd.Index(np.unique(self.members[active]), name='Membership ID')
+
+    def current_at(self, members, dates) -> np.ndarray:
+        # whether each member held a card on each date; dates may be a single date for every member
+        members = np.asarray(members)
+        dates = np.broadcast_to(datetimes_as_int64(dates), members.shape)
+        codes = np.searchsorted(self.member_ids, members)
+        current = codes < len(self.member_ids)
+        current[current] = self.member_ids[codes[current]] == members[current]
+        # memberships are disjoint, so only the member's last to start on or before the date can hold it
+        positions = np.searchsorted(self.keys, self._keys(codes, dates), side='right') - 1
+        current &= positions >= 0
+        current[current] = self.member_codes[positions[current]] == codes[current]
+        current[current] = self.ends[positions[current]] >= dates[current]
+        return current
+
+    def _keys(self, member_codes: np.ndarray, dates: np.ndarray) -> np.ndarray:
+        # as RunningBalances, the member and the rank of the date among the starts packed into one sortable integer
+        ranks = np.searchsorted(self.unique_starts, dates, side='right')
+        return member_codes.astype(np.int64) * (len(self.unique_starts) + 1) + ranks
+
+    def current_counts(self, dates) -> np.ndarray:
+        # the number of members holding a card on each date
+        dates = datetimes_as_int64(dates)
+        return np.searchsorted(self.sorted_starts, dates, side='right') - \
+            np.searchsorted(self.merged_ends, dates, side='left')
+
+    def monthly_counts(self, first_month, last_month) -> pd.Series:
+        # the number of members holding a card on the first of each month
+        months = pd.period_range(first_month, last_month, freq='M')
+        return pd.Series(self.current_counts(months.to_timestamp()), index=months, name='Members')
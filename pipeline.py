@@ -0,0 +1,78 @@
+from typing import Any, Callable, Iterable, NamedTuple
+
+
+class Stage(NamedTuple):
+    name: str
+    function: Callable[..., Any]
+    dependencies: tuple[str, ...]
+    module: str
+    # (workbook, sheet) pairs or utils.Sheet the stage loads, so they can be read ahead in parallel
+    sources: tuple[tuple, ...] = ()
+
+
+stages: dict[str, Stage] = {}
+results: dict[str, Any] = {}
+_in_progress: set[str] = set()
+
+
+def stage(name: str, *dependencies: str, sources: Iterable[tuple] = ()):
+    def register(function: Callable[..., Any]) -> Callable[..., Any]:
+        if name in stages and stages[name].module != function.__module__:
+            raise ValueError(f'Stage {name} is already declared in {stages[name].module}')
+        stages[name] = Stage(name, function, dependencies, function.__module__, tuple(sources))
+        return function
+
+    return register
+
+
+def compute(name: str) -> Any:
+    if name in results:
+        return results[name]
+    if name not in stages:
+        raise KeyError(f'No such stage {name}')
+    if name in _in_progress:
+        raise RuntimeError(f'Stage {name} depends on itself')
+
+    _in_progress.add(name)
+    try:
+        stage_def = stages[name]
+        results[name] = stage_def.function(*[compute(dependency) for dependency in stage_def.dependencies])
+    finally:
+        _in_progress.discard(name)
+    return results[name]
+
+
+def required_stages(*names: str) -> list[str]:
+    ordered: list[str] = []
+
+    def visit(name: str):
+        if name in ordered:
+            return
+        if name not in stages:
+            raise KeyError(f'No such stage {name}')
+        for dependency in stages[name].dependencies:
+            visit(dependency)
+        ordered.append(name)
+
+    for name in names:
+        visit(name)
+    return ordered
+
+
+def required_sources(*names: str) -> list[tuple]:
+    return [source for name in required_stages(*names) if name not in results for source in stages[name].sources]
+
+
+def reset():
+    results.clear()
+
+
+def lazy_attributes(module_name: str) -> Callable[[str], Any]:
+    # lets `members.accounts` and friends keep working, computed on first access
+    def module_getattr(attr: str) -> Any:
+        stage_def = stages.get(attr)
+        if stage_def is not None and stage_def.module == module_name:
+            return compute(attr)
+        raise AttributeError(f'module {module_name!r} has no attribute {attr!r}')
+
+    return module_getattr
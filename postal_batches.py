@@ -1,14 +1,17 @@
-from cards_to_print import *
-
+from pandas import MultiIndex, merge_asof
 
-fee_mappings = {0: None, 5: 'UK', 8: 'UK', 10: 'UK', 11: 'EU', 14: 'International'}
+from cards_to_print import *
+from fees import fee_schedule
+from kernels import preprint_split
+from pipeline import compute, lazy_attributes, stage
+from writers import OutputRun, excel_output, submit_output
 
 
 def write_postal_batches():
     excel_write('postal batches ', [
-        ('Postal Batches', postal_batches),
-        ('Zone Resolved', zone_resolved_issuance),
-        ('Working', self_joined_issuance)
+        ('Postal Batches', compute('postal_batches')),
+        ('Zone Resolved', compute('zone_resolved_issuance')),
+        ('Working', compute('resolved_issuance'))
     ], NOW)
 
 
@@ -17,74 +20,85 @@ def excel_write(prefix: str, sheets: list[tuple[str, DataFrame]], now: Timestamp
         now = Timestamp.today()
     file_name = f'{prefix}{now.isoformat().replace(':', '-')}.xlsx'
     print(f'writing to {file_name}')
-    with ExcelWriter(file_name) as writer:
-        for sheet in sheets:
-            sheet[1].to_excel(writer, sheet_name=sheet[0])
-
-
-def create_resolved_columns(row_dict):
-    fee = row_dict['Membership Fee Original'] if row_dict['Has Fee'] else row_dict['Membership Fee Joined'] if row_dict['Replace Fee'] else 0
-    batch_date = row_dict['Processing Date Original']
-    letters = 1
-    membership_cards = row_dict['Members']
-    preprinted_letters = 0
-    preprinted_cards = 0
-    if not isna(row_dict['Preprinted']):
-        batch_date = row_dict['Card Issuance Original']
-        letters, preprinted_letters = preprinted_letters, letters
-        membership_cards, preprinted_cards = preprinted_cards, membership_cards
-    return {
-        'Batch': batch_date.strftime('%Y%m'),
-        'Fee': fee,
-        'Zone': fee_mappings[fee],
-        'Valid': fee > 0,
-        'Letters': letters,
-        'Cards': membership_cards,
-        'Preprinted Letters': preprinted_letters,
-        'Preprinted Cards': preprinted_cards
-    }
-
-
-print('processing postal batches')
-indexed_issuance = issuance.set_index('Membership ID')
-self_joined_issuance = indexed_issuance\
-    .join(indexed_issuance, lsuffix=' Original', rsuffix=' Joined')\
-    .join(members.groupby('Membership ID').agg(**{'Members': ('Count', 'max')}))\
-    .reset_index()
-self_joined_issuance = preprints\
-    .set_index(['Membership Number', 'Letter Date'])\
-    .merge(
-        self_joined_issuance,
-        how='right',
-        left_index=True,
-        right_on=['Membership ID', 'Card Issuance Original'])\
-    .sort_values('Processing Date Joined', ascending=False)
-self_joined_issuance['Has Fee'] =\
-    ((self_joined_issuance['Membership Fee Original'] > 0) &
-     (self_joined_issuance['Processing Date Original'] == self_joined_issuance['Processing Date Joined']))
-self_joined_issuance['Previous Prospectives'] =\
-    ((self_joined_issuance['Membership Fee Original'] == 0) &
-     (self_joined_issuance['Processing Date Original'] > self_joined_issuance['Processing Date Joined']))
-self_joined_issuance['Closest Prospective'] = ~self_joined_issuance.duplicated(
-    ['Membership ID', 'Processing Date Original', 'Membership Fee Original', 'Membership Fee Joined',
-     'Previous Prospectives'])
-self_joined_issuance['Replace Fee'] =\
-    ((self_joined_issuance['Membership Fee Original'] == 0) &
-     (self_joined_issuance['Membership Fee Joined'] > 0) &
-     self_joined_issuance['Previous Prospectives'] &
-     self_joined_issuance['Closest Prospective'])
-self_joined_issuance =\
-    concat([self_joined_issuance,
-            self_joined_issuance.apply(create_resolved_columns, axis=1, result_type='expand')],
-           axis=1)
-
-zone_resolved_issuance = self_joined_issuance[self_joined_issuance['Valid'] > 0][
-    ['Batch', 'Zone', 'Letters', 'Cards', 'Preprinted Letters', 'Preprinted Cards']]
-postal_batches = zone_resolved_issuance.groupby(['Batch', 'Zone']).agg(**{
-    'Letters': ('Letters', 'sum'),
-    'Cards': ('Cards', 'sum'),
-    'Preprinted Letters': ('Preprinted Letters', 'sum'),
-    'Preprinted Cards': ('Preprinted Cards', 'sum')})
+    submit_output(excel_output, file_name, [(sheet_name, df, True) for sheet_name, df in sheets])
+
+
+def resolve_issuance_fees(issuance: DataFrame, members: DataFrame, preprints: DataFrame) -> DataFrame:
+    # An issuance processed with a fee is charged that fee. A prospective, zero fee, issuance is charged each
+    # distinct fee paid on an earlier processed issuance of the same member, taken from the latest of those by
+    # an as-of match. Rows are labelled and ordered as when issuance was joined to itself per member, which
+    # gave each row of the sheet, in turn, a label per issuance of its member. Issuances without a Membership
+    # ID were joined with each other, and are resolved as one member here.
+    issuance = issuance.join(
+        members.groupby('Membership ID').agg(**{'Members': ('Count', 'max')}), on='Membership ID')
+    by_member = issuance.groupby('Membership ID', sort=False, dropna=False)
+    issuance['Rank'] = by_member.cumcount()
+    issuance['Issuances'] = by_member['Membership ID'].transform('size')
+    issuance['Pair Base'] = issuance['Issuances'].cumsum() - issuance['Issuances']
+    issuance['Preprinted'] = MultiIndex.from_frame(issuance[['Membership ID', 'Card Issuance']]).isin(
+        MultiIndex.from_frame(preprints[['Membership Number', 'Letter Date']]))
+
+    processed = issuance[issuance['Processing Date'].notna()]
+    joined_columns = ['Membership ID', 'Processing Date', 'Rank']
+    charged = processed[processed['Membership Fee'] > 0]\
+        .merge(processed[joined_columns], on=['Membership ID', 'Processing Date'], suffixes=('', ' Joined'))
+    charged = charged.assign(**{
+        'Processing Date Joined': charged['Processing Date'],
+        'Fee': charged['Membership Fee'],
+        'Replace Fee': False})
+
+    prospective = processed[processed['Membership Fee'] == 0]\
+        .drop_duplicates(['Membership ID', 'Processing Date'])\
+        .sort_values('Processing Date')
+    replaced = []
+    for fee in sorted(processed.loc[processed['Membership Fee'] > 0, 'Membership Fee'].unique()):
+        # ties on processing date resolve to the first issuance, hence Rank descending
+        paid = processed[processed['Membership Fee'] == fee][joined_columns]\
+            .sort_values(['Processing Date', 'Rank'], ascending=[True, False])\
+            .rename(columns={'Processing Date': 'Processing Date Joined', 'Rank': 'Rank Joined'})
+        # the member's latest charge of the fee processed strictly before the prospective issuance
+        matched = merge_asof(prospective, paid, left_on='Processing Date', right_on='Processing Date Joined',
+                             by='Membership ID', direction='backward', allow_exact_matches=False)
+        replaced.append(matched[matched['Rank Joined'].notna()].assign(**{'Fee': fee, 'Replace Fee': True}))
+
+    resolved = concat([charged, *replaced], ignore_index=True)
+    # the fee is zoned by the schedule of the year it was charged in
+    zones = fee_schedule.postal_zones(resolved['Fee'], resolved['Processing Date Joined'])
+    preprinted = resolved['Preprinted']
+    resolved['Batch'] = resolved['Card Issuance'].where(preprinted, resolved['Processing Date']).dt.strftime('%Y%m')
+    resolved['Zone'] = zones
+    resolved['Letters'], resolved['Cards'], resolved['Preprinted Letters'], resolved['Preprinted Cards'] =\
+        preprint_split(preprinted, resolved['Members'])
+    resolved.index = (resolved['Pair Base'] + resolved['Rank Joined']).astype(int).rename(None)
+    return resolved\
+        .sort_index()\
+        .sort_values('Processing Date Joined', ascending=False, kind='stable')\
+        .drop(columns=['Rank', 'Issuances', 'Pair Base', 'Rank Joined'])
+
+
+@stage('resolved_issuance', 'issuance', 'members', 'preprints')
+def process_resolved_issuance(issuance, members, preprints):
+    print('processing postal batches')
+    return resolve_issuance_fees(issuance, members, preprints)
+
+
+@stage('zone_resolved_issuance', 'resolved_issuance')
+def process_zone_resolved_issuance(resolved_issuance):
+    return resolved_issuance[['Batch', 'Zone', 'Letters', 'Cards', 'Preprinted Letters', 'Preprinted Cards']]
+
+
+@stage('postal_batches', 'zone_resolved_issuance')
+def process_postal_batches(zone_resolved_issuance):
+    return zone_resolved_issuance.groupby(['Batch', 'Zone']).agg(**{
+        'Letters': ('Letters', 'sum'),
+        'Cards': ('Cards', 'sum'),
+        'Preprinted Letters': ('Preprinted Letters', 'sum'),
+        'Preprinted Cards': ('Preprinted Cards', 'sum')})
+
+
+__getattr__ = lazy_attributes(__name__)
+
 
 if __name__ == '__main__':
-    write_postal_batches()
+    with OutputRun():
+        write_postal_batches()
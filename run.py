@@ -0,0 +1,75 @@
+import argparse
+from typing import Callable, Dict, NamedTuple
+
+from MailChimp_emails import write_member_types
+from cards_to_print import (write_addresses, write_card_csvs, write_cards_to_print, write_current_members,
+                            write_mailchimp_members)
+from member_financials import write_member_financials, write_previous_month_payments
+from pipeline import required_sources
+from postal_batches import write_postal_batches
+from schema import memory_report
+from utils import close_workbooks, prefetch
+from writers import OutputRun
+
+
+class Output(NamedTuple):
+    write: Callable[[], None]
+    # the stages it writes, whose workbooks are read ahead together
+    stages: tuple[str, ...]
+
+
+# in the order the individual scripts have always written them
+outputs: Dict[str, Output] = {
+    'cards-to-print': Output(write_cards_to_print, (
+        'end_dates', 'new_letter_accounts', 'renewal_letter_accounts', 'new_issuances', 'used_preprints',
+        'letter_post_zones')),
+    'card-csvs': Output(write_card_csvs, ('end_dates', 'cards', 'card_sheets')),
+    'mailchimp': Output(write_mailchimp_members, ('current_members', 'members')),
+    'financials': Output(write_member_financials, ('balances', 'payment_history')),
+    'addresses': Output(write_addresses, ('offsite_accounts', 'post_zones')),
+    'current-members': Output(write_current_members, ('current_member_details',)),
+    'payments': Output(write_previous_month_payments, ()),
+    'postal-batches': Output(write_postal_batches, ('postal_batches', 'zone_resolved_issuance', 'resolved_issuance')),
+    'member-types': Output(write_member_types, ('member_email_details',)),
+}
+
+
+def selected_outputs(targets: list[str], skip: list[str]) -> list[str]:
+    if 'all' in targets:
+        targets = list(outputs)
+    return [name for name in outputs if name in targets and name not in skip]
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(
+        description='Write the membership outputs from one load of the workbooks, sharing the computed frames.')
+    parser.add_argument('targets', nargs='*', choices=['all', *outputs], metavar='target',
+                        help=f'outputs to write: all, {", ".join(outputs)}')
+    parser.add_argument('-o', '--output', action='append', default=[], choices=['all', *outputs], metavar='OUTPUT',
+                        help='output to write; may be repeated, and is combined with any targets')
+    parser.add_argument('--skip', action='append', default=[], choices=list(outputs), metavar='OUTPUT',
+                        help='output to leave out, e.g. with all')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='processes reading workbooks in parallel (default BA_LOAD_WORKERS or the CPU count)')
+    parser.add_argument('--output-workers', type=int, default=None,
+                        help='processes writing output files in parallel (default BA_OUTPUT_WORKERS or the CPU count)')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='print the memory of each compacted frame before and after, once the outputs are written')
+    args = parser.parse_args(argv)
+
+    names = selected_outputs(args.targets + args.output, args.skip)
+    if not names:
+        parser.error('no outputs selected')
+    prefetch(required_sources(*[stage for name in names for stage in outputs[name].stages]), args.workers)
+    try:
+        with OutputRun(args.output_workers):
+            for name in names:
+                outputs[name].write()
+    finally:
+        close_workbooks()
+    if args.memory_report:
+        memory_report()
+
+
+if __name__ == '__main__':
+    main()
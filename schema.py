@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+
+from cache import pa
+from utils import env_flag
+
+
+compact_enabled = env_flag('BA_COMPACT')
+
+# category: text from a short list of values, stored once each
+# flag: True/False, nullable only where there are blanks
+# datetime: datetime64, blanks becoming NaT
+# code: an identifier or code that takes part in no arithmetic; whole numbers downcast to the smallest integer type
+#   that holds every value, and text held as Arrow strings where pyarrow is installed
+# Money is left out, keeping its int64 or float64, as sums and products in a narrower integer type wrap around
+type ColumnKind = str
+type Schema = dict[str, ColumnKind]
+
+contact_schema: Schema = {
+    **{f'Title {count}': 'category' for count in range(1, 4)},
+    **{f'Mailing List {count}': 'flag' for count in range(1, 4)},
+}
+address_schema: Schema = {
+    'Post Zone': 'category',
+    'City': 'category',
+    'County': 'category',
+    'Country': 'category',
+    'Associate': 'flag',
+    'Offsite': 'flag',
+}
+
+# Property Code is a code rather than a category: nearly every account has its own, so a category would save nothing
+schemas: dict[str, Schema] = {
+    'all_members': {
+        **address_schema,
+        **contact_schema,
+        'Payment Type': 'category',
+        'Property Code': 'code',
+        'Date first joined': 'datetime',
+    },
+    'accounts': {
+        **address_schema,
+        'Payment Type': 'category',
+        'Property Code': 'code',
+        'Date first joined': 'datetime',
+        'Current Member': 'flag',
+    },
+    # Count numbers each member's contacts
+    'members': {
+        'Count': 'code',
+        'Property Code': 'code',
+        'Title': 'category',
+        'Mailing List': 'flag',
+    },
+    'issuance': {
+        'Membership ID': 'code',
+        'Processing Date': 'datetime',
+        'Card Issuance': 'datetime',
+        'Renewal Date': 'datetime',
+        'Card End Date': 'datetime',
+        'Anticipatory': 'flag',
+    },
+    # Amount is money; Date is an index level, compacted as the columns are
+    'payment_history': {
+        'Date': 'datetime',
+        'Payment Type': 'category',
+        'Property Code': 'code',
+    },
+}
+
+memory_usage: dict[str, tuple[int, int]] = {}
+
+
+def arrow_text_dtype() -> pd.StringDtype | None:
+    # Arrow strings with NaN for blanks, as text in object columns has
+    if pa is None:
+        return None
+    try:
+        return pd.StringDtype('pyarrow', na_value=np.nan)
+    except TypeError:
+        # pandas before 2.3 names these pyarrow_numpy
+        return pd.StringDtype('pyarrow_numpy')
+
+
+def compact_column(values: pd.Series, kind: ColumnKind) -> pd.Series:
+    match kind:
+        case 'category':
+            return values if isinstance(values.dtype, pd.CategoricalDtype) else values.astype('category')
+        case 'flag':
+            if values.dtype == bool:
+                return values
+            flags = values.astype('boolean')
+            return flags.astype(bool) if not flags.hasnans else flags
+        case 'datetime':
+            return pd.to_datetime(values)
+        case 'code':
+            if values.dtype.kind in 'iu':
+                return pd.to_numeric(values, downcast='integer')
+            # only text is held as Arrow strings, so a code that is sometimes a number keeps its numbers
+            text_dtype = arrow_text_dtype()
+            if text_dtype is not None and values.dtype == object and pd.api.types.infer_dtype(values) == 'string':
+                return values.astype(text_dtype)
+            return values
+        case _:
+            raise ValueError(f'No such column kind {kind}')
+
+
+def unexpected_values(values: pd.Series, kind: ColumnKind) -> list:
+    # the first few values of the column that cannot be taken as the kind
+    match kind:
+        case 'flag':
+            unexpected = values.notna() & ~values.map(lambda value: isinstance(value, (bool, np.bool_)))
+        case 'datetime':
+            unexpected = values.notna() & pd.to_datetime(values, errors='coerce').isna()
+        case _:
+            return []
+    return list(pd.unique(values[unexpected]))[:5]
+
+
+def compact_frame_column(name: str, values: pd.Series, kind: ColumnKind) -> pd.Series:
+    # as compact_column, but a value of the wrong kind is reported with the frame, column and values named
+    try:
+        return compact_column(values, kind)
+    except (ValueError, TypeError) as error:
+        unexpected = unexpected_values(values, kind)
+        listed = f': {", ".join(map(repr, unexpected))}' if unexpected else ''
+        raise ValueError(f'{values.name} in {name} has values that are not a {kind}{listed}') from error
+
+
+def compact_index(name: str, index: pd.Index, schema: Schema) -> pd.Index:
+    # each level of the index named in the schema compacted as a column would be
+    levels = [index.get_level_values(level) for level in range(index.nlevels)]
+    levels = [pd.Index(compact_frame_column(name, level.to_series(), schema[level.name]))
+              if level.name in schema else level for level in levels]
+    return pd.MultiIndex.from_arrays(levels) if index.nlevels > 1 else levels[0]
+
+
+def compact(name: str, df: pd.DataFrame) -> pd.DataFrame:
+    # the stage's frame with the column types of its schema, and its memory before and after reported
+    if not compact_enabled:
+        return df
+    before = df.memory_usage(deep=True).sum()
+    schema = schemas[name]
+    df = df.assign(**{
+        column: compact_frame_column(name, df[column], kind) for column, kind in schema.items() if column in df})
+    if any(level in schema for level in df.index.names):
+        df.index = compact_index(name, df.index, schema)
+    after = df.memory_usage(deep=True).sum()
+    memory_usage[name] = before, after
+    print(f'\t{name} compacted from {before / 1024:,.0f} KiB to {after / 1024:,.0f} KiB')
+    return df
+
+
+def memory_report():
+    for name, (before, after) in memory_usage.items():
+        print(f'{name:<20} {before / 1024:>10,.0f} KiB {after / 1024:>10,.0f} KiB {1 - after / before:>8.0%} saved')
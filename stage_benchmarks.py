@@ -0,0 +1,173 @@
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Any, NamedTuple
+
+import pandas as pd
+
+from pipeline import compute, required_stages, stages
+from synthetic_data import generate
+
+# the modules whose stages are profiled, each a script writing its own outputs
+stage_modules = ['members', 'member_financials', 'cards_to_print', 'postal_batches', 'MailChimp_emails']
+
+
+class StageResult(NamedTuple):
+    size: int
+    stage: str
+    module: str
+    seconds: float
+    # the most traced memory allocated while the stage ran, and what its result still holds after
+    peak_mib: float
+    retained_mib: float
+    rows: int | None
+
+
+def result_rows(result: Any) -> int | None:
+    return len(result) if isinstance(result, (pd.DataFrame, pd.Series, pd.Index)) else None
+
+
+def run_stages(names: list[str], traced: bool) -> list[tuple[str, str, float, float, float, int | None]]:
+    # Run in a fresh process whose environment points at the data and an empty cache, so every stage starts cold.
+    # The modules are imported here, as they read their settings from the environment when imported.
+    for module in stage_modules:
+        importlib.import_module(module)
+
+    measured = []
+    if traced:
+        tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        # each stage's dependencies are computed before it, so it is measured on its own; one-off costs such as
+        # compiling the kernels fall to the first stage that needs them, so compare runs of the same stages
+        for name in required_stages(*names):
+            if traced:
+                tracemalloc.reset_peak()
+                before, _ = tracemalloc.get_traced_memory()
+            start = time.perf_counter()
+            result = compute(name)
+            seconds = time.perf_counter() - start
+            peak_mib = retained_mib = 0.0
+            if traced:
+                after, peak = tracemalloc.get_traced_memory()
+                peak_mib, retained_mib = (peak - before) / 2 ** 20, (after - before) / 2 ** 20
+            measured.append((name, stages[name].module, seconds, peak_mib, retained_mib, result_rows(result)))
+    if traced:
+        tracemalloc.stop()
+    return measured
+
+
+def run_in_child(files_dir: str, names: list[str], traced: bool) -> list[tuple]:
+    with tempfile.TemporaryDirectory() as cache_dir:
+        environment = dict(os.environ)
+        os.environ.update(BA_FILES_DIR=files_dir, BA_CACHE_DIR=cache_dir)
+        try:
+            with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+                return executor.submit(run_stages, names, traced).result()
+        finally:
+            os.environ.clear()
+            os.environ.update(environment)
+
+
+def synthetic_files(data_dir: str, size: int, depth: int, seed: int) -> str:
+    # generated once for each size, depth and seed, and reused while its parameters file says it is complete
+    parameters = {'members': size, 'depth': depth, 'seed': seed}
+    files_dir = os.path.join(data_dir, f'{size} members depth {depth} seed {seed}')
+    parameters_file = os.path.join(files_dir, 'parameters.json')
+    try:
+        with open(parameters_file) as f:
+            if json.load(f) == parameters:
+                return files_dir
+    except FileNotFoundError:
+        pass
+    print(f'generating {size:,} members in {files_dir}')
+    with contextlib.redirect_stdout(io.StringIO()):
+        generate(files_dir, size, depth, seed)
+    with open(parameters_file, 'w') as f:
+        json.dump(parameters, f)
+    return files_dir
+
+
+def profile(files_dir: str, size: int, names: list[str]) -> list[StageResult]:
+    # timed and traced in separate runs, as tracemalloc slows down the code it watches
+    timed = run_in_child(files_dir, names, traced=False)
+    traced = run_in_child(files_dir, names, traced=True)
+    return [StageResult(size, name, module, seconds, peak_mib, retained_mib, rows)
+            for (name, module, seconds, _, _, rows), (_, _, _, peak_mib, retained_mib, _) in zip(timed, traced)]
+
+
+def print_results(results: list[StageResult]):
+    for result in results:
+        rows = '' if result.rows is None else f'{result.rows:,}'
+        print(f'{result.size:>8} {result.module:<18} {result.stage:<28} {rows:>10} '
+              f'{result.seconds:9.3f}s {result.peak_mib:9.1f} MiB {result.retained_mib:9.1f} MiB')
+
+
+def print_comparison(previous: dict[str, Any], results: list[StageResult]):
+    before = {(result['size'], result['stage']): result for result in previous['results']}
+    print(f'compared with {previous["created"]}')
+    for result in results:
+        old = before.get((result.size, result.stage))
+        if old is None:
+            continue
+        print(f'{result.size:>8} {result.stage:<28} {old["seconds"]:9.3f}s {result.seconds:9.3f}s '
+              f'{result.seconds / max(old["seconds"], 1e-9):7.2f}x '
+              f'{old["peak_mib"]:9.1f} MiB {result.peak_mib:9.1f} MiB')
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(
+        description='Time and trace the memory of each stage on synthetic workbooks of increasing size.')
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help=f'stages to profile, with the stages they depend on (default every stage of '
+                             f'{", ".join(stage_modules)})')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 500_000],
+                        help='numbers of members to generate')
+    parser.add_argument('-d', '--depth', type=int, default=5, help='most years of card issuances and payments')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'bapython synthetic'),
+                        help='directory the synthetic workbooks are generated in and reused from')
+    parser.add_argument('--json', help='file to write the results to (default stage benchmarks <time>.json)')
+    parser.add_argument('--compare', help='results file of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    created = pd.Timestamp.today()
+    names = args.stages
+    if not names:
+        for module in stage_modules:
+            importlib.import_module(module)
+        names = [name for name, stage_def in stages.items() if stage_def.module in stage_modules]
+
+    results = []
+    for size in args.sizes:
+        files_dir = synthetic_files(args.data_dir, size, args.depth, args.seed)
+        size_results = profile(files_dir, size, names)
+        print_results(size_results)
+        results += size_results
+
+    results_file = args.json or f'stage benchmarks {created.isoformat().replace(":", "-")}.json'
+    print(f'writing {results_file}')
+    with open(results_file, 'w') as f:
+        json.dump({
+            'created': created.isoformat(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'depth': args.depth,
+            'seed': args.seed,
+            'results': [result._asdict() for result in results],
+        }, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
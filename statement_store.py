@@ -0,0 +1,141 @@
+import json
+import os
+
+import pandas as pd
+
+from cache import from_arrow_table, pq, read_frame, source_is_current, source_stamp, write_frame, write_json_atomic
+from utils import Sheet, cache_dir, env_flag, env_setting, loadFromExcel, workbook_path
+
+
+store_dir = env_setting('BA_STATEMENT_STORE_DIR', os.path.join(cache_dir, 'statements'))
+store_enabled = env_flag('BA_STATEMENT_STORE')
+
+statements_sheet = Sheet('Statements', 'Statements 30-91-79 27933660')
+
+
+def row_keys(df: pd.DataFrame) -> pd.Series:
+    # each row's values hashed, numbered apart from identical rows before it, whatever its position in the sheet
+    hashes = pd.util.hash_pandas_object(df, index=False)
+    occurrences = hashes.groupby(hashes).cumcount()
+    return hashes.map('{:016x}'.format) + '-' + occurrences.astype(str)
+
+
+class StatementStore:
+    """The bank statement sheet as Parquet files partitioned by Transaction Date month.
+
+    Each ingest appends only the rows dated after the latest Transaction Date already ingested, and the rows on
+    that date not yet ingested, told apart by their values. Rows may be added at the top of a newest first sheet
+    or the bottom of an oldest first one, and earlier rows edited in place are left as they were ingested. The
+    store is rebuilt when the sheet is another file, has other columns or no longer reaches the latest date
+    ingested. Rows are numbered in the sheet's order in a Row column, which is their position in the sheet while
+    rows are only added at the bottom.
+    """
+
+    def __init__(self, directory: str, sheet: Sheet = statements_sheet):
+        self.directory = directory
+        self.sheet = sheet
+        self.manifest_file = os.path.join(directory, 'manifest.json')
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(self.manifest_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, manifest: dict):
+        write_json_atomic(self.manifest_file, manifest, indent=1)
+
+    def _partition_dir(self, month: pd.Period) -> str:
+        return os.path.join(self.directory, f'month={month}')
+
+    def _is_current(self, manifest: dict, path: str) -> bool:
+        mtime_ns = manifest.get('mtime_ns')
+        if not source_is_current(manifest, path):
+            return False
+        if manifest['mtime_ns'] != mtime_ns:
+            self._save_manifest(manifest)
+        return True
+
+    @staticmethod
+    def _read_part(base_file: str, extension: str) -> pd.DataFrame:
+        # a month with columns Arrow cannot hold is pickled by write_frame instead
+        if extension == '.parquet':
+            # partitioning=None, or Arrow would add the month from the directory name as a column
+            return from_arrow_table(pq.read_table(base_file + extension, partitioning=None))
+        return read_frame(base_file, extension[1:])
+
+    def clear(self):
+        for entry in os.scandir(self.directory) if os.path.isdir(self.directory) else []:
+            if entry.is_dir() and entry.name.startswith('month='):
+                for part in os.scandir(entry.path):
+                    os.remove(part.path)
+                os.rmdir(entry.path)
+        if os.path.exists(self.manifest_file):
+            os.remove(self.manifest_file)
+
+    def ingest(self) -> int:
+        path = workbook_path(self.sheet.workbook)
+        manifest = self._load_manifest()
+        if self._is_current(manifest, path):
+            return 0
+        statements = loadFromExcel(*self.sheet)
+        dated = statements[statements['Transaction Date'].notna()]
+        dates = dated['Transaction Date']
+        keys = row_keys(dated)
+
+        through = pd.Timestamp(manifest['through']) if manifest.get('through') else None
+        if through is None or (manifest.get('path') != os.path.abspath(path) or
+                               manifest.get('columns') != list(statements.columns) or
+                               dates.max() < through):
+            if through is not None:
+                print('rebuilding the statement store')
+            self.clear()
+            manifest, through = {}, None
+        first_row, next_row, parts = manifest.get('first_row', 0), manifest.get('next_row', 0), manifest.get('parts', 0)
+
+        is_new = (dates > through) | ((dates == through) & ~keys.isin(manifest.get('boundary', [])))\
+            if through is not None else pd.Series(True, index=dated.index)
+        new_rows = dated[is_new]
+        # numbered before the rows ingested when the sheet is newest first, so Row keeps to the sheet's order
+        if len(dated) > 1 and dates.iloc[0] > dates.iloc[-1]:
+            first_row -= len(new_rows)
+            new_rows = new_rows.assign(Row=range(first_row, first_row + len(new_rows)))
+        else:
+            new_rows = new_rows.assign(Row=range(next_row, next_row + len(new_rows)))
+            next_row += len(new_rows)
+        months = new_rows['Transaction Date'].dt.to_period('M')
+        for month, partition in new_rows.groupby(months):
+            partition_dir = self._partition_dir(month)
+            os.makedirs(partition_dir, exist_ok=True)
+            write_frame(partition.reset_index(drop=True), os.path.join(partition_dir, f'part-{parts:06}'))
+
+        latest = dates.max() if len(dated) else through
+        self._save_manifest({
+            **source_stamp(path),
+            'first_row': first_row,
+            'next_row': next_row,
+            'parts': parts + 1,
+            'through': latest.isoformat() if latest is not None else None,
+            'boundary': keys[dates == latest].tolist() if latest is not None else [],
+            'columns': list(statements.columns),
+        })
+        print(f'ingested {len(new_rows)} statement rows')
+        return len(new_rows)
+
+    def month(self, month: pd.Period) -> pd.DataFrame:
+        partition_dir = self._partition_dir(month)
+        parts = sorted(os.path.splitext(part) for part in os.listdir(partition_dir)
+                       if part.endswith(('.parquet', '.pickle'))) if os.path.isdir(partition_dir) else []
+        if not parts:
+            return pd.DataFrame(columns=self._load_manifest().get('columns', []))
+        return pd.concat([self._read_part(os.path.join(partition_dir, part), extension)
+                          for part, extension in parts])\
+            .set_index('Row')\
+            .rename_axis(None)\
+            .sort_index()
+
+
+if store_enabled and pq is None:
+    print('The statement store needs pyarrow, which is not installed, so statements are read from the whole sheet')
+statement_store = StatementStore(store_dir) if store_enabled and pq is not None else None
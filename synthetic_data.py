@@ -0,0 +1,261 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from fees import fee_schedule
+from member_financials import file_names as payment_workbooks
+from statement_store import statements_sheet
+from writers import ExcelOutput
+
+# made-up people, with the stray spaces, lower case and accents the real sheets have
+titles = np.array(['Mr', 'Mrs', 'Ms', 'Dr', None], dtype=object)
+first_names = np.array(['Alice', 'bob', 'Émile', 'Zoë', 'J', '  Carol ', 'dave', 'Ève', None, '  '], dtype=object)
+middle_names = np.array(['Ann', 'Lee', ' '], dtype=object)
+surnames = np.array(['Smith', 'jones', 'Ödegaard', 'Brown', 'le Carré', 'Adams', 'adams', None], dtype=object)
+offsite_zones = ['UK', 'Europe', 'Zone 1', 'Zone 2', 'Zone 3']
+zone_countries = {'UK': 'United Kingdom', 'Europe': 'France', 'Zone 1': 'USA', 'Zone 2': 'Australia',
+                  'Zone 3': 'Japan'}
+# the share of normal members with a second and third contact
+contact_shares = {1: 1.0, 2: 0.5, 3: 0.15}
+
+# a seed, or the generator the frames of one set of workbooks are drawn from in turn
+type Seed = int | np.random.Generator
+
+
+def month_starts(months: np.ndarray) -> pd.DatetimeIndex:
+    # the first of each month, counted in months since January 1970
+    return pd.to_datetime(pd.DataFrame({'year': 1970 + months // 12, 'month': months % 12 + 1, 'day': 1}))
+
+
+def month_number(date: pd.Timestamp) -> int:
+    return (date.year - 1970) * 12 + date.month - 1
+
+
+def contact_columns(rng: np.random.Generator, size: int, count: int) -> dict[str, np.ndarray]:
+    present = rng.random(size) < contact_shares[count]
+    return {
+        f'Title {count}': np.where(present, rng.choice(titles, size), None),
+        f'First name {count}': np.where(present, rng.choice(first_names, size), None),
+        f'Middlename {count}': np.where(present & (rng.random(size) < 0.2), rng.choice(middle_names, size), None),
+        f'Surname {count}': np.where(present, rng.choice(surnames, size), None),
+        f'Telephone {count}': np.where(present & (rng.random(size) < 0.6),
+                                       rng.integers(2070000000, 2079999999, size), None),
+        f'Mailing List {count}': np.where(present, rng.random(size) < 0.7, None),
+    }
+
+
+def synthetic_member_sheets(members: int, seed: Seed = 0, today: pd.Timestamp = None) -> dict[str, pd.DataFrame]:
+    # the Properties sheet, and the Member and Associates sheets of Member Details; one member in twenty an associate
+    rng = np.random.default_rng(seed)
+    today = pd.Timestamp.today().normalize() if today is None else today
+    associates = max(2, members // 20)
+    normal = members - associates
+    property_count = int(members * 1.2) + 10
+    property_codes = np.array([f'P{i:06d}' for i in range(property_count)], dtype=object)
+    properties = pd.DataFrame({
+        'Property Code': property_codes,
+        'Block Code': rng.choice(['BEN', 'CRO', 'SHA', 'LAU'], property_count),
+        'Address 1': [f'{i} Some House' for i in range(property_count)],
+        'Address 2': 'Barbican',
+        'Address 4': 'London',
+        'Post Code': rng.choice(['EC2Y 8AA', 'EC2Y 8BB', 'EC2Y 8DD'], property_count),
+    })
+
+    offsite = rng.random(normal) < 0.25
+    zones = np.where(offsite, rng.choice(offsite_zones, normal), 'Barbican')
+    member = pd.DataFrame({
+        'Serial Number': np.arange(normal),
+        'Membership Number': np.arange(1, normal + 1),
+        'Property Code': rng.choice(property_codes, normal, replace=False),
+        'Diff Address': np.where(offsite, 'Y', None),
+        'Alt Addressee': np.where(rng.random(normal) < 0.05, 'The Trustees', None),
+        'Alt Address 1': np.where(offsite, 'Elsewhere Road', None),
+        'Alt Address 2': np.where(offsite & (rng.random(normal) < 0.5), 'Flat 2', None),
+        'City': np.where(offsite, 'Leeds', None),
+        'Alt Address 4': None,
+        'County': np.where(offsite & (rng.random(normal) < 0.3), 'Yorkshire', None),
+        'Alt Post Code': np.where(offsite, 'LS1 1AA', None),
+        'Country': np.where(offsite, pd.Series(zones).map(zone_countries), None),
+        'Post Zone': zones,
+        'Date first joined': today - pd.to_timedelta(rng.integers(10, 4000, normal), unit='D'),
+        'Cancelled': np.where(rng.random(normal) < 0.05, 'Y', None),
+        'Treasurere ref': [f'T{i}' for i in range(normal)],
+        'Payment Type': rng.choice(['SO', 'Cheque', 'PayPal', 'Cash'], normal),
+        'Comment (YELLOW HIGHLIGHT = OLD COMMENT)': np.where(rng.random(normal) < 0.1, 'note', None),
+        'E mail': np.where(rng.random(normal) < 0.8, [f'm{i}@example.com' for i in range(normal)], None),
+    })
+    for count in contact_shares:
+        member = member.assign(**contact_columns(rng, normal, count))
+
+    associate = pd.DataFrame({
+        'Serial Number': np.arange(associates),
+        'Membership Number': np.arange(normal + 1, members + 1),
+        'Company': np.where(rng.random(associates) < 0.5, 'Acme Ltd', None),
+        'Contact Title 1': rng.choice(titles, associates),
+        'Contact first name 1': rng.choice(first_names[:8], associates),
+        'Contact middlename 1': None,
+        'Contact surname 1': rng.choice(surnames[:7], associates),
+        'Alt Address 1': 'Assoc Street',
+        'Alt Address 2': None,
+        'Alt Address 3': None,
+        'Alt Address 4': 'London',
+        'Alt Post Code': 'N1 1AA',
+        'County': None,
+        'E mail': [f'a{i}@example.com' for i in range(associates)],
+        'Telephone 1': None,
+        'Mailing List 1': rng.random(associates) < 0.5,
+        'Date first joined': today - pd.to_timedelta(rng.integers(10, 4000, associates), unit='D'),
+        'Cancelled': None,
+        'Treasurere ref': None,
+        'Payment Type': 'Cheque',
+        'Comment': None,
+        'Last Sub Paid': None,
+        'Amount Paid': fee_schedule.associate_fee(today),
+    })
+    return {'Properties': properties, 'Member': member, 'Associates': associate}
+
+
+def member_fees(member: pd.DataFrame, associate: pd.DataFrame, today: pd.Timestamp) -> np.ndarray:
+    # each member's fee this year by the fee schedule, in Membership Number order
+    return np.r_[fee_schedule.zone_fees(member['Post Zone'], today),
+                 np.full(len(associate), fee_schedule.associate_fee(today))]
+
+
+def zone_fees(rng: np.random.Generator, members: int, today: pd.Timestamp) -> np.ndarray:
+    # fees of members in random zones, for frames generated without the member sheets
+    return fee_schedule.zone_fees(rng.choice(fee_schedule.zones, members), today)
+
+
+def synthetic_issuance(members: int, depth: int = 5, seed: Seed = 0, fees: np.ndarray = None,
+                       today: pd.Timestamp = None) -> pd.DataFrame:
+    # Up to depth yearly cards for each member, the latest due for renewal around now. One card in seven is
+    # prospective, processed with no fee, and half of those are charged a few days later on a second row.
+    rng = np.random.default_rng(seed)
+    today = pd.Timestamp.today().normalize() if today is None else today
+    fees = zone_fees(rng, members, today) if fees is None else fees
+    cards = rng.integers(0, depth + 1, members)
+    first_months = month_number(today) - 12 * cards + rng.integers(-11, 3, members)
+    card_members = np.repeat(np.arange(1, members + 1), cards)
+    card_numbers = np.arange(cards.sum()) - np.repeat(np.cumsum(cards) - cards, cards)
+    issue_months = np.repeat(first_months, cards) + 12 * card_numbers
+    card_issuance = month_starts(issue_months)
+    renewal_date = month_starts(issue_months + 12)
+    prospective = rng.random(len(card_members)) < 0.15
+    issuance = pd.DataFrame({
+        'Membership ID': card_members,
+        'Processing Date': card_issuance - pd.to_timedelta(rng.integers(0, 20, len(card_members)), unit='D'),
+        'Card Issuance': card_issuance,
+        'Renewal Date': renewal_date,
+        'Card End Date': month_starts(issue_months + 13) - pd.Timedelta(days=1),
+        'Membership Fee': np.where(prospective, 0, fees[card_members - 1]),
+        'Anticipatory': prospective,
+    })
+    charged = issuance[prospective & (rng.random(len(issuance)) < 0.5)]
+    charged = charged.assign(**{
+        'Processing Date': charged['Processing Date'] + pd.Timedelta(days=3),
+        'Membership Fee': fees[charged['Membership ID'] - 1],
+        'Anticipatory': False,
+    })
+    return pd.concat([issuance, charged]).sort_values(['Membership ID', 'Processing Date'], kind='stable')\
+        .reset_index(drop=True)
+
+
+def synthetic_payments(members: int, depth: int = 5, seed: Seed = 0, fees: np.ndarray = None,
+                       today: pd.Timestamp = None) -> dict[str, pd.DataFrame]:
+    # a few payments a year for each member, mostly their fee, spread over the payment workbooks
+    rng = np.random.default_rng(seed)
+    today = pd.Timestamp.today().normalize() if today is None else today
+    fees = zone_fees(rng, members, today) if fees is None else fees
+    counts = rng.integers(0, depth + 2, members)
+    payment_members = np.repeat(np.arange(1, members + 1), counts)
+    size = len(payment_members)
+    amounts = np.where(rng.random(size) < 0.8, fees[payment_members - 1],
+                       rng.choice([20, -8], size)).astype(float)
+    payments = pd.DataFrame({
+        'Membership ID': payment_members,
+        'Date': today - pd.to_timedelta(rng.integers(0, 365 * (depth + 1), size), unit='D'),
+        'Amount': amounts,
+    })
+    workbooks = rng.integers(0, len(payment_workbooks), size)
+    payments['Payment Type'] = rng.choice(['SO', 'Cheque', 'PayPal', 'Cash'], size)
+    return {name: payments[workbooks == number].reset_index(drop=True)
+            for number, name in enumerate(payment_workbooks)}
+
+
+def synthetic_statements(size: int, seed: Seed = 0, today: pd.Timestamp = None) -> pd.DataFrame:
+    # bank statement lines over the last two years or so, four in five of them credits
+    rng = np.random.default_rng(seed)
+    today = pd.Timestamp.today().normalize() if today is None else today
+    credit = rng.random(size) < 0.8
+    return pd.DataFrame({
+        'Transaction Date': np.sort(today - pd.to_timedelta(rng.integers(0, 800, size), unit='D')),
+        'Transaction Type': rng.choice(['BGC', 'FPI', 'DD', 'SO'], size),
+        'Transaction Description': [f'PAYMENT REF {i}' for i in range(size)],
+        'Debit Amount': np.where(credit, np.nan, rng.integers(1, 100, size)),
+        'Credit Amount': np.where(credit, rng.integers(1, 100, size), np.nan),
+        'Balance': rng.integers(0, 10000, size) / 100,
+    })
+
+
+def generate(files_dir: str, members: int, depth: int = 5, seed: int = 0):
+    # every workbook the outputs read, for the number of members, with up to depth years of cards and payments
+    rng = np.random.default_rng(seed)
+    today = pd.Timestamp.today().normalize()
+    this_month = today.replace(day=1)
+    os.makedirs(files_dir, exist_ok=True)
+
+    member_sheets = synthetic_member_sheets(members, rng, today)
+    fees = member_fees(member_sheets['Member'], member_sheets['Associates'], today)
+    issuance = synthetic_issuance(members, depth, rng, fees, today)
+    payments = synthetic_payments(members, depth, rng, fees, today)
+    member_ids = np.arange(1, members + 1)
+    preprinted = rng.choice(member_ids, max(1, members // 30), replace=False)
+    reprinted = rng.choice(member_ids, max(1, members // 50), replace=False)
+
+    workbooks: dict[str, list[tuple[str, pd.DataFrame]]] = {
+        'Properties': [('Properties', member_sheets['Properties'])],
+        'Member Details': [('Member', member_sheets['Member']), ('Associates', member_sheets['Associates'])],
+        **{name: [('Payments', payments[name])] for name in payment_workbooks},
+        'Preprints': [('Preprints', pd.DataFrame({
+            'Membership Number': preprinted,
+            'Letter Date': this_month,
+            'Card End Date': this_month + pd.offsets.MonthBegin(12) + pd.offsets.MonthEnd(),
+            'Addressee': 'x',
+            'Informal addressee': 'y',
+            'Address Line 1': 'z',
+            'Done': None,
+        }))],
+        'Competitions': [('Junior Photography Competition', pd.DataFrame({
+            'Year': np.arange(2015, today.year + 1),
+            'Winner': [f'Kid {year}' for year in range(2015, today.year + 1)],
+        }))],
+        'Force Reprints': [('Forced Reprints', pd.DataFrame({
+            'Membership ID': reprinted,
+            'Reset Issuance': np.where(rng.random(len(reprinted)) < 0.5, True, None),
+        }))],
+    }
+    workbooks['Card Issuances'].append(('Card Issuance', issuance))
+    workbooks[statements_sheet.workbook].append((statements_sheet.sheet, synthetic_statements(members * 3, rng, today)))
+
+    for name, sheets in workbooks.items():
+        print(f'writing {name}.xlsx')
+        with ExcelOutput(os.path.join(files_dir, f'{name}.xlsx')) as output:
+            for sheet_name, df in sheets:
+                output.write(df, sheet_name, index=False)
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(
+        description='Write made-up membership workbooks to run and profile the outputs on.')
+    parser.add_argument('files_dir', help='directory to write the workbooks to, used as BA_FILES_DIR')
+    parser.add_argument('-n', '--members', type=int, default=1_000)
+    parser.add_argument('-d', '--depth', type=int, default=5, help='most years of card issuances and payments')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    generate(args.files_dir, args.members, args.depth, args.seed)
+
+
+if __name__ == '__main__':
+    main()
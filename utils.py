@@ -1,34 +1,271 @@
+import importlib.util
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import batched
+from typing import Any, Iterator, NamedTuple
 
+import openpyxl
 import pandas as pd
+import numpy as np
 from dotenv import find_dotenv, load_dotenv
+from pandas.io.parsers import TextParser
 
+from cache import SheetCache
 
+
+# loaded once, here, as every setting is read through env_setting or env_flag
 load_dotenv(find_dotenv())
 
 
-files_dir = os.getenv('BA_FILES_DIR', '')
+def env_setting(name: str, default: Any) -> Any:
+    return os.getenv(name, default)
+
+
+def env_flag(name: str, default: bool = True) -> bool:
+    # a switch that is on unless set to 0, off, false or no
+    value = os.getenv(name)
+    return default if value is None else value.lower() not in ('0', 'off', 'false', 'no')
+
+
+files_dir = env_setting('BA_FILES_DIR', '')
+load_workers = int(env_setting('BA_LOAD_WORKERS', os.cpu_count() or 1))
+
+# calamine needs python-calamine and pandas 2.2; openpyxl-stream builds the frame a chunk of rows at a time
+excel_engines = ['calamine', 'openpyxl-stream', 'openpyxl']
+excel_engine = env_setting('BA_EXCEL_ENGINE', 'calamine').lower()
+if excel_engine not in excel_engines:
+    raise ValueError(f'BA_EXCEL_ENGINE must be one of {", ".join(excel_engines)}')
+calamine_supported = importlib.util.find_spec('python_calamine') is not None and\
+    tuple(map(int, pd.__version__.split('.')[:2])) >= (2, 2)
+stream_chunk_rows = int(env_setting('BA_STREAM_CHUNK_ROWS', '10000'))
+
+cache_dir = env_setting('BA_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'bapython'))
+cache_max_bytes = int(float(env_setting('BA_CACHE_MAX_MB', '1024')) * 1024 * 1024)
+cache_enabled = env_flag('BA_CACHE')
+sheet_cache = SheetCache(cache_dir, cache_max_bytes) if cache_enabled else None
+
+excel_errors = {'#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A'}
+
+
+class Excluding(frozenset):
+    # a usecols that keeps every column but these, with a stable repr for the sheet cache key
+    def __call__(self, column: str) -> bool:
+        return column not in self
+
+    def __repr__(self) -> str:
+        return f'Excluding({sorted(self)!r})'
+
+
+type UseCols = list[str] | Excluding | None
+type DTypes = dict[str, Any] | None
+
+
+class Sheet(NamedTuple):
+    workbook: str
+    sheet: str
+    usecols: UseCols = None
+    dtype: DTypes = None
+
+    def variant(self, engine: str) -> str:
+        # cached apart from the same sheet read by another engine or with other columns or types, as the engines
+        # differ in the types and datetimes they read
+        return f'{engine}:{self.usecols!r}:{self.dtype!r}'
+
+    @property
+    def key(self) -> tuple[str, str, str]:
+        return self.workbook, self.sheet, repr((self.usecols, self.dtype))
+
+
+def workbook_path(name: str) -> str:
+    for extension in ['.xlsx', '.xlsm']:
+        xl_file = os.path.join(files_dir, name + extension)
+        if os.path.exists(xl_file):
+            return xl_file
+    raise FileNotFoundError(f'File {name}.xlsx or {name}.xlsm not found')
+
+
+def convert_value(value: Any) -> Any:
+    # as pandas' openpyxl reader converts each cell
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        as_int = int(value)
+        return as_int if as_int == value else value
+    if isinstance(value, str) and value in excel_errors:
+        return np.nan
+    return value
+
 
-type MaybeDataFrame = False | pd.DataFrame
+def sheet_rows(worksheet) -> Iterator[list[Any]]:
+    # blank rows are held back until more data follows, as pandas drops those at the end of a sheet
+    blank_rows = []
+    for row in worksheet.iter_rows(values_only=True):
+        converted_row = [convert_value(value) for value in row]
+        while converted_row and converted_row[-1] == '':
+            converted_row.pop()
+        if not converted_row:
+            blank_rows.append(converted_row)
+            continue
+        yield from blank_rows
+        blank_rows.clear()
+        yield converted_row
 
 
-def maybe_load_xl_dataframe(name: str, sheet: str) -> MaybeDataFrame:
-    xl_file = os.path.join(files_dir, name)
-    if os.path.exists(xl_file):
-        print(f'Loading data from {name}')
-        return pd.read_excel(xl_file, sheet)
-    return False
+def stream_sheet(book, sheet: str, usecols: UseCols = None, dtype: DTypes = None,
+                 chunk_rows: int = None) -> pd.DataFrame:
+    # Only one chunk of cell values is held at a time. Types are inferred per chunk and reconciled when the
+    # chunks are joined, so a column can come out differently from a whole-sheet read when its text looks
+    # numeric in some chunks only.
+    worksheet = book[sheet]
+    worksheet.reset_dimensions()
+    rows = sheet_rows(worksheet)
+    header = next(rows, [])
+    chunks = []
+    for chunk in batched(rows, chunk_rows or stream_chunk_rows):
+        width = max(len(header), *map(len, chunk))
+        data = [row + [''] * (width - len(row)) for row in [header, *chunk]]
+        chunks.append(TextParser(data, header=0, usecols=usecols, dtype=dtype, skip_blank_lines=False).read())
+    if not chunks:
+        return TextParser([header], header=0, usecols=usecols, dtype=dtype).read()
+    return pd.concat(chunks, ignore_index=True).infer_objects()
 
 
-def loadFromExcel(name: str, sheet: str = None) -> pd.DataFrame:
+class Workbook:
+    """An Excel workbook, located once in the files directory and opened once for every sheet read from it.
+
+    The engine falls back to openpyxl when calamine is not installed or not supported by pandas.
+    """
+
+    def __init__(self, name: str, engine: str = None):
+        self.name = name
+        self.path = workbook_path(name)
+        self.file_name = os.path.basename(self.path)
+        self.engine = engine or excel_engine
+        if self.engine == 'calamine' and not calamine_supported:
+            # settled before anything is read, so sheets are cached under the engine that reads them
+            self.engine = 'openpyxl'
+        self._excel_file = None
+        self._stream_book = None
+
+    def _open(self):
+        print(f'Loading data from {self.file_name}')
+        if self.engine == 'openpyxl-stream':
+            self._stream_book = openpyxl.load_workbook(self.path, read_only=True, data_only=True, keep_links=False)
+            return
+        if self.engine == 'calamine':
+            try:
+                self._excel_file = pd.ExcelFile(self.path, engine='calamine')
+                return
+            except (ImportError, ValueError):
+                self.engine = 'openpyxl'
+        self._excel_file = pd.ExcelFile(self.path, engine='openpyxl')
+
+    def parse(self, sheet: str, usecols: UseCols = None, dtype: DTypes = None) -> pd.DataFrame:
+        if self._excel_file is None and self._stream_book is None:
+            self._open()
+        if self._stream_book is not None:
+            return stream_sheet(self._stream_book, sheet, usecols, dtype)
+        return self._excel_file.parse(sheet, usecols=usecols, dtype=dtype)
+
+    def read(self, sheet: str, usecols: UseCols = None, dtype: DTypes = None) -> pd.DataFrame:
+        variant = Sheet(self.name, sheet, usecols, dtype).variant(self.engine)
+        if sheet_cache is not None:
+            df = sheet_cache.get(self.path, sheet, variant)
+            if df is not None:
+                print(f'Loading data from {self.file_name} (cached)')
+                return df
+        df = self.parse(sheet, usecols, dtype)
+        if sheet_cache is not None:
+            sheet_cache.put(self.path, sheet, df, variant)
+        return df
+
+    def close(self):
+        if self._excel_file is not None:
+            self._excel_file.close()
+            self._excel_file = None
+        if self._stream_book is not None:
+            self._stream_book.close()
+            self._stream_book = None
+
+    def __enter__(self) -> 'Workbook':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+workbooks: dict[str, Workbook] = {}
+# sheets read ahead by load_sheets, handed out once by the next load of the same sheet
+prefetched: dict[tuple[str, str, str], pd.DataFrame] = {}
+
+
+def open_workbook(name: str) -> Workbook:
+    if name not in workbooks:
+        workbooks[name] = Workbook(name)
+    return workbooks[name]
+
+
+def close_workbooks():
+    for workbook in workbooks.values():
+        workbook.close()
+    workbooks.clear()
+
+
+def loadFromExcel(name: str, sheet: str = None, usecols: UseCols = None, dtype: DTypes = None,
+                  engine: str = None) -> pd.DataFrame:
     if sheet is None:
         sheet = name
+    if engine is not None and Workbook(name, engine).engine != open_workbook(name).engine:
+        # read ahead sheets were read by the default engine
+        with Workbook(name, engine) as workbook:
+            return workbook.read(sheet, usecols, dtype)
+    key = Sheet(name, sheet, usecols, dtype).key
+    if key in prefetched:
+        return prefetched.pop(key)
+    return open_workbook(name).read(sheet, usecols, dtype)
+
+
+def read_workbook_sheets(name: str, sheets: list[Sheet]) -> list[pd.DataFrame]:
+    # one parse of the workbook for all of its sheets; runs in the loader's worker processes
+    with Workbook(name) as workbook:
+        return [workbook.parse(source.sheet, source.usecols, source.dtype) for source in sheets]
+
+
+def load_sheets(sources: list[Sheet | tuple[str, str]], workers: int = None) -> list[pd.DataFrame]:
+    if workers is None:
+        workers = load_workers
+    sources = [Sheet(*source) for source in sources]
+    frames: dict[tuple[str, str, str], pd.DataFrame] = {}
+    to_read: dict[str, list[Sheet]] = {}
+    for source in {source.key: source for source in sources}.values():
+        if source.key in prefetched:
+            frames[source.key] = prefetched.pop(source.key)
+            continue
+        if sheet_cache is not None:
+            workbook = open_workbook(source.workbook)
+            df = sheet_cache.get(workbook.path, source.sheet, source.variant(workbook.engine))
+            if df is not None:
+                print(f'Loading data from {workbook.file_name} (cached)')
+                frames[source.key] = df
+                continue
+        to_read.setdefault(source.workbook, []).append(source)
+
+    if workers > 1 and len(to_read) > 1:
+        with ProcessPoolExecutor(min(workers, len(to_read))) as executor:
+            read = dict(zip(to_read, executor.map(read_workbook_sheets, to_read, to_read.values())))
+    else:
+        read = {name: [open_workbook(name).parse(source.sheet, source.usecols, source.dtype) for source in sheets]
+                for name, sheets in to_read.items()}
 
-    df_or_false = maybe_load_xl_dataframe(name + '.xlsx', sheet)
-    if not isinstance(df_or_false, pd.DataFrame):
-        df_or_false = maybe_load_xl_dataframe(name + '.xlsm', sheet)
-        if not isinstance(df_or_false, pd.DataFrame):
-            raise FileNotFoundError(f'File {name}.xlsx or {name}.xlsm not found')
+    for name, dfs in read.items():
+        for source, df in zip(to_read[name], dfs):
+            if sheet_cache is not None:
+                workbook = open_workbook(name)
+                sheet_cache.put(workbook.path, source.sheet, df, source.variant(workbook.engine))
+            frames[source.key] = df
+    return [frames[source.key] for source in sources]
 
-    return df_or_false
 
+def prefetch(sources: list[Sheet | tuple[str, str]], workers: int = None):
+    sources = [Sheet(*source) for source in sources]
+    prefetched.update(zip([source.key for source in sources], load_sheets(sources, workers)))
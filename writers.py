@@ -0,0 +1,324 @@
+import datetime
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+from cache import file_digest, write_json_atomic
+from utils import env_flag, env_setting, stream_chunk_rows
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+stream_output_enabled = env_flag('BA_STREAM_OUTPUT')
+output_workers = int(env_setting('BA_OUTPUT_WORKERS', os.cpu_count() or 1))
+
+# values the csv module would quote; Arrow can only write a chunk with none of them unquoted
+csv_special_characters = '[,"\r\n]'
+
+# the style to_excel gives header cells and index labels, as xlsxwriter format properties
+excel_header_format = {'bold': True, 'align': 'center', 'valign': 'top', 'top': 1, 'right': 1, 'bottom': 1, 'left': 1}
+
+
+class ExcelOutput:
+    """An xlsx file written with xlsxwriter, in constant_memory mode a chunk of rows at a time.
+
+    In constant_memory mode xlsxwriter keeps only the current row, so each frame is laid out as to_excel lays it out,
+    with the same values and formats, and written a row at a time. Index labels that to_excel merges down rows are
+    merged over the same ranges, each declared at its first row with no format, so xlsxwriter writes nothing ahead
+    of the current row, and the rest of its cells written as blanks in the label's format as their rows come.
+    """
+
+    # xlsxwriter cannot add tables in constant_memory mode, so a sheet with one needs constant_memory=False
+    def __init__(self, path: str, constant_memory: bool = None, **writer_kwargs):
+        self.constant_memory = stream_output_enabled if constant_memory is None else constant_memory
+        if not self.constant_memory:
+            self.writer = pd.ExcelWriter(path, engine='xlsxwriter', **writer_kwargs)
+            return
+        self.book = xlsxwriter.Workbook(path, {'constant_memory': True})
+        self.datetime_format = writer_kwargs.get('datetime_format') or 'YYYY-MM-DD HH:MM:SS'
+        self.date_format = writer_kwargs.get('date_format') or 'YYYY-MM-DD'
+        self._formats = {}
+
+    def write(self, df: pd.DataFrame, sheet_name: str, index: bool = True):
+        if not self.constant_memory:
+            df.to_excel(self.writer, sheet_name=sheet_name, index=index)
+            return
+        if isinstance(df.columns, pd.MultiIndex):
+            raise ValueError(f'cannot write {sheet_name} in constant_memory mode, its columns have more than one level')
+        sheet = self.book.add_worksheet(sheet_name)
+        levels = df.index.nlevels if index else 0
+        names = list(df.index.names) if index else []
+        # to_excel labels a single index only when its name is set, and every level of a MultiIndex when any is
+        labelled = any(name is not None for name in names) if levels > 1 else bool(names and names[0])
+        header = [(col, name) for col, name in enumerate(names) if labelled]
+        header += [(col, label) for col, label in enumerate(df.columns, levels)]
+        for col, label in header:
+            self._write_label(sheet, 0, col, *self._value(label))
+
+        runs = merged_runs(df.index) if levels > 1 else []
+        run_formats = [None] * len(runs)
+        for start in range(0, len(df), stream_chunk_rows):
+            chunk = df.iloc[start:start + stream_chunk_rows]
+            labels = [self._cells(chunk.index.get_level_values(level)) for level in range(levels)]
+            columns = [self._cells(values) for _, values in chunk.items()]
+            for offset in range(len(chunk)):
+                position, row = start + offset, start + offset + 1
+                for level, (values, num_formats) in enumerate(labels):
+                    cell_format = self._format(True, num_formats[offset])
+                    if level < len(runs):
+                        first, last = runs[level]
+                        if not first[position]:
+                            sheet.write_blank(row, level, None, run_formats[level])
+                            continue
+                        run_formats[level] = cell_format
+                        if last[position] > position:
+                            sheet.merge_range(row, level, row + last[position] - position, level, '', None)
+                    self._write_label(sheet, row, level, values[offset], num_formats[offset])
+                for col, (values, num_formats) in enumerate(columns, levels):
+                    if values[offset] is not None:
+                        sheet.write(row, col, values[offset], self._format(False, num_formats[offset]))
+
+    def _write_label(self, sheet, row: int, col: int, value, num_format: str | None):
+        # a header or index label, a blank in the header format where the label is missing
+        cell_format = self._format(True, num_format)
+        if value is None:
+            sheet.write_blank(row, col, None, cell_format)
+        else:
+            sheet.write(row, col, value, cell_format)
+
+    def _format(self, label: bool, num_format: str | None):
+        key = label, num_format
+        if key not in self._formats:
+            properties = dict(excel_header_format) if label else {}
+            if num_format is not None:
+                properties['num_format'] = num_format
+            self._formats[key] = self.book.add_format(properties) if properties else None
+        return self._formats[key]
+
+    def _value(self, value) -> tuple[Any, str | None]:
+        # the value as to_excel writes it, None where it leaves the cell blank, and its number format
+        if pd.api.types.is_scalar(value) and pd.isna(value):
+            return None, None
+        if pd.api.types.is_integer(value):
+            return int(value), None
+        if pd.api.types.is_float(value):
+            return (float(value) if np.isfinite(value) else str(value)), None
+        if pd.api.types.is_bool(value):
+            return bool(value), None
+        if isinstance(value, datetime.datetime):
+            return value, self.datetime_format
+        if isinstance(value, datetime.date):
+            return value, self.date_format
+        if isinstance(value, datetime.timedelta):
+            return value.total_seconds() / 86400, '0'
+        return str(value), None
+
+    def _cells(self, values) -> tuple[list, list[str | None]]:
+        # the values and number formats of a column as _value gives them, taking whole numpy columns where it can
+        values = pd.Series(values)
+        # nullable extension columns share their kinds with numpy's, but hold pd.NA
+        kind = values.dtype.kind if isinstance(values.dtype, np.dtype) else 'O'
+        no_formats = [None] * len(values)
+        if kind in 'iub':
+            return values.tolist(), no_formats
+        if kind == 'f':
+            floats, cells = values.to_numpy(), values.tolist()
+            for position in np.flatnonzero(~np.isfinite(floats)):
+                cells[position] = None if np.isnan(floats[position]) else str(floats[position])
+            return cells, no_formats
+        if kind == 'M' and values.dt.tz is None:
+            missing = values.isna().tolist()
+            cells = [None if na else value for value, na in zip(values.astype(object), missing)]
+            return cells, [None if na else self.datetime_format for na in missing]
+        cells = [self._value(value) for value in values.astype(object)]
+        return [value for value, _ in cells], [num_format for _, num_format in cells]
+
+    def close(self):
+        if self.constant_memory:
+            self.book.close()
+        else:
+            self.writer.close()
+
+    def __enter__(self) -> 'ExcelOutput':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def merged_runs(index: pd.MultiIndex) -> list[tuple[np.ndarray, np.ndarray]]:
+    # For each level to_excel merges, all but the innermost, whether each row starts a run of labels, and the
+    # position of the last row of its run. A run ends where the level's label or that of any outer level changes.
+    n = len(index)
+    runs = []
+    first = np.zeros(n, dtype=bool)
+    first[:1] = True
+    for level in range(index.nlevels - 1):
+        codes = index.codes[level]
+        first[1:] |= codes[1:] != codes[:-1]
+        last = np.flatnonzero(np.append(first[1:], True))
+        runs.append((first.copy(), last[np.cumsum(first) - 1]))
+    return runs
+
+
+def csv_column(values: pd.Series):
+    # the column as Arrow would write it to match to_csv, or None where only pandas writes it the same
+    if values.dtype == bool:
+        return pa.array(np.where(values, 'True', 'False'))
+    if pd.api.types.is_integer_dtype(values.dtype):
+        return pa.array(values)
+    if values.dtype.kind == 'f':
+        # to_csv writes floats as numpy formats them, Arrow would write 1.0 as 1
+        return pa.array(values.astype(str).where(values.notna(), None))
+    if values.dtype == object or isinstance(values.dtype, (pd.CategoricalDtype, pd.BooleanDtype)):
+        values = values.astype(object)
+        strings = values if pd.api.types.infer_dtype(values, skipna=True) in ('string', 'empty') else\
+            values.map(str, na_action='ignore')
+        return pa.array(strings.where(values.notna(), None), type=pa.string())
+    return None
+
+
+def arrow_chunk(chunk: pd.DataFrame):
+    # the chunk as a table that Arrow writes byte for byte as to_csv does, or None
+    if pa is None or os.linesep != '\n' or len(chunk.columns) < 2:
+        # Arrow ends lines with \n alone, and the csv module quotes a row of one empty value
+        return None
+    columns = []
+    for _, values in chunk.items():
+        column = csv_column(values)
+        if column is None:
+            return None
+        if pa.types.is_string(column.type) and pc.any(pc.match_substring_regex(column, csv_special_characters)).as_py():
+            return None
+        columns.append(column)
+    return pa.Table.from_arrays(columns, names=[str(column) for column in chunk.columns])
+
+
+def write_csv(df: pd.DataFrame, path: str):
+    # as df.to_csv(path, index=False), a chunk of rows at a time, through Arrow where it writes the same text
+    if not stream_output_enabled or pa is None:
+        df.to_csv(path, index=False)
+        return
+    options = pa_csv.WriteOptions(include_header=False, quoting_style='none')
+    with open(path, 'wb') as f:
+        f.write(df.head(0).to_csv(index=False).encode())
+        for start in range(0, len(df), stream_chunk_rows):
+            chunk = df.iloc[start:start + stream_chunk_rows]
+            table = arrow_chunk(chunk)
+            if table is None:
+                f.write(chunk.to_csv(index=False, header=False).encode())
+            else:
+                pa_csv.write_csv(table, f, options)
+
+
+# a sheet name, its frame, and whether to write the frame's index
+type SheetOutput = tuple[str, pd.DataFrame, bool]
+# writes an output file to the path it is given, returning the rows of each sheet, or of the file as '' when a CSV
+type OutputWriter = Callable[..., dict[str, int]]
+
+
+def csv_output(path: str, df: pd.DataFrame) -> dict[str, int]:
+    write_csv(df, path)
+    return {'': len(df)}
+
+
+def excel_output(path: str, sheets: list[SheetOutput]) -> dict[str, int]:
+    with ExcelOutput(path) as output:
+        for sheet_name, df, index in sheets:
+            output.write(df, sheet_name, index)
+    return {sheet_name: len(df) for sheet_name, df, _ in sheets}
+
+
+def temporary_path(path: str) -> str:
+    # hidden from anything looking for the finished file, and keeping the extension ExcelWriter checks
+    directory, file_name = os.path.split(path)
+    stem, extension = os.path.splitext(file_name)
+    return os.path.join(directory, f'.{stem}.{os.getpid()}.tmp{extension}')
+
+
+def write_output(write: OutputWriter, path: str, *args) -> dict[str, Any]:
+    # the file written under a temporary name and renamed once complete, and its manifest entry
+    temp_path = temporary_path(path)
+    try:
+        rows = write(temp_path, *args)
+        entry = {
+            'file': os.path.basename(path),
+            'bytes': os.path.getsize(temp_path),
+            'rows': sum(rows.values()),
+            'sha256': file_digest(temp_path),
+        }
+        if '' not in rows:
+            entry['sheets'] = rows
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return entry
+
+
+class OutputRun:
+    """The output files of a run, written by a pool of worker processes while the next outputs are computed.
+
+    Each file is written under a temporary name and renamed when complete. Once every file is written the run's
+    manifest lists them with their sizes, rows and checksums, so a job picking up the outputs can tell a complete run
+    from one that stopped part way; no manifest is written when any file failed.
+    """
+
+    def __init__(self, workers: int = None, now: pd.Timestamp = None):
+        self.workers = output_workers if workers is None else workers
+        self.started = pd.Timestamp.today() if now is None else now
+        self.manifest_path = f'Run Manifest {self.started.isoformat().replace(':', '-')}.json'
+        self._executor = None
+        self._files: list[Future | dict[str, Any]] = []
+
+    def submit(self, write: OutputWriter, path: str, *args):
+        if self.workers <= 1:
+            self._files.append(write_output(write, path, *args))
+            return
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers)
+        self._files.append(self._executor.submit(write_output, write, path, *args))
+
+    def close(self, write_manifest: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if not write_manifest:
+            return
+        files = [file.result() if isinstance(file, Future) else file for file in self._files]
+        manifest = {
+            'started': self.started.isoformat(),
+            'finished': pd.Timestamp.today().isoformat(),
+            'files': files,
+        }
+        print(f'writing {self.manifest_path}')
+        write_json_atomic(self.manifest_path, manifest, indent=2)
+
+    def __enter__(self) -> 'OutputRun':
+        global current_run
+        current_run = self
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        global current_run
+        current_run = None
+        self.close(write_manifest=exc_type is None)
+
+
+current_run: OutputRun | None = None
+
+
+def submit_output(write: OutputWriter, path: str, *args):
+    # to the current run's pool, or written straight away outside a run
+    if current_run is None:
+        write_output(write, path, *args)
+    else:
+        current_run.submit(write, path, *args)